@@ -0,0 +1,233 @@
+"""
+Audit violations and uptime for many nodes at once, from a database generated by the ingester. By default every node in the database is scanned for the last completed minting period, so the results can be reconciled against the output of minting.
+
+Nodes are split into shards of consecutive node ids, which are scanned in parallel by a pool of processes using the batch engine in find_violations. Each process opens its own read only connection, so it's safe to run this against the database of a live ingester.
+
+Uptime is the same estimate that find_violations prints in verbose mode. It's meant for spotting large differences with minting, not as an exact figure.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from grid3.minting.period import Period
+
+import find_violations
+
+# Shards per worker process. More shards than workers evens out the load, since some nodes have far more events than others
+SHARDS_PER_WORKER = 4
+
+# Each worker process keeps its own connection
+worker_con = None
+
+
+def connect_readonly(db_file):
+    return sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+
+
+def init_worker(db_file):
+    global worker_con
+    worker_con = connect_readonly(db_file)
+
+
+def scan_shard(nodes, offset, since, uptime):
+    period = find_violations.get_period(worker_con, offset) or Period(offset=offset)
+    if uptime:
+        results = find_violations.scan_nodes(worker_con, nodes, period, since)
+    else:
+        violations = find_violations.check_nodes(worker_con, nodes, period, since)
+        results = {
+            node: find_violations.ScanResult(v, None) for node, v in violations.items()
+        }
+    return offset, results
+
+
+def get_nodes(con, node_ids=None, farm_ids=None):
+    """Get the node ids to audit. By default these are the nodes with a PowerState or power target change, which are the only nodes that can have violations. Both are read from indexes. Farms are resolved through the power events, the only events that carry a farm id"""
+    if node_ids:
+        return sorted(set(node_ids))
+    elif farm_ids:
+        params = ", ".join("?" * len(farm_ids))
+        rows = con.execute(
+            f"""
+            SELECT node_id FROM PowerTargetChanged WHERE farm_id IN ({params})
+            UNION SELECT node_id FROM PowerStateChanged WHERE farm_id IN ({params})
+            """,
+            farm_ids + farm_ids,
+        ).fetchall()
+    else:
+        rows = con.execute("""
+            SELECT DISTINCT node_id FROM PowerState
+            UNION SELECT DISTINCT node_id FROM PowerTargetChanged
+            """).fetchall()
+    return sorted(row[0] for row in rows)
+
+
+def shard(nodes, count):
+    size = max(1, -(-len(nodes) // count))
+    return [nodes[i : i + size] for i in range(0, len(nodes), size)]
+
+
+def audit(db_file, nodes, offsets, workers, since=None, uptime=True):
+    """Scan the nodes for each period offset in parallel. Returns {offset: {node_id: ScanResult}}. See scan_nodes for since. Without uptime, only violations are found, which is several times faster, and the uptime of each result is None"""
+    shards = shard(nodes, workers * SHARDS_PER_WORKER)
+    results = {offset: {} for offset in offsets}
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=[db_file]
+    ) as executor:
+        futures = [
+            executor.submit(scan_shard, nodes, offset, since, uptime)
+            for offset in offsets
+            for nodes in shards
+        ]
+        for future in futures:
+            offset, shard_results = future.result()
+            results[offset].update(shard_results)
+    return results
+
+
+def write_json(results, output, violations_only):
+    records = []
+    for offset, nodes in results.items():
+        for node_id, result in sorted(nodes.items()):
+            if violations_only and not result.violations:
+                continue
+            records.append(
+                {
+                    "period": offset,
+                    "node_id": node_id,
+                    "uptime": result.uptime,
+                    "violations": [
+                        {
+                            "boot_requested": v.boot_requested,
+                            "booted_at": v.booted_at,
+                            "finalized": v.finalized,
+                            "end_time": v.end_time,
+                        }
+                        for v in result.violations
+                    ],
+                }
+            )
+    json.dump(records, output, indent=2)
+    output.write("\n")
+
+
+def write_csv(results, output, violations_only):
+    # One row per violation, plus one row for each node without violations
+    writer = csv.writer(output)
+    writer.writerow(
+        [
+            "period",
+            "node_id",
+            "uptime",
+            "violations",
+            "boot_requested",
+            "booted_at",
+            "finalized",
+            "end_time",
+        ]
+    )
+    for offset, nodes in results.items():
+        for node_id, result in sorted(nodes.items()):
+            row = [offset, node_id, result.uptime, len(result.violations)]
+            if result.violations:
+                for v in result.violations:
+                    writer.writerow(
+                        row + [v.boot_requested, v.booted_at, v.finalized, v.end_time]
+                    )
+            elif not violations_only:
+                writer.writerow(row + [None, None, None, None])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-f", "--file", help="Database file to audit", type=str, default="tfchain.db"
+    )
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument(
+        "-n", "--nodes", help="Node ids to audit", type=int, nargs="+"
+    )
+    selection.add_argument(
+        "--farms", help="Audit all nodes in these farms", type=int, nargs="+"
+    )
+    parser.add_argument(
+        "-p",
+        "--periods",
+        help="Period offsets to audit. Defaults to the last completed period",
+        type=int,
+        nargs="+",
+    )
+    parser.add_argument(
+        "-t",
+        "--times",
+        help="Audit the periods containing these timestamps, instead of giving offsets",
+        type=int,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--since",
+        help="Only audit what happened after the latest power state snapshot at or before this timestamp. Violations from before it are left out, and uptime only covers the part of the period after it",
+        type=int,
+    )
+    parser.add_argument(
+        "--no-uptime",
+        help="Only find violations, without estimating uptime. Most uptime reports are then skipped, which makes the audit several times faster",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of worker processes",
+        type=int,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        "--format", help="Output format", choices=["json", "csv"], default="json"
+    )
+    parser.add_argument("-o", "--output", help="Output file. Defaults to stdout")
+    parser.add_argument(
+        "--violations-only",
+        help="Only output nodes that have violations",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    if args.periods:
+        offsets = args.periods
+    elif args.times:
+        offsets = [Period(t).offset for t in args.times]
+    else:
+        offsets = [Period().offset - 1]
+
+    start = time.time()
+    nodes = get_nodes(connect_readonly(args.file), args.nodes, args.farms)
+    results = audit(
+        args.file,
+        nodes,
+        sorted(set(offsets)),
+        args.workers,
+        args.since,
+        not args.no_uptime,
+    )
+
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    if args.format == "json":
+        write_json(results, output, args.violations_only)
+    else:
+        write_csv(results, output, args.violations_only)
+    if args.output:
+        output.close()
+
+    violation_count = sum(
+        len(r.violations) for nodes in results.values() for r in nodes.values()
+    )
+    print(
+        f"Audited {len(nodes)} nodes over {len(offsets)} periods in {time.time() - start:.2f} seconds, found {violation_count} violations",
+        file=sys.stderr,
+    )
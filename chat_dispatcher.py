@@ -0,0 +1,146 @@
+"""
+A dispatcher that handles updates from different chats at the same time. PTB's default dispatcher runs handlers one at a time in its own thread, so one slow command holds up every other chat's commands. This one keeps the same handlers but runs them on a pool of worker threads:
+
+* Updates for the same chat are handled one at a time and in the order they arrived, so replies to a user's commands still come back in order
+* Updates for different chats are handled in parallel, up to the number of workers
+* Updates without a chat (which the bot doesn't handle anyway) go straight to the pool
+* When too many updates are waiting, new ones are turned away and passed to a callback instead, which can tell the user to try again later
+* No chat can have more than a share of the queue waiting, so one chat sending commands in a loop can't fill it and get everyone else turned away
+* A handler can hand slow work for a chat to another lane and hold the chat's later updates until it's done, see hold_chat
+
+The workers and queue are a lane (see lanes.py), which exports the queue length and waiting time as Prometheus metrics. The time taken to handle updates is exported here.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import prometheus_client
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import Dispatcher
+
+from lanes import Busy
+
+DEFAULT_WORKERS = 8
+# Updates waiting beyond this many are turned away
+DEFAULT_MAX_QUEUE = 200
+# The share of the queue that one chat's waiting updates can take up
+MAX_CHAT_SHARE = 0.1
+
+update_handling = prometheus_client.Histogram(
+    "dispatcher_update_seconds",
+    "Time taken to run the handlers for an update",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+busy_chats = prometheus_client.Gauge(
+    "dispatcher_busy_chats", "Chats with updates being handled or waiting"
+)
+
+
+class ChatDispatcher(Dispatcher):
+    def __init__(self, *args, lane, on_busy=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lane = lane
+        self.on_busy = on_busy
+        self.chat_limit = None
+        if lane.max_queue is not None:
+            self.chat_limit = max(1, int(lane.max_queue * MAX_CHAT_SHARE))
+        # Updates waiting for each chat that has one being handled
+        self.chat_queues = {}
+        # Work that each chat's later updates wait for, see hold_chat
+        self.held_chats = {}
+        self.chat_queues_lock = threading.Lock()
+
+    def process_update(self, update):
+        """Called by the dispatcher thread for each update. Queues the update for its chat instead of handling it here"""
+        # Errors from polling are handled right away, like the default dispatcher does
+        if isinstance(update, TelegramError):
+            super().process_update(update)
+            return
+
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            try:
+                admitted = self.lane.admit()
+            except Busy:
+                return
+            self.lane.executor.submit(self.handle, update, admitted)
+            return
+
+        with self.chat_queues_lock:
+            waiting = self.chat_queues.get(chat.id)
+            admitted = self.admit(waiting)
+            if admitted is not None:
+                if waiting is not None:
+                    # A worker is already on this chat and will get to it next
+                    waiting.append((update, admitted))
+                    return
+                self.chat_queues[chat.id] = collections.deque([(update, admitted)])
+                busy_chats.set(len(self.chat_queues))
+
+        if admitted is None:
+            if self.on_busy:
+                self.on_busy(update)
+            return
+        self.lane.executor.submit(self.run_chat, chat.id)
+
+    def admit(self, waiting):
+        """Count an update for a chat into the lane, given the chat's updates already waiting, if any. Returns the time it was admitted, or None if the chat or the whole queue is full"""
+        if (
+            waiting is not None
+            and self.chat_limit is not None
+            and len(waiting) >= self.chat_limit
+        ):
+            self.lane.shed.inc()
+            return None
+        try:
+            return self.lane.admit()
+        except Busy:
+            return None
+
+    def hold_chat(self, chat_id, future):
+        """Called by a handler that handed work for its chat to another lane. The chat's later updates wait until the future is done, so they're still handled in order, without keeping a worker here waiting"""
+        with self.chat_queues_lock:
+            self.held_chats[chat_id] = future
+
+    def run_chat(self, chat_id):
+        """Handle the chat's updates in order until there are none left, or the chat is held"""
+        while True:
+            with self.chat_queues_lock:
+                waiting = self.chat_queues[chat_id]
+                if not waiting:
+                    del self.chat_queues[chat_id]
+                    busy_chats.set(len(self.chat_queues))
+                    return
+                update, admitted = waiting.popleft()
+            self.handle(update, admitted)
+            with self.chat_queues_lock:
+                future = self.held_chats.pop(chat_id, None)
+            if future is not None:
+                # The chat stays in chat_queues meanwhile, so new updates wait behind the held work
+                future.add_done_callback(lambda _: self.resume_chat(chat_id))
+                return
+
+    def resume_chat(self, chat_id):
+        try:
+            self.lane.executor.submit(self.run_chat, chat_id)
+        except RuntimeError:
+            # The lane was shut down, so the bot is stopping
+            logging.warning("Dropped the waiting updates of chat %s", chat_id)
+
+    def handle(self, update, admitted):
+        self.lane.start(admitted)
+        start = time.monotonic()
+        try:
+            super().process_update(update)
+        except:
+            # The default dispatcher already catches errors in handlers, so this shouldn't happen, but a worker must never stop working through a chat's updates
+            logging.exception("Error processing update")
+        update_handling.observe(time.monotonic() - start)
+
+    def stop(self):
+        super().stop()
+        # Let updates that were already taken finish, so nothing a user sent is silently lost
+        self.lane.shutdown(wait=True)
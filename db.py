@@ -1,23 +1,136 @@
-from typing import Any, Dict, List, Tuple
+import functools
+import threading
+from typing import Any, Dict, List, Optional, Tuple
 
+import cachetools
+import prometheus_client
 import pyrqlite.dbapi2 as dbapi2
 
 from find_violations import Violation
+from rqlite_client import RqliteClient
+
+# Read consistency levels, see https://rqlite.io/docs/api/read-consistency/. Chat settings are read on nearly every command and only change when the chat changes them, so they're read from whichever node we're connected to without checking leadership. The leader key must never be read stale
+HOT_READ = "none"
+DEFAULT_READ = "weak"
+STRICT_READ = "strong"
+
+# How many chat settings and subscription lists to keep in memory, and for how many seconds, see RqliteDB.cached
+CHAT_CACHE_SIZE = 20000
+CHAT_CACHE_TTL = 60
+
+chat_cache_hits = prometheus_client.Counter(
+    "chat_cache_hits", "Chat settings reads served from memory", ["kind"]
+)
+chat_cache_misses = prometheus_client.Counter(
+    "chat_cache_misses", "Chat settings reads that went to rqlite", ["kind"]
+)
+
+method_latency = prometheus_client.Histogram(
+    "rqlite_method_seconds", "Time taken by each RqliteDB method", ["method"]
+)
+
+
+def timed(method):
+    """Record the latency of a RqliteDB method"""
+    histogram = method_latency.labels(method.__name__)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with histogram.time():
+            return method(*args, **kwargs)
+
+    return wrapper
 
 
 class RqliteDB:
-    def __init__(self, host: str = "localhost", port: int = 4001):
-        self.conn = dbapi2.connect(
-            host=host,
-            port=port,
-        )
+    def __init__(
+        self, host: str = "localhost", port: int = 4001, client: str = "pyrqlite"
+    ):
+        """The client is either "pyrqlite", or "http" for the pooled client in rqlite_client.py, which sends related statements together in one request"""
+        if client == "http":
+            self.client = RqliteClient(host=host, port=port)
+        else:
+            self.client = None
+            self.conn = dbapi2.connect(
+                host=host,
+                port=port,
+            )
+            # pyrqlite connections can't be shared between threads, so only one request goes through at a time
+            self.lock = threading.Lock()
+        # Chat settings and subscription lists, keyed by (kind, chat_id, ...). The leader makes every change to these through this object. For changes made elsewhere, entries expire quickly and the cache is cleared on taking over
+        self.chat_cache = cachetools.TTLCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL)
+        self.chat_cache_lock = threading.Lock()
+        self.chat_cache_writes = 0
         self._enable_foreign_keys()
         self._init_db()
 
+    def cached(self, key, load):
+        """Read through the chat cache: return the cached value for the key, or call load and cache what it returns"""
+        with self.chat_cache_lock:
+            value = self.chat_cache.get(key)
+            writes = self.chat_cache_writes
+        if value is not None:
+            chat_cache_hits.labels(key[0]).inc()
+            return value
+        chat_cache_misses.labels(key[0]).inc()
+        value = load()
+        with self.chat_cache_lock:
+            # If something was written while we were loading, what we loaded may already be stale
+            if self.chat_cache_writes == writes:
+                self.chat_cache[key] = value
+        return value
+
+    def set_cached(self, key, value):
+        with self.chat_cache_lock:
+            self.chat_cache[key] = value
+            self.chat_cache_writes += 1
+
+    def invalidate(self, key):
+        with self.chat_cache_lock:
+            self.chat_cache.pop(key, None)
+            self.chat_cache_writes += 1
+
+    def clear_cache(self):
+        """Drop every cached chat setting, for when other replicas may have changed them"""
+        with self.chat_cache_lock:
+            self.chat_cache.clear()
+            self.chat_cache_writes += 1
+
+    def _query(self, sql: str, params=(), level: str = DEFAULT_READ) -> List[list]:
+        """Run a query and return all of its rows"""
+        if self.client:
+            return self.client.query(sql, params, level)
+        with self.lock, self.conn.cursor() as cursor:
+            cursor.execute(sql, params, consistency=level)
+            return cursor.fetchall()
+
+    def _query_many(self, queries, level: str = DEFAULT_READ) -> List[List[list]]:
+        """Run a list of (sql, params) queries, in one request when possible, and return the rows of each"""
+        if self.client:
+            return self.client.request(queries, level)
+        return [self._query(sql, params, level) for sql, params in queries]
+
+    def _execute(self, sql: str, params=()) -> Optional[int]:
+        """Run a statement and return the number of rows it affected. Pyrqlite only reports that for UPDATE and DELETE, so other statements give None with it"""
+        if self.client:
+            return self.client.execute(sql, params)
+        with self.lock, self.conn.cursor() as cursor:
+            cursor.execute(sql, params)
+            if sql.split(None, 1)[0].upper() in ("UPDATE", "DELETE"):
+                return cursor.rowcount
+            return None
+
+    def _executemany(self, sql: str, seq_of_params) -> int:
+        """Run a statement for each set of parameters in a single transaction, and return the number of rows affected. Unlike its execute, pyrqlite's executemany counts them for every kind of statement, but it only logs errors, which then count no rows"""
+        if self.client:
+            return sum(self.client.executemany(sql, seq_of_params))
+        with self.lock, self.conn.cursor() as cursor:
+            cursor.executemany(sql, seq_of_params)
+            return max(cursor.rowcount, 0)
+
     def _enable_foreign_keys(self):
         """Enable foreign key constraints for SQLite"""
-        with self.conn.cursor() as cursor:
-            cursor.execute("PRAGMA foreign_keys = ON")
+        self._query("PRAGMA foreign_keys = ON")
 
     def _init_db(self):
         """Initialize database schema"""
@@ -45,6 +158,13 @@ class RqliteDB:
                 FOREIGN KEY (chat_id) REFERENCES chats(chat_id),
                 FOREIGN KEY (node_id, network) REFERENCES nodes(node_id, network)
             )""",
+            """CREATE TABLE IF NOT EXISTS farm_subscriptions (
+                chat_id INTEGER,
+                network TEXT,
+                farm_id INTEGER,
+                PRIMARY KEY (chat_id, network, farm_id),
+                FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
+            )""",
             """CREATE TABLE IF NOT EXISTS violations (
                 node_id INTEGER,
                 network TEXT,
@@ -59,26 +179,31 @@ class RqliteDB:
                 key TEXT PRIMARY KEY,
                 value TEXT
             )""",
+            """CREATE TABLE IF NOT EXISTS replicas (
+                replica_id TEXT PRIMARY KEY,
+                heartbeat REAL
+            )""",
         ]
 
-        with self.conn.cursor() as cursor:
-            for query in queries:
-                cursor.execute(query)
+        for query in queries:
+            self._execute(query)
 
+    @timed
     def create_chat(self, chat_id: int) -> None:
         """Create a new chat with default settings if it doesn't exist"""
-        with self.conn.cursor() as cursor:
-            cursor.execute(
-                """
-                INSERT OR IGNORE INTO chats (chat_id) VALUES (?)
-            """,
-                (chat_id,),
-            )
+        self._execute(
+            """
+            INSERT OR IGNORE INTO chats (chat_id) VALUES (?)
+        """,
+            (chat_id,),
+        )
 
+    @timed
     def get_subscribed_nodes(self, chat_id: int, network: str) -> List[int]:
         """Get list of node IDs that a chat is subscribed to for a specific network"""
-        with self.conn.cursor() as cursor:
-            cursor.execute(
+
+        def load():
+            rows = self._query(
                 """
                 SELECT s.node_id
                 FROM subscriptions s
@@ -86,263 +211,703 @@ class RqliteDB:
             """,
                 (chat_id, network),
             )
+            return tuple(row[0] for row in rows if row[0] is not None)
 
-            return [row[0] for row in cursor.fetchall() if row[0] is not None]
+        return list(self.cached(("subscriptions", chat_id, network), load))
 
+    @timed
     def update_chat_network(self, chat_id: int, network: str):
-        with self.conn.cursor() as cursor:
-            cursor.execute(
-                """
-                UPDATE chats SET net = ? WHERE chat_id = ?
-            """,
-                (network, chat_id),
-            )
+        """Set the network for a chat, creating the chat if needed so the cached value always matches what's stored"""
+        self._execute(
+            """
+            INSERT INTO chats (chat_id, net) VALUES (?, ?)
+            ON CONFLICT (chat_id) DO UPDATE SET net = excluded.net
+        """,
+            (chat_id, network),
+        )
+        self.set_cached(("network", chat_id), network)
 
     def add_subscription(self, chat_id: int, network: str, node_id: int):
         """Add a single subscription (kept for backward compatibility)"""
         self.add_subscriptions(chat_id, network, [node_id])
 
+    @timed
     def add_subscriptions(self, chat_id: int, network: str, node_ids: List[int]):
         """Add multiple subscriptions in a single request"""
-        with self.conn.cursor() as cursor:
-            cursor.executemany(
-                """
-                INSERT OR IGNORE INTO subscriptions (chat_id, network, node_id)
-                VALUES (?, ?, ?)
-            """,
-                [(chat_id, network, node_id) for node_id in node_ids],
-            )
+        self._executemany(
+            """
+            INSERT OR IGNORE INTO subscriptions (chat_id, network, node_id)
+            VALUES (?, ?, ?)
+        """,
+            [(chat_id, network, node_id) for node_id in node_ids],
+        )
+        self.invalidate(("subscriptions", chat_id, network))
 
     def remove_subscription(self, chat_id: int, network: str, node_id: int):
         """Remove a single subscription (kept for backward compatibility)"""
         self.remove_subscriptions(chat_id, network, [node_id])
 
+    @timed
     def remove_subscriptions(self, chat_id: int, network: str, node_ids: List[int]):
         """Remove multiple subscriptions in a single request"""
-        with self.conn.cursor() as cursor:
-            cursor.executemany(
+        self._executemany(
+            """
+            DELETE FROM subscriptions
+            WHERE chat_id = ? AND network = ? AND node_id = ?
+        """,
+            [(chat_id, network, node_id) for node_id in node_ids],
+        )
+        self.invalidate(("subscriptions", chat_id, network))
+
+    @timed
+    def remove_all_subscriptions(self, chat_id: int, network: str):
+        """Remove all of a chat's node and farm subscriptions on a network, with one DELETE for each"""
+        self._execute(
+            """
+            DELETE FROM subscriptions WHERE chat_id = ? AND network = ?
+        """,
+            (chat_id, network),
+        )
+        self._execute(
+            """
+            DELETE FROM farm_subscriptions WHERE chat_id = ? AND network = ?
+        """,
+            (chat_id, network),
+        )
+        self.invalidate(("subscriptions", chat_id, network))
+        self.invalidate(("farm_subscriptions", chat_id, network))
+
+    @timed
+    def get_subscribed_farms(self, chat_id: int, network: str) -> List[int]:
+        """Get list of farm IDs that a chat is subscribed to for a specific network"""
+
+        def load():
+            rows = self._query(
                 """
-                DELETE FROM subscriptions
-                WHERE chat_id = ? AND network = ? AND node_id = ?
+                SELECT farm_id FROM farm_subscriptions
+                WHERE chat_id = ? AND network = ?
             """,
-                [(chat_id, network, node_id) for node_id in node_ids],
+                (chat_id, network),
             )
+            return tuple(row[0] for row in rows)
+
+        return list(self.cached(("farm_subscriptions", chat_id, network), load))
+
+    @timed
+    def add_farm_subscriptions(self, chat_id: int, network: str, farm_ids: List[int]):
+        """Subscribe a chat to whole farms. Each farm is one row, expanded to its nodes when checking"""
+        self._executemany(
+            """
+            INSERT OR IGNORE INTO farm_subscriptions (chat_id, network, farm_id)
+            VALUES (?, ?, ?)
+        """,
+            [(chat_id, network, farm_id) for farm_id in farm_ids],
+        )
+        self.invalidate(("farm_subscriptions", chat_id, network))
+
+    @timed
+    def remove_farm_subscriptions(
+        self, chat_id: int, network: str, farm_ids: List[int]
+    ):
+        self._executemany(
+            """
+            DELETE FROM farm_subscriptions
+            WHERE chat_id = ? AND network = ? AND farm_id = ?
+        """,
+            [(chat_id, network, farm_id) for farm_id in farm_ids],
+        )
+        self.invalidate(("farm_subscriptions", chat_id, network))
+
+    @timed
+    def get_farm_subscriptions_by_network(self) -> Dict[str, Dict[int, List[int]]]:
+        """Get all farm subscriptions in one query, as a dict of network name to a dict of farm_id to the list of chat IDs subscribed to that farm"""
+        rows = self._query("""
+            SELECT network, farm_id, GROUP_CONCAT(chat_id)
+            FROM farm_subscriptions
+            GROUP BY network, farm_id
+            """)
+
+        subscriptions = {}
+        for network, farm_id, chat_ids in rows:
+            subscriptions.setdefault(network, {})[farm_id] = [
+                int(chat_id) for chat_id in chat_ids.split(",")
+            ]
+        return subscriptions
 
+    @timed
     def get_node(self, node_id: int, network: str) -> Dict[str, Any]:
-        with self.conn.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT node_id, network, status, updated_at,
-                       power_state, power_target, farmerbot
-                FROM nodes
-                WHERE node_id = ? AND network = ?
-            """,
-                (node_id, network),
-            )
+        """Get one node with its violations. Both queries go in one request with the http client"""
+        rows, violation_rows = self._query_many(
+            [
+                (
+                    """
+                    SELECT node_id, network, status, updated_at,
+                           power_state, power_target, farmerbot
+                    FROM nodes
+                    WHERE node_id = ? AND network = ?
+                """,
+                    (node_id, network),
+                ),
+                (
+                    """
+                    SELECT boot_requested, booted_at, end_time, finalized
+                    FROM violations
+                    WHERE node_id = ? AND network = ?
+                """,
+                    (node_id, network),
+                ),
+            ]
+        )
 
-            row = cursor.fetchone()
-            if row:
-                return {
-                    "nodeId": row[0],
-                    "status": row[2],
-                    "updatedAt": row[3],
-                    "power": {"state": row[4], "target": row[5]},
-                    "farmerbot": bool(row[6]),
-                    "violations": self.get_node_violations(node_id, network),
-                }
-            return None
+        if rows:
+            row = rows[0]
+            return {
+                "nodeId": row[0],
+                "status": row[2],
+                "updatedAt": row[3],
+                "power": {"state": row[4], "target": row[5]},
+                "farmerbot": bool(row[6]),
+                "violations": violations_from_rows(violation_rows),
+            }
+        return None
 
+    @timed
     def get_nodes(self, network: str) -> List[Dict[str, Any]]:
-        with self.conn.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT node_id, network, status, updated_at,
-                       power_state, power_target, farmerbot
-                FROM nodes
-                WHERE network = ?
-            """,
-                (network,),
+        """Get all nodes on a network with their violations. The two queries go in one request with the http client"""
+        node_rows, violation_rows = self._query_many(
+            [
+                (NODE_STATES_QUERY, (network,)),
+                (NETWORK_VIOLATIONS_QUERY, (network,)),
+            ]
+        )
+        violations = network_violations_from_rows(violation_rows)
+        nodes = []
+        for node_id, node in node_states_from_rows(node_rows).items():
+            node["violations"] = violations.get(node_id, {})
+            nodes.append(node)
+        return nodes
+
+    @timed
+    def get_node_states(self, network: str) -> Dict[int, Dict[str, Any]]:
+        """Get the stored state of all nodes on a network in a single query, keyed by node id. Unlike get_node, violations are not included"""
+        return node_states_from_rows(self._query(NODE_STATES_QUERY, (network,)))
+
+    @timed
+    def get_node_states_by_id(
+        self, network: str, node_ids: List[int]
+    ) -> Dict[int, Dict[str, Any]]:
+        """Like get_node_states, for just the given nodes. Nodes that aren't stored are left out"""
+        if not node_ids:
+            return {}
+        return node_states_from_rows(
+            self._query(
+                NODE_STATES_QUERY
+                + " AND node_id IN ({})".format(", ".join("?" * len(node_ids))),
+                (network, *node_ids),
             )
+        )
 
-            nodes = []
-            for row in cursor.fetchall():
-                nodes.append(
-                    {
-                        "nodeId": row[0],
-                        "status": row[2],
-                        "updatedAt": row[3],
-                        "power": {"state": row[4], "target": row[5]},
-                        "farmerbot": bool(row[6]),
-                        "violations": self.get_node_violations(row[0], network),
-                    }
-                )
-            return nodes
-
+    @timed
     def create_node(self, node, network: str):
-        with self.conn.cursor() as cursor:
-            cursor.execute(
-                """
-                INSERT OR IGNORE INTO nodes
-                (node_id, network, status, updated_at,
-                 power_state, power_target, farmerbot)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """,
-                (
-                    node.nodeId,
-                    network,
-                    node.status,
-                    node.updatedAt,
-                    node.power["state"],
-                    node.power["target"],
-                    getattr(node, "farmerbot", False),
-                ),
-            )
+        self._execute(
+            """
+            INSERT OR IGNORE INTO nodes
+            (node_id, network, status, updated_at,
+             power_state, power_target, farmerbot)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+            node_row(node, network),
+        )
 
+    @timed
+    def create_nodes(self, nodes, network: str):
+        """Store many nodes in a single transaction, leaving any that already exist as they are"""
+        if not nodes:
+            return
+        self._executemany(
+            """
+            INSERT OR IGNORE INTO nodes
+            (node_id, network, status, updated_at,
+             power_state, power_target, farmerbot)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+            [node_row(node, network) for node in nodes],
+        )
+
+    @timed
     def update_node(self, node, network: str):
-        with self.conn.cursor() as cursor:
-            cursor.execute(
-                """
-                INSERT OR REPLACE INTO nodes
-                (node_id, network, status, updated_at,
-                 power_state, power_target, farmerbot)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """,
-                (
-                    node.nodeId,
-                    network,
-                    node.status,
-                    node.updatedAt,
-                    node.power["state"],
-                    node.power["target"],
-                    getattr(node, "farmerbot", False),
-                ),
-            )
+        self._execute(
+            """
+            INSERT OR REPLACE INTO nodes
+            (node_id, network, status, updated_at,
+             power_state, power_target, farmerbot)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+            node_row(node, network),
+        )
+
+    @timed
+    def update_nodes(self, nodes, network: str):
+        """Write the state of many nodes in a single transaction"""
+        if not nodes:
+            return
+        self._executemany(
+            """
+            INSERT OR REPLACE INTO nodes
+            (node_id, network, status, updated_at,
+             power_state, power_target, farmerbot)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+            [node_row(node, network) for node in nodes],
+        )
 
+    @timed
     def get_node_violations(self, node_id: int, network: str) -> Dict[float, Violation]:
         """Get all violations for a node as a dict of Violation objects keyed by boot_requested timestamp"""
-        with self.conn.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT boot_requested, booted_at, end_time, finalized
-                FROM violations
-                WHERE node_id = ? AND network = ?
-            """,
-                (node_id, network),
-            )
+        rows = self._query(
+            """
+            SELECT boot_requested, booted_at, end_time, finalized
+            FROM violations
+            WHERE node_id = ? AND network = ?
+        """,
+            (node_id, network),
+        )
+        return violations_from_rows(rows)
 
-            return {
-                row[0]: Violation(
-                    boot_requested=row[0],
-                    booted_at=row[1],
-                    end_time=row[2],
-                    finalized=bool(row[3]),
+    @timed
+    def add_violations(self, node_id: int, network: str, violations: List[Violation]):
+        """Add multiple Violation objects in a single request"""
+        self._executemany(
+            """
+            INSERT OR REPLACE INTO violations
+            (node_id, network, boot_requested, booted_at, end_time, finalized)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """,
+            [
+                (
+                    node_id,
+                    network,
+                    v.boot_requested,
+                    v.booted_at,
+                    v.end_time,
+                    v.finalized,
                 )
-                for row in cursor.fetchall()
-            }
+                for v in violations
+            ],
+        )
 
-    def add_violation(self, node_id: int, network: str, violation):
-        """Add a single violation (kept for backward compatibility)"""
-        self.add_violations(node_id, network, [violation])
+    @timed
+    def add_network_violations(
+        self, network: str, violations: Dict[int, List[Violation]]
+    ):
+        """Add the violations of many nodes, given as {node_id: [Violation, ...]}, in a single request"""
+        self._executemany(
+            """
+            INSERT OR REPLACE INTO violations
+            (node_id, network, boot_requested, booted_at, end_time, finalized)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """,
+            [
+                (
+                    node_id,
+                    network,
+                    v.boot_requested,
+                    v.booted_at,
+                    v.end_time,
+                    v.finalized,
+                )
+                for node_id, node_violations in violations.items()
+                for v in node_violations
+            ],
+        )
 
-    def add_violations(self, node_id: int, network: str, violations: List[Violation]):
-        """Add multiple Violation objects in a single request"""
-        with self.conn.cursor() as cursor:
-            cursor.executemany(
-                """
-                INSERT OR REPLACE INTO violations
-                (node_id, network, boot_requested, booted_at, end_time, finalized)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """,
-                [
-                    (
-                        node_id,
-                        network,
-                        v.boot_requested,
-                        v.booted_at,
-                        v.end_time,
-                        v.finalized,
-                    )
-                    for v in violations
-                ],
+    @timed
+    def add_network_violations_if_leader(
+        self,
+        network: str,
+        violations: Dict[int, List[Violation]],
+        leader_id: str,
+        term: int,
+    ) -> bool:
+        """Like add_network_violations, but only if the replica still holds the leader lease for the given term, see set_metadata_if_leader. The rows are written in one transaction, all or none. Returns whether they were written"""
+        pattern = lease_pattern(leader_id, term)
+        rows = self._executemany(
+            """
+            INSERT OR REPLACE INTO violations
+            (node_id, network, boot_requested, booted_at, end_time, finalized)
+            SELECT ?, ?, ?, ?, ?, ? WHERE EXISTS (
+                SELECT 1 FROM metadata
+                WHERE key = 'leader' AND value LIKE ? ESCAPE '\\'
             )
+        """,
+            [
+                (
+                    node_id,
+                    network,
+                    v.boot_requested,
+                    v.booted_at,
+                    v.end_time,
+                    v.finalized,
+                    pattern,
+                )
+                for node_id, node_violations in violations.items()
+                for v in node_violations
+            ],
+        )
+        return rows > 0
 
-    def get_all_subscribed_nodes(self) -> List[Tuple[int, List[int]]]:
-        """Get list of all nodes with active subscriptions
+    @timed
+    def get_all_subscribed_nodes(
+        self, network: Optional[str] = None
+    ) -> List[Tuple[int, List[int]]]:
+        """Get list of all nodes with active subscriptions, optionally only for one network
 
         Returns:
             List of tuples where each tuple contains:
             - node_id: int
             - chat_ids: List[int] of chat IDs subscribed to this node
         """
-        with self.conn.cursor() as cursor:
-            cursor.execute(
-                """
+        if network is None:
+            rows = self._query("""
                 SELECT n.node_id, GROUP_CONCAT(s.chat_id)
                 FROM nodes n
                 JOIN subscriptions s ON n.node_id = s.node_id AND n.network = s.network
                 GROUP BY n.node_id
+                """)
+        else:
+            rows = self._query(
                 """
+                SELECT node_id, GROUP_CONCAT(chat_id)
+                FROM subscriptions
+                WHERE network = ?
+                GROUP BY node_id
+                """,
+                (network,),
             )
 
-            # Convert the comma-separated chat_ids string to a list of integers
-            return [
-                (row[0], [int(chat_id) for chat_id in row[1].split(",")])
-                for row in cursor.fetchall()
+        # Convert the comma-separated chat_ids string to a list of integers
+        return [
+            (row[0], [int(chat_id) for chat_id in row[1].split(",")]) for row in rows
+        ]
+
+    @timed
+    def get_subscriptions_by_network(self) -> Dict[str, Dict[int, List[int]]]:
+        """Get all active subscriptions in one query, grouped by network
+
+        Returns:
+            Dict of network name to a dict of node_id to the list of chat IDs subscribed to that node on that network
+        """
+        rows = self._query("""
+            SELECT network, node_id, GROUP_CONCAT(chat_id)
+            FROM subscriptions
+            GROUP BY network, node_id
+            """)
+
+        subscriptions = {}
+        for network, node_id, chat_ids in rows:
+            subscriptions.setdefault(network, {})[node_id] = [
+                int(chat_id) for chat_id in chat_ids.split(",")
             ]
+        return subscriptions
 
+    @timed
     def get_chat_network(self, chat_id: int) -> str:
         """Get the selected network for a chat"""
-        with self.conn.cursor() as cursor:
-            cursor.execute(
+
+        def load():
+            rows = self._query(
                 """
                 SELECT net FROM chats WHERE chat_id = ?
                 """,
                 (chat_id,),
+                HOT_READ,
             )
-            row = cursor.fetchone()
-            return row[0] if row else "main"
+            return rows[0][0] if rows else "main"
+
+        return self.cached(("network", chat_id), load)
 
+    @timed
     def get_metadata(self, key: str) -> str:
-        """Get metadata value by key"""
-        with self.conn.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT value FROM metadata WHERE key = ?
-                """,
-                (key,),
-            )
-            row = cursor.fetchone()
-            return row[0] if row else None
+        """Get metadata value by key. This holds the leader key, so it's always read from the leader"""
+        rows = self._query(
+            """
+            SELECT value FROM metadata WHERE key = ?
+            """,
+            (key,),
+            STRICT_READ,
+        )
+        return rows[0][0] if rows else None
 
+    @timed
     def set_metadata(self, key: str, value: str) -> None:
         """Set metadata value by key"""
-        with self.conn.cursor() as cursor:
-            cursor.execute(
+        self._execute(
+            """
+            INSERT OR REPLACE INTO metadata (key, value)
+            VALUES (?, ?)
+            """,
+            (key, value),
+        )
+
+    @timed
+    def compare_and_set_metadata(
+        self, key: str, old_value: Optional[str], new_value: str
+    ) -> bool:
+        """Set a metadata value only if it still holds old_value (None meaning it isn't set). Returns whether it was set. Writes go through the rqlite leader one at a time, so of two replicas racing to replace the same value, only one succeeds"""
+        if old_value is None:
+            rows = self._execute(
                 """
-                INSERT OR REPLACE INTO metadata (key, value)
-                VALUES (?, ?)
+                INSERT OR IGNORE INTO metadata (key, value) VALUES (?, ?)
                 """,
-                (key, value),
+                (key, new_value),
             )
+            if rows is None:
+                # The value holds a timestamp, so it's only there now if we put it there
+                return self.get_metadata(key) == new_value
+        else:
+            rows = self._execute(
+                """
+                UPDATE metadata SET value = ? WHERE key = ? AND value = ?
+                """,
+                (new_value, key, old_value),
+            )
+        return rows == 1
+
+    @timed
+    def set_metadata_if_leader(
+        self, key: str, value: str, leader_id: str, term: int
+    ) -> bool:
+        """Set a metadata value only if the replica still holds the leader lease for the given term. The check and the write are one statement, so a replica that has lost the lease can't overwrite what its successor wrote. Returns whether it was set, as counted by that statement"""
+        rows = self._executemany(
+            """
+            INSERT OR REPLACE INTO metadata (key, value)
+            SELECT ?, ? WHERE EXISTS (
+                SELECT 1 FROM metadata
+                WHERE key = 'leader' AND value LIKE ? ESCAPE '\\'
+            )
+            """,
+            [(key, value, lease_pattern(leader_id, term))],
+        )
+        return rows == 1
 
+    @timed
     def get_chat_timeout(self, chat_id: int) -> int:
         """Get the timeout setting for a chat"""
-        with self.conn.cursor() as cursor:
-            cursor.execute(
+
+        def load():
+            rows = self._query(
                 """
                 SELECT timeout FROM chats WHERE chat_id = ?
                 """,
                 (chat_id,),
+                HOT_READ,
             )
-            row = cursor.fetchone()
-            return row[0] if row else 10
+            return rows[0][0] if rows else 10
 
+        return self.cached(("timeout", chat_id), load)
+
+    @timed
     def set_chat_timeout(self, chat_id: int, timeout: int) -> None:
-        """Set the timeout setting for a chat"""
-        with self.conn.cursor() as cursor:
-            cursor.execute(
-                """
-                UPDATE chats SET timeout = ? WHERE chat_id = ?
-                """,
-                (timeout, chat_id),
-            )
+        """Set the timeout setting for a chat, creating the chat if needed"""
+        self._execute(
+            """
+            INSERT INTO chats (chat_id, timeout) VALUES (?, ?)
+            ON CONFLICT (chat_id) DO UPDATE SET timeout = excluded.timeout
+            """,
+            (chat_id, timeout),
+        )
+        self.set_cached(("timeout", chat_id), timeout)
+
+    @timed
+    def replica_heartbeat(self, replica_id: str, timestamp: float) -> None:
+        """Record that a bot replica is alive. Only changes to the heartbeat matter, see Liveness in sharding.py"""
+        self._execute(
+            """
+            INSERT OR REPLACE INTO replicas (replica_id, heartbeat)
+            VALUES (?, ?)
+            """,
+            (replica_id, timestamp),
+        )
+
+    @timed
+    def get_replicas(self) -> Dict[str, float]:
+        """Get the last heartbeat of every bot replica, as {replica_id: heartbeat}"""
+        rows = self._query(
+            "SELECT replica_id, heartbeat FROM replicas", (), STRICT_READ
+        )
+        return {replica_id: heartbeat for replica_id, heartbeat in rows}
+
+    @timed
+    def delete_replicas(self, replicas: List[Tuple[str, float]]) -> None:
+        """Delete the replicas given as (replica_id, heartbeat) pairs, unless they've sent another heartbeat since"""
+        self._executemany(
+            "DELETE FROM replicas WHERE replica_id = ? AND heartbeat = ?", replicas
+        )
+
+
+NODE_STATES_QUERY = """
+    SELECT node_id, network, status, updated_at,
+           power_state, power_target, farmerbot
+    FROM nodes
+    WHERE network = ?
+"""
+
+NETWORK_VIOLATIONS_QUERY = """
+    SELECT node_id, boot_requested, booted_at, end_time, finalized
+    FROM violations
+    WHERE network = ?
+"""
+
+
+def node_row(node, network: str) -> tuple:
+    """The values of a node for the columns of the nodes table"""
+    return (
+        node.nodeId,
+        network,
+        node.status,
+        node.updatedAt,
+        node.power["state"],
+        node.power["target"],
+        getattr(node, "farmerbot", False),
+    )
+
+
+def lease_pattern(leader_id: str, term: int) -> str:
+    """A LIKE pattern matching the leader key while the replica holds the lease for the given term, whatever its expiry"""
+    escaped_id = leader_id.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return "{}:%:{}".format(escaped_id, term)
+
+
+def node_states_from_rows(rows) -> Dict[int, Dict[str, Any]]:
+    return {
+        row[0]: {
+            "nodeId": row[0],
+            "status": row[2],
+            "updatedAt": row[3],
+            "power": {"state": row[4], "target": row[5]},
+            "farmerbot": bool(row[6]),
+        }
+        for row in rows
+    }
+
+
+def violations_from_rows(rows) -> Dict[float, Violation]:
+    return {
+        row[0]: Violation(
+            boot_requested=row[0],
+            booted_at=row[1],
+            end_time=row[2],
+            finalized=bool(row[3]),
+        )
+        for row in rows
+    }
+
+
+def network_violations_from_rows(rows) -> Dict[int, Dict[float, Violation]]:
+    violations = {}
+    for row in rows:
+        violations.setdefault(row[0], {})[row[1]] = Violation(
+            boot_requested=row[1],
+            booted_at=row[2],
+            end_time=row[3],
+            finalized=bool(row[4]),
+        )
+    return violations
+
+
+def node_state(node) -> Dict[str, Any]:
+    """Convert a Node fetched from GraphQL into the same dict format as get_node_states"""
+    return {
+        "nodeId": node.nodeId,
+        "status": node.status,
+        "updatedAt": node.updatedAt,
+        "power": {"state": node.power["state"], "target": node.power["target"]},
+        "farmerbot": bool(getattr(node, "farmerbot", False)),
+    }
+
+
+def is_transition(state: Dict[str, Any], node) -> bool:
+    """Check whether the fetched node differs from the stored state in a way worth writing: a new status, power state or target, or farmerbot flag. A new updatedAt alone doesn't count"""
+    return (
+        state["status"] != node.status
+        or state["power"]["state"] != node.power["state"]
+        or state["power"]["target"] != node.power["target"]
+        or state["farmerbot"] != bool(getattr(node, "farmerbot", False))
+    )
+
+
+class NodeStateCache:
+    """
+    A replica's in-memory copy of the nodes table. Each node's state is only written by the replica that owns it in the hash ring (see sharding.py), so sending every write through here keeps the owned nodes coherent with rqlite. The cache is loaded again whenever the owners change, to pick up what the previous owners wrote.
+
+    Only transitions are written to rqlite, which is a Raft write each time in a cluster. Fields that change on every poll without meaning anything, like updatedAt, are only kept in memory, so the stored value can be older than the cached one.
+    """
+
+    def __init__(self, db: RqliteDB, networks: List[str]):
+        self.db = db
+        self.networks = networks
+        self.nodes = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Replace the cache with the node states currently stored in rqlite"""
+        nodes = {network: self.db.get_node_states(network) for network in self.networks}
+        with self.lock:
+            self.nodes = nodes
+
+    def fill(self, network: str, node_ids: List[int]):
+        """Load the stored state of any of the nodes we don't have yet, as stored by the leader for a new subscription or by the node's previous owner, so we alert on any change since"""
+        with self.lock:
+            cached = self.nodes.get(network, {})
+            missing = [node_id for node_id in node_ids if node_id not in cached]
+        if not missing:
+            return
+        stored = self.db.get_node_states_by_id(network, missing)
+        with self.lock:
+            cached = self.nodes.setdefault(network, {})
+            for node_id, state in stored.items():
+                cached.setdefault(node_id, state)
+
+    def get_states(self, network: str) -> Dict[int, Dict[str, Any]]:
+        """Get the cached states of all nodes on a network, keyed by node id"""
+        with self.lock:
+            return dict(self.nodes.get(network, {}))
+
+    def create_node(self, node, network: str):
+        """Store a node if we don't have it yet"""
+        with self.lock:
+            exists = node.nodeId in self.nodes.get(network, {})
+        if not exists:
+            self.db.create_node(node, network)
+            with self.lock:
+                self.nodes.setdefault(network, {})[node.nodeId] = node_state(node)
+
+    def create_nodes(self, nodes, network: str):
+        """Store the nodes we don't have yet in one request"""
+        with self.lock:
+            stored = self.nodes.get(network, {})
+            new = [node for node in nodes if node.nodeId not in stored]
+        if new:
+            self.db.create_nodes(new, network)
+            with self.lock:
+                cached = self.nodes.setdefault(network, {})
+                for node in new:
+                    cached.setdefault(node.nodeId, node_state(node))
+
+    def update_nodes(self, nodes, network: str):
+        """Update the cache with the fetched nodes, writing only new nodes and those with a transition to rqlite. Returns the nodes that were written"""
+        with self.lock:
+            stored = self.nodes.get(network, {})
+            changed = [
+                node
+                for node in nodes
+                if node.nodeId not in stored or is_transition(stored[node.nodeId], node)
+            ]
+
+        # If the write fails, the cache is left as it was so the same changes are written on the next try
+        self.db.update_nodes(changed, network)
+        with self.lock:
+            cached = self.nodes.setdefault(network, {})
+            for node in nodes:
+                cached[node.nodeId] = node_state(node)
+        return changed
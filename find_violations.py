@@ -2,25 +2,28 @@
 This code is essentially a selective port of the v3 minting code, only including the parts needed to find farmerbot related violations. It reads from a sqlite database as generated by the ingester code, parses the events, and returns a list of any violations for that node.
 """
 
-import sys, sqlite3, collections, logging
+import sys, sqlite3, collections, itertools, logging, operator
 from dataclasses import dataclass
 from grid3.minting.period import Period
 
 POST_PERIOD = 60 * 60 * 27
 PERIOD_CATCH = 30
 MAX_BOOT_TIME = 60 * 30
+# How many nodes the batch engines look up in one query
+NODE_CHUNK = 500
 
-# It turns out that namedtuples might not be the most performant option for how we are using them, but I didn't find a substantial improvement when switching to slotted data classes and these definitions are much more compact :)
+# Events are replayed as the plain rows sqlite returns, (timestamp, event_index, kind, value), since building an object for each of millions of events took longer than the queries. Sorting the rows puts them in chain order. This namedtuple only names the fields, for verbose mode
+Event = collections.namedtuple("Event", "timestamp, event_index, kind, value")
+UPTIME = "uptime"
+TARGET = "target"
+STATE = "state"
 
-NodeUptimeReported = collections.namedtuple(
-    "NodeUptimeReported", "uptime, timestamp, event_index"
-)
-PowerTargetChanged = collections.namedtuple(
-    "PowerTargetChanged", "target, timestamp, event_index"
-)
-PowerStateChanged = collections.namedtuple(
-    "PowerStateChanged", "state, timestamp, event_index"
-)
+# The table holding each kind of event. The kind is also the name of the column holding its value
+EVENT_TABLES = {
+    UPTIME: "NodeUptimeReported",
+    TARGET: "PowerTargetChanged",
+    STATE: "PowerStateChanged",
+}
 
 
 # Since Telegram bot's pickle persistence doesn't play nice with namedtuples, we use a slotted data class here instead. Technically this class represents both actual violations and possible violations. In the second case, finalized is set to false. Including the end time of the period we have checked allows for comparing the boot_requested time with the amount of time that has elapsed (in terms of the timestamps of tfchain blocks we've actually processed) to decide how likely it is that a violation has actually occurred
@@ -33,39 +36,70 @@ class Violation:
     end_time: int
 
 
-def check_node(con, node, period, verbose=False):
-    # Checkpoints indicate the last block number and associated timestamp for which all block data has been ingested and processed. We don't want to assume a node has a violation if block processing is behind current time
-    checkpoint_time = con.execute(
-        "SELECT value FROM kv WHERE key='checkpoint_time'"
-    ).fetchone()[0]
+# The part of a node's power state that matters for finding violations, as tracked while replaying its events. This is what gets stored in power state snapshots, so scans can resume from one instead of the start of the period
+ScanState = collections.namedtuple(
+    "ScanState", "state, target, power_managed, power_manage_boot"
+)
+DEFAULT_STATE = ScanState("Up", "Up", None, None)
 
-    # Nodes have 30 minutes to wake up, so we need to check enough uptime events to see if they manage to wake up after the period has ended. Since the boot time and the time of submitting uptime are different events, and the uptime report can come much later, the post period duration is the effective limit on how long a node can spend "booting up" at the end of the period before getting a violation. We (now) use the same value as minting (27 hours) so that we reach the same conclusion as minting about whether to assign a violation or not
-    if checkpoint_time > period.end + POST_PERIOD:
-        end_time = period.end + POST_PERIOD
-        period_finished = True
-    else:
-        end_time = checkpoint_time
-        period_finished = False
+# Result of scanning one node in one period with the batch engine
+ScanResult = collections.namedtuple("ScanResult", "violations, uptime")
 
-    uptimes = con.execute(
-        "SELECT uptime, timestamp, event_index FROM NodeUptimeReported WHERE node_id=? AND timestamp>=?  AND timestamp<=?",
-        (node, period.start, end_time),
-    ).fetchall()
-    targets = con.execute(
-        "SELECT target, timestamp, event_index FROM PowerTargetChanged WHERE node_id=? AND timestamp>=?  AND timestamp<=?",
-        (node, period.start, end_time),
-    ).fetchall()
-    states = con.execute(
-        "SELECT state, timestamp, event_index FROM PowerStateChanged WHERE node_id=? AND timestamp>=? AND timestamp<=?",
-        (node, period.start, end_time),
-    ).fetchall()
+# A minting period as recorded in the ingester's period catalog, including the blocks at its boundaries. It has the same offset, start, and end attributes as grid3's Period, so either one can be passed to the functions below
+CatalogPeriod = collections.namedtuple(
+    "CatalogPeriod",
+    "offset, start, end, start_block, start_block_time, end_block, snapshot_status",
+)
 
-    # Since we only fetch initial power configs for the beginning of each period, there's no risk of fetching the wrong one unless we're off by a month. On the other hand, getting the exact timestamp of the block or the block number is relatively expensive, so we use a bit of a hack here. Maybe a better approach is caching the period start/end info inside the db
-    initial_power = con.execute(
-        "SELECT state, down_time, target, timestamp FROM PowerState WHERE node_id=? AND timestamp>=?  AND timestamp<=?",
-        [node, (period.start - PERIOD_CATCH), (period.start + PERIOD_CATCH)],
-    ).fetchone()
 
+def get_period(con, offset):
+    """Look up a minting period in the ingester's period catalog. Returns None if the period hasn't been recorded, or the database doesn't have a catalog"""
+    try:
+        row = con.execute(
+            "SELECT period_offset, start_time, end_time, start_block, start_block_time, end_block, snapshot_status FROM Periods WHERE period_offset=?",
+            (offset,),
+        ).fetchone()
+    except sqlite3.OperationalError as e:
+        if missing_table(e):
+            return None
+        raise
+    return CatalogPeriod(*row) if row else None
+
+
+def missing_table(error):
+    """Whether a query failed because the database was written by an older ingester that doesn't create the table. The bot opens the database read only, so it can't create them itself, and falls back to working without them"""
+    return str(error).startswith("no such table")
+
+
+def get_periods(con, timestamp=None):
+    """Return the period containing the timestamp (default now) and the one before it. Periods come from the catalog when recorded there, otherwise they are plain Period objects"""
+    current = Period(timestamp)
+    return tuple(
+        get_period(con, offset) or Period(offset=offset)
+        for offset in (current.offset, current.offset - 1)
+    )
+
+
+def initial_power_query(con, period):
+    """Return the condition and parameters that select PowerState rows for the start of the period"""
+    start_block = getattr(period, "start_block", None)
+    if start_block is None:
+        catalog_period = get_period(con, period.offset)
+        if catalog_period:
+            start_block = catalog_period.start_block
+
+    if start_block is not None:
+        return "block=?", [start_block]
+    else:
+        # Periods fetched before the catalog existed don't have a known start block. Initial power configs are only fetched at period starts, so a small window around the start can't match the wrong one
+        return "timestamp>=? AND timestamp<=?", [
+            period.start - PERIOD_CATCH,
+            period.start + PERIOD_CATCH,
+        ]
+
+
+def power_to_state(initial_power):
+    """Convert a PowerState row (state, down_time, target, timestamp) into the ScanState at the start of the period"""
     # If there's no entry in the db, it would mean either the node was not created yet at this point in time (thus the default value), or the fetching of this data is not completed. The latter case is potentially problematic, but as long as we get the data eventually, we will catch any associated violations eventually too
     if initial_power is None:
         initial_power = "Up", None, "Up", None
@@ -82,45 +116,115 @@ def check_node(con, node, period, verbose=False):
         power_managed = None
         power_manage_boot = None
 
+    return ScanState(state, target, power_managed, power_manage_boot)
+
+
+def initial_state(con, node, period):
+    """Return the ScanState of the node at the start of the period, based on the PowerState fetched by the ingester"""
+    condition, params = initial_power_query(con, period)
+    initial_power = con.execute(
+        "SELECT state, down_time, target, timestamp FROM PowerState WHERE node_id=? AND "
+        + condition,
+        [node] + params,
+    ).fetchone()
+    return power_to_state(initial_power)
+
+
+def snapshot_state(con, node, period, timestamp):
+    """Find the latest power state snapshot for the period taken at or before the timestamp. Returns the snapshot time and the node's ScanState at that time, or None if there's no snapshot yet"""
+    snapshot = snapshot_time(con, period, timestamp)
+    if snapshot is None:
+        return None
+
+    # Only nodes that aren't in the default state get a row
+    row = con.execute(
+        "SELECT state, target, power_managed, power_manage_boot FROM PowerSnapshot WHERE node_id=? AND period_offset=? AND timestamp=?",
+        (node, period.offset, snapshot),
+    ).fetchone()
+    if row is None:
+        return snapshot, DEFAULT_STATE
+    return snapshot, ScanState(*row)
+
+
+def snapshot_time(con, period, timestamp):
+    """The time of the latest power state snapshot for the period taken at or before the timestamp, or None if there's none yet"""
+    try:
+        row = con.execute(
+            "SELECT timestamp FROM SnapshotTimes WHERE period_offset=? AND timestamp<=? ORDER BY timestamp DESC LIMIT 1",
+            (period.offset, timestamp),
+        ).fetchone()
+    except sqlite3.OperationalError as e:
+        if missing_table(e):
+            return None
+        raise
+    return row[0] if row else None
+
+
+def fetch_events(con, node, start, end, kinds=(UPTIME, TARGET, STATE)):
+    """Get the events of the given kinds for the node with timestamps between start and end (inclusive), in the order they happened on chain"""
     events = []
-    events.extend([NodeUptimeReported(*u) for u in uptimes])
-    events.extend([PowerStateChanged(*s) for s in states])
-    events.extend([PowerTargetChanged(*t) for t in targets])
+    for kind in kinds:
+        events += con.execute(
+            f"SELECT timestamp, event_index, '{kind}', {kind} FROM {EVENT_TABLES[kind]} WHERE node_id=? AND timestamp>=? AND timestamp<=?",
+            (node, start, end),
+        ).fetchall()
+    events.sort()
+    return events
+
+
+def fetch_power_events(con, nodes, start, end):
+    """Get the power target and state events of many nodes at once, with one pass over each table in (node_id, timestamp) order. Returns a dict of {node_id: [event, ...]}, each list in the order the events happened on chain, leaving out nodes without any"""
+    events = collections.defaultdict(list)
+    node_params = ", ".join("?" * len(nodes))
+    for kind in (TARGET, STATE):
+        rows = con.execute(
+            f"SELECT node_id, timestamp, event_index, '{kind}', {kind} FROM {EVENT_TABLES[kind]} WHERE node_id IN ({node_params}) AND timestamp>=? AND timestamp<=? ORDER BY node_id, timestamp",
+            list(nodes) + [start, end],
+        )
+        for node, node_rows in itertools.groupby(rows, operator.itemgetter(0)):
+            events[node].extend(row[1:] for row in node_rows)
+    for node_events in events.values():
+        node_events.sort()
+    return events
 
-    events = sorted(events, key=lambda e: (e.timestamp, e.event_index))
+
+def scan_events(events, scan_state, period, start, verbose=False):
+    """Replay the events for a node (rows as described for Event), beginning from the given ScanState at the start time. Returns any violations found (where the node booted late), the ScanState after the last event, and the total uptime accrued over the events"""
+    state, target, power_managed, power_manage_boot = scan_state
 
     violations = []
-    timestamp = period.start
+    timestamp = start
     uptime = None
     total_uptime = 0
     for event in events:
+        event_time, _, kind, value = event
         if verbose:
-            print(event)
-        if isinstance(event, NodeUptimeReported):
+            print(Event(*event))
+        if kind == UPTIME:
             if power_managed is not None and power_manage_boot is not None:
-                boot_time = event.timestamp - event.uptime
+                boot_time = event_time - value
                 if boot_time > power_managed:
+                    standby_hours = (boot_time - power_managed) / 60 / 60
                     if verbose:
-                        standby_hours = (boot_time - power_managed) / 60 / 60
                         print(
                             "Node booted at",
                             boot_time,
                             "Hours in standby: ",
                             standby_hours,
                         )
-                        if (
-                            standby_hours < 24
-                            and boot_time < power_manage_boot + MAX_BOOT_TIME
-                        ):
-                            total_uptime += min(
-                                boot_time - power_managed, boot_time - period.start
-                            )
+                    if (
+                        standby_hours < 24
+                        and boot_time < power_manage_boot + MAX_BOOT_TIME
+                    ):
+                        total_uptime += min(
+                            boot_time - power_managed, boot_time - period.start
+                        )
 
                     if boot_time > power_manage_boot + MAX_BOOT_TIME:
                         if verbose:
                             print(
                                 "About to return a violation for this uptime event:",
-                                event,
+                                Event(*event),
                             )
                         violations.append(
                             Violation(power_manage_boot, boot_time, True, None)
@@ -129,77 +233,257 @@ def check_node(con, node, period, verbose=False):
                     power_managed = None
                     power_manage_boot = None
 
-            if verbose:
-                elapsed = event.timestamp - timestamp
-                if uptime is None:
-                    # First uptime report of the period, scale to actual time in period so far
-                    if event.uptime > elapsed:
-                        uptime = elapsed
-                    else:
-                        uptime = event.uptime
+            elapsed = event_time - timestamp
+            if uptime is None:
+                # First uptime report of the period, only credit the part that
+                # falls within the period so far. The raw uptime is kept for
+                # comparing with the next report, otherwise a node that was up
+                # before the period began gets its whole uptime credited again
+                total_uptime += min(value, elapsed)
+                uptime = value
 
-                    total_uptime += uptime
-
-                elif event.uptime < uptime:
+            elif value < uptime:
+                if verbose:
                     print(
                         "Reboot detected. Elapsed time: ",
                         elapsed,
                         "Uptime accrued: ",
-                        event.uptime,
+                        value,
                     )
-                    uptime = event.uptime
-                    total_uptime += uptime
+                uptime = value
+                total_uptime += uptime
 
-                else:
+            else:
+                if verbose:
                     print(
                         "Elapsed time: ",
                         elapsed,
                         "Uptime accrued: ",
-                        event.uptime - uptime,
+                        value - uptime,
                     )
-                    total_uptime += event.uptime - uptime
-                    uptime = event.uptime
+                total_uptime += value - uptime
+                uptime = value
 
-                timestamp = event.timestamp
+            timestamp = event_time
 
-        elif isinstance(event, PowerTargetChanged):
+        elif kind == TARGET:
             # We don't want to check boots requested during the post period. Those will get checked during the next cycle
             if (
-                event.target == "Up"
+                value == "Up"
                 and state == "Down"
                 and power_manage_boot is None
-                and event.timestamp < period.end
+                and event_time < period.end
             ):
-                power_manage_boot = event.timestamp
-            target = event.target
+                power_manage_boot = event_time
+            target = value
 
-        elif isinstance(event, PowerStateChanged):
-            if state == "Up" and target == "Down" and event.state == "Down":
+        elif kind == STATE:
+            if state == "Up" and target == "Down" and value == "Down":
                 if power_managed is None:
-                    power_managed = event.timestamp
-            state = event.state
+                    power_managed = event_time
+            state = value
 
         if verbose:
             print(
                 "power_managed:", power_managed, "power_manage_boot:", power_manage_boot
             )
 
+    return (
+        violations,
+        ScanState(state, target, power_managed, power_manage_boot),
+        total_uptime,
+    )
+
+
+def scan_end(con, period):
+    """Return the time up to which events should be scanned for the period and whether the period is finished"""
+    # Checkpoints indicate the last block number and associated timestamp for which all block data has been ingested and processed. We don't want to assume a node has a violation if block processing is behind current time
+    checkpoint_time = con.execute(
+        "SELECT value FROM kv WHERE key='checkpoint_time'"
+    ).fetchone()[0]
+
+    # Nodes have 30 minutes to wake up, so we need to check enough uptime events to see if they manage to wake up after the period has ended. Since the boot time and the time of submitting uptime are different events, and the uptime report can come much later, the post period duration is the effective limit on how long a node can spend "booting up" at the end of the period before getting a violation. We (now) use the same value as minting (27 hours) so that we reach the same conclusion as minting about whether to assign a violation or not
+    if checkpoint_time > period.end + POST_PERIOD:
+        return period.end + POST_PERIOD, True
+    else:
+        return checkpoint_time, False
+
+
+def finish_scan(scan_state, period, end_time, period_finished, verbose=False):
+    """Handle a boot request still open at the end of the scan. Returns the resulting violation, if any, and the uptime to credit if the node ended the period in standby"""
+    power_managed, power_manage_boot = (
+        scan_state.power_managed,
+        scan_state.power_manage_boot,
+    )
+
     # There are two scenarios here. First is that we are scanning a completed minting period that ended longer ago than the POST_PERIOD duration. In that case these will be "never booted" violations. The other is that we are scanning an ongoing minting period (or one that ended very recently) and the MAX_BOOT_TIME has elapsed. In the second case we don't actually know if a violation will happen for the node, because boot time is timestamp - uptime. So if the node's uptime counter is already running and it successfully submits an uptime report later, then no violation happens. We mark these as unfinalized
+    violation = None
     if power_manage_boot and end_time > power_manage_boot + MAX_BOOT_TIME:
         finalized = period_finished
-        violations.append(Violation(power_manage_boot, None, finalized, end_time))
+        violation = Violation(power_manage_boot, None, finalized, end_time)
 
-    if verbose:
-        if power_managed and period.end - power_managed < 24 * 60 * 60:
+    standby_uptime = 0
+    if power_managed and period.end - power_managed < 24 * 60 * 60:
+        standby_uptime = period.end - power_managed
+        if verbose:
             print(
                 "Node is standby at end of period, crediting additional uptime: ",
-                period.end - power_managed,
+                standby_uptime,
             )
-            total_uptime += period.end - power_managed
-        print("Total uptime accumulated: ", total_uptime)
+    return violation, standby_uptime
+
+
+def check_node(con, node, period, verbose=False, since=None):
+    """Find the violations for a node in the given period.
+
+    By default the whole period is replayed. When since is given, the scan starts from the latest power state snapshot at or before that time instead, so only violations detected after the snapshot are returned (including any still open boot request carried in the snapshot). Uptime totals printed in verbose mode then only cover the scanned part of the period.
+    """
+    end_time, period_finished = scan_end(con, period)
+
+    snapshot = None
+    if since is not None:
+        snapshot = snapshot_state(con, node, period, since)
+
+    if snapshot is None:
+        start = period.start
+        scan_state = initial_state(con, node, period)
+    else:
+        start, scan_state = snapshot
+
+    events = fetch_events(con, node, start, end_time)
+    violations, scan_state, total_uptime = scan_events(
+        events, scan_state, period, start, verbose
+    )
+    violation, standby_uptime = finish_scan(
+        scan_state, period, end_time, period_finished, verbose
+    )
+    if violation:
+        violations.append(violation)
+
+    if verbose:
+        print("Total uptime accumulated: ", total_uptime + standby_uptime)
     return violations
 
 
+def initial_states(con, nodes, period):
+    """Like initial_state, for many nodes at once. Returns a dict of {node_id: ScanState} for every node given"""
+    condition, params = initial_power_query(con, period)
+    node_params = ", ".join("?" * len(nodes))
+    powers = con.execute(
+        f"SELECT node_id, state, down_time, target, timestamp FROM PowerState WHERE node_id IN ({node_params}) AND "
+        + condition,
+        list(nodes) + params,
+    ).fetchall()
+    powers = {p[0]: p[1:] for p in powers}
+    return {node: power_to_state(powers.get(node)) for node in nodes}
+
+
+def start_states(con, nodes, period, since=None):
+    """Where a batch scan of the nodes starts: the latest power state snapshot at or before since, as for check_node, or the start of the period if since isn't given or there's no snapshot yet. Returns the start time and a dict of {node_id: ScanState} for every node given"""
+    snapshot = None
+    if since is not None:
+        snapshot = snapshot_time(con, period, since)
+    if snapshot is None:
+        return period.start, initial_states(con, nodes, period)
+
+    node_params = ", ".join("?" * len(nodes))
+    rows = con.execute(
+        f"SELECT node_id, state, target, power_managed, power_manage_boot FROM PowerSnapshot WHERE period_offset=? AND timestamp=? AND node_id IN ({node_params})",
+        [period.offset, snapshot] + list(nodes),
+    ).fetchall()
+    states = {row[0]: ScanState(*row[1:]) for row in rows}
+    return snapshot, {node: states.get(node, DEFAULT_STATE) for node in nodes}
+
+
+def chunks(nodes):
+    """Split the nodes into sorted chunks of at most NODE_CHUNK, without duplicates"""
+    nodes = sorted(set(nodes))
+    for i in range(0, len(nodes), NODE_CHUNK):
+        yield nodes[i : i + NODE_CHUNK]
+
+
+def scan_nodes(con, nodes, period, since=None):
+    """Batch version of check_node, which also returns the uptime estimate. Returns {node_id: ScanResult} for every node given. Events are still read node by node, since sqlite is no faster reading them for a chunk. As for check_node, since starts the scans from a snapshot"""
+    end_time, period_finished = scan_end(con, period)
+
+    results = {}
+    for chunk in chunks(nodes):
+        start, states = start_states(con, chunk, period, since)
+        for node, scan_state in states.items():
+            events = fetch_events(con, node, start, end_time)
+            violations, scan_state, total_uptime = scan_events(
+                events, scan_state, period, start
+            )
+            violation, standby_uptime = finish_scan(
+                scan_state, period, end_time, period_finished
+            )
+            if violation:
+                violations.append(violation)
+            results[node] = ScanResult(violations, total_uptime + standby_uptime)
+
+    return results
+
+
+def check_nodes(con, nodes, period, since=None):
+    """Like scan_nodes, but only finds violations, as {node_id: [Violation, ...]}, which lets it skip most of the events.
+
+    Uptime reports only matter for violations while a boot request is open, and a boot request is only ever opened by a power target change to Up, or carried in from the previous period (or the snapshot the scan starts from, see since in scan_nodes). So the power events of each chunk of nodes are read first, with one ordered pass over each table, and uptime reports are only read for nodes that had a boot request, from the time of the first one. For nodes that never had one, which is most of them, the power events alone give the same result as replaying everything.
+    """
+    end_time, period_finished = scan_end(con, period)
+
+    results = {}
+    for chunk in chunks(nodes):
+        start, states = start_states(con, chunk, period, since)
+        power_events = fetch_power_events(con, chunk, start, end_time)
+        for node, scan_state in states.items():
+            events = power_events.get(node, [])
+            if scan_state.power_manage_boot is not None:
+                first_boot = start
+            else:
+                first_boot = next(
+                    (e[0] for e in events if e[2] == TARGET and e[3] == "Up"), None
+                )
+            if first_boot is not None:
+                events += fetch_events(con, node, first_boot, end_time, (UPTIME,))
+                events.sort()
+
+            violations, scan_state, _ = scan_events(events, scan_state, period, start)
+            violation, _ = finish_scan(scan_state, period, end_time, period_finished)
+            if violation:
+                violations.append(violation)
+            results[node] = violations
+
+    return results
+
+
+def farm_nodes(con, farm_id, period):
+    """Find the nodes of a farm that can have violations in the period: those with power events in it, found through the (farm_id, timestamp) indexes, and those that started it asleep with a boot requested, matched by the event that put them to sleep"""
+    end_time, _ = scan_end(con, period)
+    nodes = set()
+    for table in ("PowerTargetChanged", "PowerStateChanged"):
+        rows = con.execute(
+            f"SELECT DISTINCT node_id FROM {table} WHERE farm_id=? AND timestamp>=? AND timestamp<=?",
+            (farm_id, period.start, end_time),
+        )
+        nodes.update(row[0] for row in rows)
+
+    condition, params = initial_power_query(con, period)
+    rows = con.execute(
+        "SELECT node_id FROM PowerState WHERE state='Down' AND target='Up' AND "
+        + condition
+        + " AND EXISTS (SELECT 1 FROM PowerStateChanged c WHERE c.node_id=PowerState.node_id AND c.block=PowerState.down_block AND c.farm_id=?)",
+        params + [farm_id],
+    )
+    nodes.update(row[0] for row in rows)
+    return sorted(nodes)
+
+
+def check_farm(con, farm_id, period):
+    """Find the violations of every node in the farm, as {node_id: [Violation, ...]}, leaving out nodes without any"""
+    violations = check_nodes(con, farm_nodes(con, farm_id, period), period)
+    return {node: v for node, v in violations.items() if v}
+
+
 if __name__ == "__main__":
     DB = sys.argv[1]
     NODE = int(sys.argv[2])
@@ -211,5 +495,5 @@ if __name__ == "__main__":
         VERBOSE = False
 
     con = sqlite3.connect(DB)
-    period = Period(TIME)
-    print(check_node(con, NODE, Period(TIME), VERBOSE))
+    period = get_period(con, Period(TIME).offset) or Period(TIME)
+    print(check_node(con, NODE, period, VERBOSE))
@@ -19,10 +19,16 @@ import prometheus_client
 from grid3 import tfchain
 from grid3.minting.period import Period
 
+import find_violations
+
 MIN_WORKERS = 2
 SLEEP_TIME = 30
 DB_TIMEOUT = 30
 POST_PERIOD = 60 * 60
+# How often to write power state snapshots, counted from the start of each period
+SNAPSHOT_INTERVAL = 60 * 60 * 24
+# How long to keep change log entries. The bot only needs the entries written since it last checked, so this just has to cover it being down for a while
+CHANGE_LOG_RETENTION = 60 * 60 * 24
 
 # When querying a fixed period of blocks, how many times to retry missed blocks
 RETRIES = 3
@@ -102,6 +108,12 @@ def fetch_powers(block_number, db_file=None):
             nodes -= {p[0] for p in existing_powers}
 
             if not nodes:
+                # If this block starts a period in the catalog, its snapshot is now ready to be used
+                with con:
+                    con.execute(
+                        "UPDATE Periods SET snapshot_status='complete' WHERE start_block=?",
+                        (block_number,),
+                    )
                 break
 
             print("Fetching node powers for", len(nodes), "nodes")
@@ -136,6 +148,53 @@ def fetch_powers(block_number, db_file=None):
             print("Got exception while fetching powers:", e)
 
 
+def record_period(con, client, period):
+    """Add a period to the period catalog, along with its start block. This also records the end block of the previous period, if it's in the catalog. Returns the start block"""
+    start_block = client.find_block_minting(period.start)
+    start_block_time = client.get_time_at_block(start_block) // 1000
+    with con:
+        con.execute(
+            "INSERT INTO Periods VALUES(?, ?, ?, ?, ?, NULL, 'pending') ON CONFLICT(period_offset) DO UPDATE SET start_block=excluded.start_block, start_block_time=excluded.start_block_time",
+            (period.offset, period.start, period.end, start_block, start_block_time),
+        )
+        con.execute(
+            "UPDATE Periods SET end_block=? WHERE period_offset=?",
+            (start_block - 1, period.offset - 1),
+        )
+    return start_block
+
+
+def backfill_periods(con):
+    """Add catalog entries for periods whose initial power states were fetched before the catalog existed. Runs once per database"""
+    done = con.execute("SELECT value FROM kv WHERE key='periods_backfilled'").fetchone()
+    if done:
+        return
+    blocks = con.execute("SELECT DISTINCT block, timestamp FROM PowerState").fetchall()
+    for block, timestamp in blocks:
+        period = Period(timestamp)
+        if timestamp - period.start <= find_violations.PERIOD_CATCH:
+            con.execute(
+                "INSERT OR IGNORE INTO Periods VALUES(?, ?, ?, ?, ?, NULL, 'pending')",
+                (period.offset, period.start, period.end, block, timestamp),
+            )
+    con.execute(
+        "UPDATE Periods SET end_block=(SELECT p.start_block - 1 FROM Periods p WHERE p.period_offset=Periods.period_offset + 1) WHERE end_block IS NULL"
+    )
+    con.execute("INSERT INTO kv VALUES('periods_backfilled', 1)")
+
+
+def fetch_pending_powers(skip_block=None):
+    """Finish fetching the initial power states of the current and previous periods if they're still pending, so their snapshots can be written"""
+    con = new_connection()
+    blocks = con.execute(
+        "SELECT start_block FROM Periods WHERE snapshot_status='pending' AND period_offset>=? AND start_block IS NOT ?",
+        (Period().offset - 1, skip_block),
+    ).fetchall()
+    con.close()
+    for (block,) in blocks:
+        fetch_powers(block)
+
+
 def get_block(client, block_number):
     # Sometimes we get None here (but only on remote VM?)
     # Maybe better to handle gracefully rather than let proc die
@@ -162,12 +221,14 @@ def process_block(block, events):
     timestamp = block["extrinsics"][0].value["call"]["call_args"][0]["value"] // 1000
 
     updates = []
+    node_ids = set()
     for i, event in enumerate(events):
         event = event.value
         event_id = event["event_id"]
         attributes = event["attributes"]
         # TODO: pass these more efficiently than writing the INSERT string for each one
         if event_id == "NodeUptimeReported":
+            node_ids.add(attributes[0])
             updates.append(
                 (
                     "INSERT INTO NodeUptimeReported VALUES(?, ?, ?, ?, ?, ?)",
@@ -182,6 +243,7 @@ def process_block(block, events):
                 )
             )
         elif event_id == "PowerTargetChanged":
+            node_ids.add(attributes["node_id"])
             updates.append(
                 (
                     "INSERT INTO PowerTargetChanged VALUES(?, ?, ?, ?, ?, ?)",
@@ -196,6 +258,7 @@ def process_block(block, events):
                 )
             )
         elif event_id == "PowerStateChanged":
+            node_ids.add(attributes["node_id"])
             if attributes["power_state"] == "Up":
                 state = "Up"
                 down_block = None
@@ -217,6 +280,15 @@ def process_block(block, events):
                 )
             )
 
+    # Record which nodes had events in this block, so the bot can recheck just those nodes once the block is covered by the checkpoint. Since this is written in the same transaction as the events, the change log never gets ahead of the data
+    if node_ids:
+        updates.append(
+            (
+                "INSERT INTO ChangeLog VALUES(?, ?, ?)",
+                (block_number, timestamp, ",".join(str(n) for n in sorted(node_ids))),
+            )
+        )
+
     return updates
 
 
@@ -290,6 +362,11 @@ def prep_db(con):
         "CREATE INDEX IF NOT EXISTS PowerTargetChanged_node_id_ts ON PowerTargetChanged(node_id, timestamp)"
     )
 
+    # Farm level reports find a farm's nodes with a range scan of these
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS PowerTargetChanged_farm_id_ts ON PowerTargetChanged(farm_id, timestamp)"
+    )
+
     con.execute(
         "CREATE TABLE IF NOT EXISTS PowerStateChanged(farm_id, node_id, state, down_block, block, event_index, timestamp, UNIQUE(event_index, block))"
     )
@@ -298,16 +375,47 @@ def prep_db(con):
         "CREATE INDEX IF NOT EXISTS PowerStateChanged_node_id_timestamp ON PowerStateChanged(node_id, timestamp)"
     )
 
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS PowerStateChanged_farm_id_ts ON PowerStateChanged(farm_id, timestamp)"
+    )
+
     con.execute(
         "CREATE TABLE IF NOT EXISTS PowerState(node_id, state, down_block, down_time, target, block, timestamp, UNIQUE(node_id, block))"
     )
 
+    # Power state snapshots hold each node's scan state at regular times in a period, so scans can start from the nearest one. Nodes in the default state get no row, and SnapshotTimes records which snapshots are complete
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS PowerSnapshot(node_id, period_offset, timestamp, state, target, power_managed, power_manage_boot, UNIQUE(node_id, period_offset, timestamp))"
+    )
+
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS SnapshotTimes(period_offset, timestamp, UNIQUE(period_offset, timestamp))"
+    )
+
+    con.execute("CREATE INDEX IF NOT EXISTS PowerState_block ON PowerState(block)")
+
+    # The period catalog records the boundaries of each minting period we have ingested, as the first block of the period and the last block before the next one. The snapshot status tells whether the PowerState for the first block has been completely fetched
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS Periods(period_offset INTEGER PRIMARY KEY, start_time, end_time, start_block, start_block_time, end_block, snapshot_status)"
+    )
+
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS Periods_start_block ON Periods(start_block)"
+    )
+
+    # The change log holds the ids of the nodes that had any events in each block, as a comma separated list. It's how the bot learns which nodes to check for new violations, without querying every subscribed node on each poll
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS ChangeLog(block INTEGER PRIMARY KEY, timestamp, node_ids)"
+    )
+
     con.execute("CREATE TABLE IF NOT EXISTS processed_blocks(block_number PRIMARY KEY)")
 
     con.execute("CREATE TABLE IF NOT EXISTS kv(key UNIQUE, value)")
     con.execute("INSERT OR IGNORE INTO kv VALUES('checkpoint_block', 0)")
     con.execute("INSERT OR IGNORE INTO kv VALUES('checkpoint_time', 0)")
 
+    backfill_periods(con)
+
     con.commit()
 
 
@@ -336,6 +444,96 @@ def scale_workers(processes, block_queue, write_queue):
             processes.append(spawn_worker(block_queue, write_queue))
 
 
+def snapshot_nodes(con, period, timestamp, end):
+    """Get the node ids that might not be in the default state at the end time, given the snapshot at timestamp (or the period start). Only power events can move a node out of the default state"""
+    if timestamp == period.start:
+        nodes = con.execute(
+            "SELECT node_id FROM PowerState WHERE block=? AND (state!='Up' OR target!='Up')",
+            (period.start_block,),
+        ).fetchall()
+    else:
+        nodes = con.execute(
+            "SELECT node_id FROM PowerSnapshot WHERE period_offset=? AND timestamp=?",
+            (period.offset, timestamp),
+        ).fetchall()
+
+    for table in ("PowerTargetChanged", "PowerStateChanged"):
+        nodes += con.execute(
+            f"SELECT DISTINCT node_id FROM {table} WHERE timestamp>=? AND timestamp<=?",
+            (timestamp, end),
+        ).fetchall()
+
+    return {n[0] for n in nodes}
+
+
+def write_snapshots(con, checkpoint_time):
+    """Write any power state snapshots that are due for the current and previous periods. Snapshots are derived from the events already in the database, so this should only be called with a checkpoint time up to which all blocks have been processed"""
+    for period in find_violations.get_periods(con, checkpoint_time):
+        # Snapshots replay from the initial power states, so we need those to be completely fetched first. If the period isn't in the catalog at all, it wasn't ingested from its start
+        if getattr(period, "snapshot_status", None) != "complete":
+            continue
+
+        # Scans run through the post period, so snapshots do too
+        last_time = min(checkpoint_time, period.end + find_violations.POST_PERIOD)
+        timestamp = con.execute(
+            "SELECT MAX(timestamp) FROM SnapshotTimes WHERE period_offset=?",
+            (period.offset,),
+        ).fetchone()[0]
+        if timestamp is None:
+            timestamp = period.start
+
+        while timestamp + SNAPSHOT_INTERVAL <= last_time:
+            next_time = timestamp + SNAPSHOT_INTERVAL
+            rows = []
+            for node in snapshot_nodes(con, period, timestamp, next_time - 1):
+                if timestamp == period.start:
+                    scan_state = find_violations.initial_state(con, node, period)
+                else:
+                    scan_state = find_violations.snapshot_state(
+                        con, node, period, timestamp
+                    )[1]
+                events = find_violations.fetch_events(
+                    con, node, timestamp, next_time - 1
+                )
+                scan_state = find_violations.scan_events(
+                    events, scan_state, period, timestamp
+                )[1]
+                if scan_state != find_violations.DEFAULT_STATE:
+                    rows.append((node, period.offset, next_time, *scan_state))
+
+            with con:
+                con.executemany(
+                    "INSERT OR REPLACE INTO PowerSnapshot VALUES(?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                con.execute(
+                    "INSERT OR IGNORE INTO SnapshotTimes VALUES(?, ?)",
+                    (period.offset, next_time),
+                )
+            print(
+                "Wrote power state snapshot at",
+                next_time,
+                "for period",
+                period.offset,
+                "with",
+                len(rows),
+                "nodes not in default state",
+            )
+            timestamp = next_time
+
+
+def snapshot_worker(checkpoint_time, db_file=None):
+    """Write the snapshots due up to the checkpoint time on a connection of our own, so this can run in a thread"""
+    con = new_connection(db_file=db_file)
+    try:
+        write_snapshots(con, checkpoint_time)
+    except Exception as e:
+        # Whatever wasn't written is picked up again by the next round
+        print("Got exception while writing snapshots:", e)
+    finally:
+        con.close()
+
+
 def spawn_subscriber(block_queue, client):
     callback = functools.partial(subscription_callback, block_queue)
     sub_thread = Thread(target=client.sub.subscribe_block_headers, args=[callback])
@@ -409,7 +607,7 @@ if __name__ == "__main__":
         start_number = client.find_block_minting(args.start)
     else:
         # By default, use beginning of current minting period
-        start_number = client.find_block_minting(Period().start)
+        start_number = record_period(con, client, Period())
 
     # Without cancel_join_thread, we can end up deadlocked on trying to flush buffers out to the queue when the program is exiting, since the processes consuming the queue will exit first. We don't care about the data loss implications because all of our data can be fetched again
     block_queue = JoinableQueue()
@@ -425,6 +623,10 @@ if __name__ == "__main__":
     powers_thread.daemon = True
     powers_thread.start()
 
+    pending_thread = Thread(target=fetch_pending_powers, args=[start_number])
+    pending_thread.daemon = True
+    pending_thread.start()
+
     if args.end or args.end_block:
         if args.end_block:
             end_number = args.end_block
@@ -504,6 +706,7 @@ if __name__ == "__main__":
         )
 
         current_period = Period()
+        snapshot_thread = None
         processed_count = con.execute(
             "SELECT COUNT(1) FROM processed_blocks"
         ).fetchone()[0]
@@ -592,16 +795,33 @@ if __name__ == "__main__":
                                 "UPDATE kv SET value=? WHERE key='checkpoint_time'",
                                 (timestamp,),
                             )
+                            con.execute(
+                                "DELETE FROM ChangeLog WHERE timestamp<?",
+                                (timestamp - CHANGE_LOG_RETENTION,),
+                            )
                     except WebSocketConnectionClosedException as e:
                         # We already try reconnecting on each pass of the loop, so here just log the error and move on
                         print(e)
 
+                    # Snapshots can take a while to write after a long pause, so they're written in a thread rather than holding up this loop. A new round starts once the last one is done
+                    if snapshot_thread is None or not snapshot_thread.is_alive():
+                        snapshot_thread = Thread(
+                            target=snapshot_worker,
+                            args=[
+                                con.execute(
+                                    "SELECT value FROM kv WHERE key='checkpoint_time'"
+                                ).fetchone()[0]
+                            ],
+                        )
+                        snapshot_thread.daemon = True
+                        snapshot_thread.start()
+
             scale_workers(processes, block_queue, write_queue)
 
             # If we have entered a new minting period, spawn a thread to fetch the power info for each node at the start of the new period
             period = Period()
             if period.offset > current_period.offset:
-                start_number = client.find_block_minting(period.start)
+                start_number = record_period(con, client, period)
                 powers_thread = Thread(target=fetch_powers, args=[start_number])
                 powers_thread.daemon = True
                 powers_thread.start()
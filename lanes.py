@@ -0,0 +1,82 @@
+"""
+Separate pools of worker threads for work of different priority, so one kind of work can't starve another. The bot uses three:
+
+* heartbeat, for the leader lease and replica membership, which must run on time or the bot loses its place
+* interactive, for user commands, which is bounded so that when it's overloaded new commands get a quick "busy" reply instead of a long wait
+* background, for the alert checks and violation scans
+
+Each lane exports its queue length, the time work waits in the queue and how much work it turned away as Prometheus metrics. Lanes can also run jobs for APScheduler (and so PTB's JobQueue), see LaneExecutor.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import prometheus_client
+from apscheduler.executors.pool import BasePoolExecutor
+
+queue_length = prometheus_client.Gauge(
+    "lane_queue_length", "Work waiting for a worker in each lane", ["lane"]
+)
+queue_wait = prometheus_client.Histogram(
+    "lane_wait_seconds",
+    "Time work waited in each lane's queue before a worker started it",
+    ["lane"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+shed = prometheus_client.Counter(
+    "lane_shed", "Work turned away because a lane's queue was full", ["lane"]
+)
+
+
+class Busy(Exception):
+    """The lane's queue is full"""
+
+
+class Lane:
+    def __init__(self, name, workers, max_queue=None):
+        self.name = name
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.queued = 0
+        self.lock = threading.Lock()
+        self.queue_length = queue_length.labels(name)
+        self.queue_wait = queue_wait.labels(name)
+        self.shed = shed.labels(name)
+
+    def admit(self):
+        """Count an item of work into the queue, raising Busy if it's full. Returns the time it was admitted, to pass to start"""
+        with self.lock:
+            if self.max_queue is not None and self.queued >= self.max_queue:
+                self.shed.inc()
+                raise Busy(self.name)
+            self.queued += 1
+            self.queue_length.set(self.queued)
+        return time.monotonic()
+
+    def start(self, admitted):
+        """Count an item of work out of the queue, once a worker has picked it up"""
+        with self.lock:
+            self.queued -= 1
+            self.queue_length.set(self.queued)
+        self.queue_wait.observe(time.monotonic() - admitted)
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn in the lane, returning a Future. Raises Busy if the queue is full"""
+        admitted = self.admit()
+
+        def run():
+            self.start(admitted)
+            return fn(*args, **kwargs)
+
+        return self.executor.submit(run)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait)
+
+
+class LaneExecutor(BasePoolExecutor):
+    """Runs APScheduler jobs in a lane. Add it to the scheduler under an alias, then schedule jobs with that alias as their executor"""
+
+    def __init__(self, lane):
+        super().__init__(lane)
@@ -0,0 +1,61 @@
+"""
+The leader lease, held in the "leader" metadata key in rqlite. Only the replica holding it polls Telegram and runs the violations job, and the others take it over when it runs out.
+
+The key is "node_id:expiry:term". Every change is a compare and swap on the previous value, so when several replicas race for an expired lease only one wins. The term goes up by one on each change of leader and fences the leader's writes (see set_metadata_if_leader in db.py), so a leader that was paused long enough to lose its lease can't overwrite the state of its successor.
+"""
+
+import time
+
+# The leader lease lasts this many heartbeat intervals
+LEASE_FACTOR = 3
+# Leader keys written by older versions only hold the last heartbeat, which was sent every 30 seconds and considered stale after two intervals. Those versions can't read the lease key written now, so replicas must all be stopped before upgrading, see the README
+LEGACY_LEASE_TIME = 60
+
+
+def parse(leader_info):
+    """
+    Split the leader key into (node_id, expiry time, term). Keys written by older versions hold the time of the last heartbeat rather than an expiry, and no term. Returns None if the key can't be read
+    """
+    try:
+        parts = leader_info.split(":")
+        if len(parts) == 2:
+            return parts[0], float(parts[1]) + LEGACY_LEASE_TIME, 0
+        return parts[0], float(parts[1]), int(parts[2])
+    except:
+        return None
+
+
+def acquire(db, node_id, heartbeat_interval, now=None):
+    """
+    Take the lease if it's free or expired, or renew it if we hold it. Returns (term, expiry) if we hold the lease afterwards, otherwise None. Read errors are raised, rather than treated as no leader
+    """
+    if now is None:
+        now = time.time()
+    current = db.get_metadata("leader")
+    lease = parse(current) if current else None
+    if lease is None:
+        term = 1
+    elif lease[0] == node_id:
+        term = lease[2]
+    elif lease[1] > now:
+        return None
+    else:
+        term = lease[2] + 1
+
+    expiry = now + LEASE_FACTOR * heartbeat_interval
+    new_value = f"{node_id}:{expiry}:{term}"
+    # A write can go through even if it looks like it didn't, like when its request is sent again after the response got lost and the second try finds no match. The leader key then holds the value we wrote
+    if (
+        db.compare_and_set_metadata("leader", current, new_value)
+        or db.get_metadata("leader") == new_value
+    ):
+        return term, expiry
+    return None
+
+
+def release(db, node_id, term):
+    """Expire our lease right away, so a follower can take over without waiting for it to run out. Does nothing if we no longer hold it"""
+    current = db.get_metadata("leader")
+    lease = parse(current) if current else None
+    if lease and lease[0] == node_id and lease[2] == term:
+        db.compare_and_set_metadata("leader", current, f"{node_id}:0:{term}")
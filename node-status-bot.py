@@ -1,28 +1,49 @@
 import argparse
+import collections
+import copy
+import hashlib
+import json
 import logging
 import os
+import queue
 import random
+import re
 import sqlite3
+import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
+import cachetools
 import grid3.graphql
-import telegram
+import prometheus_client
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES
 from gql import gql
-from grid3.minting.period import Period
 from grid3.types import Node
 from telegram import ParseMode, Update
 from telegram.ext import (
     CallbackContext,
     CommandHandler,
     Defaults,
+    ExtBot,
+    JobQueue,
     Updater,
 )
+from telegram.utils.request import Request
 
 import find_violations
-from db import RqliteDB
+import lease
+from chat_dispatcher import DEFAULT_MAX_QUEUE, DEFAULT_WORKERS, ChatDispatcher
+from db import NodeStateCache, RqliteDB
 from ingester import prep_db
+from lanes import Busy, Lane, LaneExecutor
+from node_lookup import FarmIndex, NodeLookupCache
+from outbox import Outbox
+from pages import paginate
+from scheduler import DeadlineScheduler
+from sharding import HashRing, Liveness
+from tfchain_db import POOL_SIZE, ConnectionPool
 
 # Technically Telegram supports messages up to 4096 characters, beyond which an
 # error is returned. However in my experience, messages longer than 3800 chars
@@ -31,10 +52,76 @@ MAX_TEXT_LENGTH = 3800
 
 NETWORKS = ["main", "test", "dev"]
 DEFAULT_PING_TIMEOUT = 10
-DEFAULT_HEARTBEAT_INTERVAL = 30
+# Each lease renewal is a strongly consistent write, and a leader that can't renew in time shuts down. A shorter interval gives faster failover after a crash, for more load and less tolerance of stalls
+DEFAULT_HEARTBEAT_INTERVAL = 10
+# Followers check for an expired or released leader lease this many times per heartbeat interval. Each check is a strongly consistent read through the rqlite leader, so they're kept to a fraction of the lease's rate
+LEASE_POLLS_PER_INTERVAL = 2
 JITTER_TIME = 5
 DB_RETRY_WAIT = 5
 BOOT_TOLERANCE = 60 * 40
+# How many node ids to put in one GraphQL query, and how many such queries to run at once
+GQL_CHUNK_SIZE = 500
+GQL_CHUNK_WORKERS = 4
+# Nodes are considered offline this long after their last uptime report, or this long after it when in standby
+UP_TIMEOUT = 60 * 60
+STANDBY_TIMEOUT = 60 * 60 * 24
+# How often status_job looks for nodes with a status deadline that has passed
+STATUS_TICK = 1
+# How often check_job fetches all subscribed nodes, rather than just the ones that changed
+FULL_POLL_INTERVAL = 60 * 10
+# Delta polls ask for nodes updated a bit before the newest update seen so far, in case GraphQL indexes some reports out of order
+DELTA_POLL_OVERLAP = 60 * 5
+# Each replica sends a heartbeat this often, and is dropped from the hash ring when it hasn't sent one for REPLICA_TIMEOUT seconds. The leader deletes replicas that haven't sent one for REPLICA_PRUNE_AGE
+MEMBERSHIP_INTERVAL = 5
+REPLICA_TIMEOUT = 3 * MEMBERSHIP_INTERVAL
+REPLICA_PRUNE_AGE = 12 * MEMBERSHIP_INTERVAL
+# How many violation scans for commands can run at once, how many more can wait for a worker, and how many scan results to keep
+SCAN_WORKERS = 2
+MAX_SCAN_QUEUE = 50
+SCAN_CACHE_SIZE = 10000
+# populate_violations scans this many nodes per batch, and one batch per pooled connection at once
+POPULATE_CHUNK = 500
+POPULATE_WORKERS = POOL_SIZE
+# Threads for the leader lease and membership jobs, and for the alert and violation jobs. Keeping them apart means a slow poll can't hold up a heartbeat
+HEARTBEAT_WORKERS = 2
+BACKGROUND_WORKERS = 4
+# Jobs are scheduled to run in one of these lanes
+HEARTBEAT_JOB = {"executor": "heartbeat"}
+BACKGROUND_JOB = {"executor": "background"}
+BUSY_TEXT = "Sorry, the bot is very busy right now. Please try again in a minute."
+
+# Violation alerts can only be as recent as the ingester's checkpoint, so its lag is part of their detection latency (see alert_detection_seconds in outbox.py)
+checkpoint_lag = prometheus_client.Gauge(
+    "ingester_checkpoint_lag_seconds",
+    "Age of the last block processed by the ingester, when violations_job last read its checkpoint",
+)
+
+
+def run_scan(context, chat_id, fn, *args):
+    """Run the slow part of a command, fn(context, chat_id, *args), in the scan lane. The chat's later commands wait for it, so they still run in order. When the lane's queue is full the command is turned away with the busy reply"""
+    try:
+        future = scan_executor.submit(fn, context, chat_id, *args)
+    except Busy:
+        outbox.send(chat_id, BUSY_TEXT)
+        return
+    future.add_done_callback(lambda f: scan_done(context, chat_id, f))
+    context.dispatcher.hold_chat(chat_id, future)
+
+
+def scan_done(context, chat_id, future):
+    error = future.exception()
+    if error is not None:
+        logging.error("Error running command for chat %s", chat_id, exc_info=error)
+        send_message(
+            context,
+            chat_id,
+            text="There was an error processing your command. Please wait a moment and try again.",
+        )
+
+
+def reply_busy(update: Update):
+    """Sent instead of handling a command when too many are waiting, see ChatDispatcher"""
+    outbox.send(update.effective_chat.id, BUSY_TEXT)
 
 
 def check_chat(update: Update, context: CallbackContext):
@@ -45,139 +132,187 @@ def check_chat(update: Update, context: CallbackContext):
 def check_job(context: CallbackContext):
     """
     The main attraction. This function collects all the node ids that have an active subscription, checks their status, then sends alerts to users whose nodes have a status change.
+
+    Each network is its own pipeline. The GraphQL queries for all networks are sent concurrently, and each network's results are reconciled with the database as soon as they arrive, while the other queries are still in flight. So a poll takes about as long as the slowest network, rather than the sum of all of them.
     """
     db = context.bot_data["db"]
-    con, periods = get_con_and_periods()
+    start_time = time.time()
 
-    for net in NETWORKS:
-        try:
-            # Get all subscribed nodes and their chat subscriptions
-            subscribed_nodes = db.get_all_subscribed_nodes()
-
-            # Convert to format: {node_id: [chat_ids]}
-            subbed_nodes = {node_id: chat_ids for node_id, chat_ids in subscribed_nodes}
+    try:
+        # Get all subscribed nodes and their chat subscriptions, as {net: {node_id: [chat_ids]}}, with farm subscriptions expanded to their nodes
+        node_subscriptions = db.get_subscriptions_by_network()
+        farm_subscriptions = db.get_farm_subscriptions_by_network()
+        subscriptions = {
+            net: expand_farms(
+                net, node_subscriptions.get(net, {}), farm_subscriptions.get(net, {})
+            )
+            for net in NETWORKS
+        }
+    except:
+        logging.exception("Error fetching subscriptions for check")
+        return
 
+    # Only check the nodes in this replica's shard
+    ring = context.bot_data["ring"]
+    subscriptions = {
+        net: {
+            node_id: chat_ids
+            for node_id, chat_ids in nodes.items()
+            if ring.owner(net, node_id) == args.node_id
+        }
+        for net, nodes in subscriptions.items()
+    }
+    context.bot_data["subscriptions"] = subscriptions
+
+    futures = {
+        gql_executor.submit(poll_nodes, net, subscriptions[net]): net
+        for net in NETWORKS
+        if subscriptions.get(net)
+    }
+    for future in as_completed(futures):
+        net = futures[future]
+        try:
             # Get current node statuses
-            updates = get_nodes(net, subbed_nodes.keys())
-
-            if net == "main":
-                # Check for violations only on mainnet
-                all_violations = {}
-                for node_id in subbed_nodes.keys():
-                    violations = get_violations(con, node_id, periods)
-                    all_violations[node_id] = violations
-
+            updates = future.result()
         except:
             logging.exception("Error fetching node data for check")
             continue
 
-        for update in updates:
-            try:
-                # Get current node state from database
-                node_data = db.get_node(update.nodeId, net)
-                if not node_data:
-                    # New node, create initial record
-                    db.create_node(update, net)
-                    node_data = db.get_node(update.nodeId, net)
-
-                # Check for status changes
-                if (
-                    node_data["power"]["target"] == "Down"
-                    and update.power["target"] == "Up"
-                ):
-                    for chat_id in subbed_nodes[update.nodeId]:
-                        send_message(
-                            context,
-                            chat_id,
-                            text="Node {} wake up initiated \N{HOT BEVERAGE}".format(
-                                update.nodeId
-                            ),
-                        )
-
-                if node_data["status"] == "up" and update.status == "down":
-                    for chat_id in subbed_nodes[update.nodeId]:
-                        send_message(
-                            context,
-                            chat_id,
-                            text="Node {} has gone offline \N{WARNING SIGN}".format(
-                                update.nodeId
-                            ),
-                        )
-
-                elif node_data["status"] == "up" and update.status == "standby":
-                    for chat_id in subbed_nodes[update.nodeId]:
-                        send_message(
-                            context,
-                            chat_id,
-                            text="Node {} has gone to sleep \N{LAST QUARTER MOON WITH FACE}".format(
-                                update.nodeId
-                            ),
-                        )
-
-                elif node_data["status"] == "standby" and update.status == "down":
-                    for chat_id in subbed_nodes[update.nodeId]:
-                        send_message(
-                            context,
-                            chat_id,
-                            text="Node {} did not wake up within 24 hours \N{WARNING SIGN}".format(
-                                update.nodeId
-                            ),
-                        )
-
-                elif (
-                    node_data["status"] in ("down", "standby") and update.status == "up"
-                ):
-                    for chat_id in subbed_nodes[update.nodeId]:
-                        send_message(
-                            context,
-                            chat_id,
-                            text="Node {} has come online \N{ELECTRIC LIGHT BULB}".format(
-                                update.nodeId
-                            ),
-                        )
-
-                # We track which nodes have ever been managed by farmerbot,
-                # since those are the only ones that can get violations and
-                # scanning for violations is a relatively expensive operation
-                if node_data["status"] == "standby" or update.status == "standby":
-                    node_data["farmerbot"] = True
-                # Update node status in database
-                db.update_node(update, net)
-
-                # Check for new violations
-                if update.nodeId in all_violations:
-                    existing_violations = node_data["violations"]
-                    for violation in all_violations[update.nodeId]:
-                        if violation.boot_requested not in existing_violations:
-                            if violation.finalized:
-                                for chat_id in subbed_nodes[update.nodeId]:
-                                    send_message(
-                                        context,
-                                        chat_id,
-                                        text="🚨 Farmerbot violation detected for node {}. Node failed to boot within 30 minutes 🚨\n\n{}".format(
-                                            update.nodeId, format_violation(violation)
-                                        ),
-                                    )
-                            # The idea here was to give a bit of wiggle room before alerting the user, since these are only possible violations at this point. However, if the condition wasn't met when the violation was first detected, then the user was never alerted. To reenable this, we'd need some additional logic here in the bot or in code that finds violations.
-                            # elif (
-                            #     violation.end_time - violation.boot_requested
-                            #     > BOOT_TOLERANCE
-                            # ):
-                            else:
-                                for chat_id in subbed_nodes[update.nodeId]:
-                                    send_message(
-                                        context,
-                                        chat_id,
-                                        text="🚨 Possible farmerbot violation detected for node {}. Node appears to have not booted within 30 minutes of boot request. Check again with /violations after node boots 🚨\n\n{}".format(
-                                            update.nodeId, format_violation(violation)
-                                        ),
-                                    )
-
-                            # Add new violation to database
-                            db.add_violation(update.nodeId, net, violation)
+        with alert_lock:
+            check_updates(context, net, updates, subscriptions[net])
+
+    logging.info("Check job finished in %.2f seconds", time.time() - start_time)
+
+
+def status_job(context: CallbackContext):
+    """
+    Runs every STATUS_TICK seconds to catch status changes that happen just because time passes, like a node going offline when it stops reporting. Rather than checking every node, we only evaluate the nodes whose deadline has arrived, so a tick with nothing due does almost no work and a change is detected within a tick of it happening.
+    """
+    due = status_scheduler.pop_due(time.time())
+    if not due:
+        return
+
+    subscriptions = context.bot_data.get("subscriptions", {})
+    due_nodes = collections.defaultdict(list)
+    with poll_lock:
+        for net, node_id in due:
+            node = poll_states.get(net, {}).get("nodes", {}).get(node_id)
+            if node is None or node_id not in subscriptions.get(net, {}):
+                continue
+            node.status = get_node_status(node)
+            status_scheduler.schedule((net, node_id), next_status_deadline(node))
+            due_nodes[net].append(node)
+
+    for net, nodes in due_nodes.items():
+        with alert_lock:
+            check_updates(context, net, nodes, subscriptions[net])
+
+
+def report_overrun(event):
+    """Scheduler listener for job runs that were skipped because the previous run of the same job was still going"""
+    job = updater.job_queue.scheduler.get_job(event.job_id)
+    name = job.name if job else event.job_id
+    job_overruns[name] += 1
+    logging.warning(
+        "Skipped a run of %s because the previous one is still running (%s skipped so far)",
+        name,
+        job_overruns[name],
+    )
 
-            except:
-                logging.exception("Error in alert block")
+
+def check_updates(context, net, updates, subbed_nodes):
+    """Compare the fetched node data for one network with the cached node states, and alert subscribers of any status changes. The cache then writes any transitions back to rqlite in one transaction"""
+    node_cache = context.bot_data["node_cache"]
+    node_cache.fill(net, [update.nodeId for update in updates])
+    stored_nodes = node_cache.get_states(net)
+
+    for update in updates:
+        try:
+            node_data = stored_nodes.get(update.nodeId)
+            if not node_data:
+                # New node, there's nothing to compare against yet
+                continue
+
+            # Check for status changes. Alerts carry the time of the change from the node data, for the alert latency metrics. GraphQL doesn't say when a wake up was requested, so those alerts have none
+            if (
+                node_data["power"]["target"] == "Down"
+                and update.power["target"] == "Up"
+            ):
+                for chat_id in subbed_nodes[update.nodeId]:
+                    send_message(
+                        context,
+                        chat_id,
+                        text="Node {} wake up initiated \N{HOT BEVERAGE}".format(
+                            update.nodeId
+                        ),
+                        batch=True,
+                    )
+
+            if node_data["status"] == "up" and update.status == "down":
+                for chat_id in subbed_nodes[update.nodeId]:
+                    send_message(
+                        context,
+                        chat_id,
+                        text="Node {} has gone offline \N{WARNING SIGN}".format(
+                            update.nodeId
+                        ),
+                        batch=True,
+                        source=("offline", update.updatedAt + UP_TIMEOUT),
+                    )
+
+            elif node_data["status"] == "up" and update.status == "standby":
+                for chat_id in subbed_nodes[update.nodeId]:
+                    send_message(
+                        context,
+                        chat_id,
+                        text="Node {} has gone to sleep \N{LAST QUARTER MOON WITH FACE}".format(
+                            update.nodeId
+                        ),
+                        batch=True,
+                        source=("sleep", update.updatedAt),
+                    )
+
+            elif node_data["status"] == "standby" and update.status == "down":
+                for chat_id in subbed_nodes[update.nodeId]:
+                    send_message(
+                        context,
+                        chat_id,
+                        text="Node {} did not wake up within 24 hours \N{WARNING SIGN}".format(
+                            update.nodeId
+                        ),
+                        batch=True,
+                        source=("no_wake", update.updatedAt + STANDBY_TIMEOUT),
+                    )
+
+            elif node_data["status"] in ("down", "standby") and update.status == "up":
+                for chat_id in subbed_nodes[update.nodeId]:
+                    send_message(
+                        context,
+                        chat_id,
+                        text="Node {} has come online \N{ELECTRIC LIGHT BULB}".format(
+                            update.nodeId
+                        ),
+                        batch=True,
+                        source=("online", update.updatedAt),
+                    )
+
+            # We track which nodes have ever been managed by farmerbot,
+            # since those are the only ones that can get violations and
+            # scanning for violations is a relatively expensive operation
+            if (
+                node_data["farmerbot"]
+                or node_data["status"] == "standby"
+                or update.status == "standby"
+            ):
+                update.farmerbot = True
+        except:
+            logging.exception("Error in alert block")
+
+    # Update node statuses in database
+    try:
+        node_cache.update_nodes(updates, net)
+    except:
+        logging.exception("Error writing node updates")
 
 
 def format_list(items):
@@ -186,92 +321,105 @@ def format_list(items):
     elif len(items) == 2:
         text = "s " + str(items[0]) + " and " + str(items[1])
     else:
-        text = "s "
-        for i in items[:-1]:
-            text = text + str(i) + ", "
-        text = text + "and " + str(items[-1])
+        text = "s " + ", ".join(str(i) for i in items[:-1]) + ", and " + str(items[-1])
     return text
 
 
-def format_nodes(up, down, standby):
+def node_sections(up, down, standby):
+    """Render a status report one section per node state, for send_report"""
     up.sort()
     down.sort()
     standby.sort()
-    text = ""
-
-    if up:
-        text += "<b><u>Up nodes:</u></b>\n"
-        text += format_vertical_list(up)
-    if down:
-        if up:
-            text += "\n"
-        text += "<b><u>Down nodes:</u></b>\n"
-        text += format_vertical_list(down)
-    if standby:
-        if up or down:
-            text += "\n"
-        text += "<b><u>Standby nodes:</u></b>\n"
-        text += format_vertical_list(standby)
 
-    return text
+    # Sections after the first are set apart by a blank line
+    separator = ""
+    for name, nodes in (("Up", up), ("Down", down), ("Standby", standby)):
+        if nodes:
+            heading = "<b><u>{} nodes:</u></b>\n".format(name)
+            yield separator + heading + format_vertical_list(nodes)
+            separator = "\n"
 
 
 def format_vertical_list(items):
-    text = ""
-    for item in items:
-        text += str(item) + "\n"
-    return text
+    return "".join(str(item) + "\n" for item in items)
 
 
 def format_violation(violation):
-    text = ""
-    requested = datetime.fromtimestamp(violation.boot_requested)
-    text += "<i>Boot requested at:</i>\n"
-    text += "{} UTC\n".format(requested)
+    lines = [
+        "<i>Boot requested at:</i>",
+        "{} UTC".format(datetime.fromtimestamp(violation.boot_requested)),
+    ]
     if violation.booted_at:
-        booted = datetime.fromtimestamp(violation.booted_at)
-        text += "<i>Node booted at:</i>\n"
-        text += "{} UTC\n".format(booted)
+        lines.append("<i>Node booted at:</i>")
+        lines.append("{} UTC".format(datetime.fromtimestamp(violation.booted_at)))
     else:
-        text += "Node has not booted\n"
-    return text
+        lines.append("Node has not booted")
+    return "\n".join(lines) + "\n"
 
 
 def format_violations(node_id, violations):
-    text = "<b><u>Violations for node {}:</u></b>\n\n".format(node_id)
-    for violation in violations:
-        requested = datetime.fromtimestamp(violation.boot_requested)
-        text += "<i>Boot requested at:</i>\n"
-        text += "{} UTC\n".format(requested)
-        if violation.booted_at:
-            booted = datetime.fromtimestamp(violation.booted_at)
-            text += "<i>Node booted at:</i>\n"
-            text += "{} UTC\n".format(booted)
-        else:
-            text += "Node has not booted\n"
-        text += "\n"
-    return text
+    return "<b><u>Violations for node {}:</u></b>\n\n".format(node_id) + "".join(
+        format_violation(violation) + "\n" for violation in violations
+    )
 
 
 def get_con_and_periods():
-    con = sqlite3.connect(args.db_file)
-    current_period = Period()
-    last_period = Period(offset=current_period.offset - 1)
-    periods = (current_period, last_period)
+    """Take a connection from the pool, to be returned with tfchain_pool.put, along with the current and previous periods"""
+    con = tfchain_pool.get()
+    periods = find_violations.get_periods(con)
     return con, periods
 
 
-def get_nodes(net, node_ids):
+def get_schema(net):
     """
-    Query a list of node ids in GraphQL, create Node objects for consistency and easy field access, then assign them a status and return them.
+    Get the GraphQL schema for the network. It's fetched once by the network's main client, at startup, or by the first query that needs it if the network wasn't available then. Clients aren't safe to share between threads, so the lock keeps every other thread off the main client while it's fetching.
+    """
+    with schema_lock:
+        if not graphqls[net].client.schema:
+            graphqls[net].fetch_schema()
+        return graphqls[net].client.schema
+
+
+def get_graphql(net):
     """
-    graphql = graphqls[net]
-    nodes = graphql.nodes(
-        ["nodeID", "twinID", "updatedAt", "power"], nodeID_in=node_ids
+    Get the GraphQL client for the network that belongs to the current thread. Clients aren't safe to share between threads, so each thread that runs queries gets its own. They reuse the schema fetched by the main client for the network, see get_schema.
+    """
+    if not hasattr(gql_clients, "clients"):
+        gql_clients.clients = {}
+    clients = gql_clients.clients
+    if net not in clients:
+        client = grid3.graphql.GraphQL(graphqls[net].transport.url, fetch_schema=False)
+        client.client.schema = get_schema(net)
+        clients[net] = client
+    return clients[net]
+
+
+def query_nodes(net, node_ids, **where):
+    nodes = get_graphql(net).nodes(
+        ["nodeID", "twinID", "updatedAt", "power"], nodeID_in=node_ids, **where
     )
-    nodes = [Node(node) for node in nodes]
+    return [Node(node) for node in nodes]
+
 
-    one_hour_ago = time.time() - 60 * 60
+def get_nodes(net, node_ids, **where):
+    """
+    Query a list of node ids in GraphQL, create Node objects for consistency and easy field access, then assign them a status and return them. Long lists are queried in parallel chunks, and extra keyword arguments are added as filters, like updatedAt_gt.
+    """
+    node_ids = list(node_ids)
+    chunks = [
+        node_ids[i : i + GQL_CHUNK_SIZE]
+        for i in range(0, len(node_ids), GQL_CHUNK_SIZE)
+    ]
+    if len(chunks) == 1:
+        nodes = query_nodes(net, chunks[0], **where)
+    else:
+        nodes = []
+        futures = [
+            gql_chunk_executor.submit(query_nodes, net, chunk, **where)
+            for chunk in chunks
+        ]
+        for future in futures:
+            nodes.extend(future.result())
 
     for node in nodes:
         if node.power is None:
@@ -287,7 +435,7 @@ def get_nodes(net, node_ids):
     return nodes
 
 
-def get_nodes_from_file(net, node_ids):
+def get_nodes_from_file(net, node_ids, **where):
     """
     For use in test mode, to emulate get_nodes using data in a file. The updatedAt value is given in the file as a delta of how many seconds in the past and converted to absolute time here
     """
@@ -316,12 +464,107 @@ def get_nodes_from_file(net, node_ids):
         return []
 
 
+def get_farm_nodes(net, farm_ids):
+    """Get the ids of the nodes in each farm from GraphQL, as {farm_id: [node_id, ...]}. Used through farm_index"""
+    farms = collections.defaultdict(list)
+    for node in get_graphql(net).nodes(["nodeID", "farmID"], farmID_in=list(farm_ids)):
+        farms[node["farmID"]].append(node["nodeID"])
+    return farms
+
+
+def get_farm_nodes_from_file(net, farm_ids):
+    """For use in test mode, like get_nodes_from_file. The node in the file belongs to the farm given as farmID, or farm 1"""
+    farms = {}
+    if net == "main":
+        with open("node_test_data", "r") as f:
+            node = json.load(f)
+        if node.get("farmID", 1) in farm_ids:
+            farms[node.get("farmID", 1)] = [node["nodeID"]]
+    return farms
+
+
+def expand_farms(net, node_subs, farm_subs):
+    """Combine the node and farm subscriptions of a network, both given as {id: [chat_ids]}, into {node_id: [chat_ids]} for every node covered by either. Farm membership comes from farm_index, falling back to what we last knew if GraphQL is unavailable"""
+    subs = {node_id: list(chat_ids) for node_id, chat_ids in node_subs.items()}
+    if farm_subs:
+        farms = farm_index.get(net, farm_subs.keys(), stale_ok=True)
+        for farm_id, chat_ids in farm_subs.items():
+            for node_id in farms.get(farm_id, ()):
+                node_chats = subs.setdefault(node_id, [])
+                node_chats.extend(c for c in chat_ids if c not in node_chats)
+    return subs
+
+
+def lookup_nodes(net, node_ids):
+    """
+    Like get_nodes, but served from the shared node cache when possible. Used by commands, so that many chats asking about the same nodes don't each query GraphQL. Status is worked out again on copies of the cached nodes, since it depends on the current time
+    """
+    nodes = []
+    for node in node_lookup.get(net, node_ids):
+        node = copy.copy(node)
+        node.status = get_node_status(node)
+        node.farmerbot = node.status == "standby"
+        nodes.append(node)
+    return nodes
+
+
+def poll_nodes(net, node_ids):
+    """
+    Get the current state of the subscribed nodes on a network for check_job. Rather than fetching every node on each poll, we keep the last fetched data for each node and only ask GraphQL for nodes that have new uptime reports (updatedAt) since the last poll, plus new nodes and those whose power state could change without a report, meaning any node in standby, waking up, or managed by farmerbot. Only the fetched nodes are returned. Status changes that happen just because time passes are handled by status_job instead, using the deadline each fetched node gets scheduled with here.
+
+    Every FULL_POLL_INTERVAL seconds all nodes are fetched again anyway, which catches anything the delta queries could miss, like a node's first trip to standby. That interval is well under the one hour it takes for a node without reports to be considered down, so such a node can't be reported offline by mistake.
+    """
+    state = poll_states.setdefault(
+        net, {"nodes": {}, "last_updated": 0, "last_full_poll": 0}
+    )
+    cached = state["nodes"]
+    node_ids = set(node_ids)
+    with poll_lock:
+        for node_id in cached.keys() - node_ids:
+            del cached[node_id]
+            status_scheduler.cancel((net, node_id))
+
+    if time.time() - state["last_full_poll"] > FULL_POLL_INTERVAL:
+        fetched = get_nodes(net, node_ids)
+        state["last_full_poll"] = time.time()
+    else:
+        known = node_ids & cached.keys()
+        new = node_ids - known
+        power_managed = [
+            node_id
+            for node_id in known
+            if getattr(cached[node_id], "farmerbot", False)
+            or cached[node_id].power["state"] == "Down"
+            or cached[node_id].power["target"] == "Down"
+        ]
+        fetched = get_nodes(net, new | set(power_managed))
+        fetched += get_nodes(
+            net,
+            known - set(power_managed),
+            updatedAt_gt=int(state["last_updated"]) - DELTA_POLL_OVERLAP,
+        )
+
+    fetched = [node for node in fetched if node.nodeId in node_ids]
+    with poll_lock:
+        for node in fetched:
+            # Keep the farmerbot flag that check_job may have set on the cached node
+            if getattr(cached.get(node.nodeId), "farmerbot", False):
+                node.farmerbot = True
+            cached[node.nodeId] = node
+            state["last_updated"] = max(state["last_updated"], node.updatedAt)
+            status_scheduler.schedule((net, node.nodeId), next_status_deadline(node))
+        # Nodes that weren't fetched haven't changed, so everything polled is fresh now
+        node_lookup.put(net, cached.values())
+
+    return fetched
+
+
 def get_node_status(node):
     """
     More or less the same methodology that Grid Proxy uses. Nodes are supposed to report every 40 minutes, so we consider them offline after one hour. Standby nodes should wake up once every 24 hours, so we consider them offline after that.
     """
-    one_hour_ago = time.time() - 60 * 60
-    one_day_ago = time.time() - 60 * 60 * 24
+    one_hour_ago = time.time() - UP_TIMEOUT
+    one_day_ago = time.time() - STANDBY_TIMEOUT
 
     # It's possible that some node might not have a power state
     if node.updatedAt > one_hour_ago and node.power["state"] != "Down":
@@ -332,41 +575,112 @@ def get_node_status(node):
         return "down"
 
 
-def get_violations(con, node_id, periods):
-    violations = []
-    for period in periods:
-        violations.extend(find_violations.check_node(con, node_id, period))
-    return violations
+def next_status_deadline(node):
+    """The time at which the node's status will change if no new data arrives, following get_node_status. Down nodes stay down until they report again, so they have no deadline"""
+    if node.status == "up":
+        return node.updatedAt + UP_TIMEOUT
+    elif node.status == "standby":
+        return node.updatedAt + STANDBY_TIMEOUT
+    else:
+        return None
 
 
-def is_leader_valid(leader_info):
-    if not leader_info:
-        return False
+def get_boot_requests(con, node_ids, since, until):
+    """Find the boot requests (power target changed to up) of the nodes after since and up to until. Returns a list of (node_id, timestamp)"""
+    if not node_ids:
+        return []
+    node_ids = list(node_ids)
+    return con.execute(
+        "SELECT node_id, timestamp FROM PowerTargetChanged WHERE target='Up' AND node_id IN ({}) AND timestamp>? AND timestamp<=?".format(
+            ", ".join("?" * len(node_ids))
+        ),
+        node_ids + [since, until],
+    ).fetchall()
 
-    try:
-        leader_id, last_heartbeat = leader_info.split(":")
-        last_heartbeat = float(last_heartbeat)
-        return time.time() - last_heartbeat < 2 * args.heartbeat_interval
-    except:
-        return False
+
+def get_changed_nodes(con, after_block, until_block):
+    """Get the ids of all nodes that had events in the blocks after after_block, up to and including until_block, according to the ingester's change log"""
+    node_ids = set()
+    for (ids,) in con.execute(
+        "SELECT node_ids FROM ChangeLog WHERE block>? AND block<=?",
+        (after_block, until_block),
+    ):
+        node_ids.update(int(n) for n in ids.split(","))
+    return node_ids
 
 
-def update_leader(db):
+def change_log_start(con):
+    """The timestamp of the oldest entry in the ingester's change log, which is only kept for a while. Returns None if the log is empty, or the ingester is too old to write one"""
     try:
-        leader_value = f"{args.node_id}:{time.time()}"
-        db.set_metadata("leader", leader_value)
-        return True
-    except:
-        logging.exception("Failed to update leader")
-        return False
+        row = con.execute(
+            "SELECT timestamp FROM ChangeLog ORDER BY block LIMIT 1"
+        ).fetchone()
+    except sqlite3.OperationalError as e:
+        if find_violations.missing_table(e):
+            return None
+        raise
+    return row[0] if row else None
 
 
-def get_leader(db):
+def get_checkpoint(con):
+    """Get the block up to which the ingester has processed all blocks, and that block's timestamp"""
+    block = con.execute("SELECT value FROM kv WHERE key='checkpoint_block'").fetchone()[
+        0
+    ]
+    timestamp = con.execute(
+        "SELECT value FROM kv WHERE key='checkpoint_time'"
+    ).fetchone()[0]
+    return block, timestamp
+
+
+def get_checkpoint_time(con):
+    """The timestamp of the ingester's checkpoint, or None if there isn't one yet"""
+    row = con.execute("SELECT value FROM kv WHERE key='checkpoint_time'").fetchone()
+    return row[0] if row else None
+
+
+def scan_violations(con, node_id, period, checkpoint_time, since=None):
+    """
+    Scan one node for violations in one period. Results are cached by checkpoint time, since a node's violations can only change when the ingester processes new blocks. Until then, repeated scans of the same node (like /violations called again, or right after violations_job checked it) are served from memory. See check_node for since
+    """
+    if checkpoint_time is None:
+        return find_violations.check_node(con, node_id, period, since=since)
+
+    key = node_id, period.offset, checkpoint_time, since
+    with scan_cache_lock:
+        violations = scan_cache.get(key)
+    if violations is None:
+        violations = find_violations.check_node(con, node_id, period, since=since)
+        with scan_cache_lock:
+            scan_cache[key] = violations
+    return violations
+
+
+def get_violations(con, node_id, periods, since=None):
+    """Scan the node for violations in all the periods given. With since, scans start from the latest power state snapshot at or before that time, so only the violations detected since then are returned"""
+    checkpoint_time = get_checkpoint_time(con)
+    violations = []
+    for period in periods:
+        violations.extend(scan_violations(con, node_id, period, checkpoint_time, since))
+    return violations
+
+
+def acquire_lease(db):
+    """Take or renew the leader lease, see lease.acquire. Returns our term if we hold the lease afterwards, otherwise None"""
+    held = lease.acquire(db, args.node_id, args.heartbeat_interval)
+    if held is None:
+        return None
+    term, expiry = held
+    dispatcher.bot_data["lease_expiry"] = expiry
+    return term
+
+
+def release_lease(db, term):
+    """Expire our lease right away, so a follower can take over without waiting for it to run out"""
     try:
-        return db.get_metadata("leader")
+        lease.release(db, args.node_id, term)
     except:
-        logging.exception("Failed to get leader")
-        return None
+        logging.exception("Failed to release leader lease")
 
 
 def initialize_dbs(bot_data):
@@ -377,7 +691,9 @@ def initialize_dbs(bot_data):
         prep_db(con)
         con.close()
 
-    bot_data["db"] = RqliteDB(host=args.rqlite_host, port=args.rqlite_port)
+    bot_data["db"] = RqliteDB(
+        host=args.rqlite_host, port=args.rqlite_port, client=args.rqlite_client
+    )
 
 
 def network(update: Update, context: CallbackContext):
@@ -400,80 +716,165 @@ def network(update: Update, context: CallbackContext):
         send_message(context, chat_id, text="Network is set to {}net".format(net))
 
 
-def node_used_farmerbot(con, node_id):
-    # Check if the node ever went standby, which is a requirement for it to receive a violation
-    result = con.execute(
-        "SELECT 1 FROM PowerStateChanged WHERE node_id=? AND state='Down'", (node_id,)
-    ).fetchone()
-    return result is not None
+def farmerbot_nodes(con, node_ids):
+    """Find which of the nodes ever went standby, which is a requirement for a node to receive a violation. Returns a set of node ids"""
+    node_ids = list(node_ids)
+    found = set()
+    for i in range(0, len(node_ids), find_violations.NODE_CHUNK):
+        chunk = node_ids[i : i + find_violations.NODE_CHUNK]
+        rows = con.execute(
+            "SELECT DISTINCT node_id FROM PowerStateChanged WHERE state='Down' AND node_id IN ({})".format(
+                ", ".join("?" * len(chunk))
+            ),
+            chunk,
+        )
+        found.update(row[0] for row in rows)
+    return found
 
 
 # This function existed to make a smooth transition when the violations feature
 # was launched. It stores all historic violations for all nodes that were
 # already in the system. For a new bot, it's not relevant since there won't be
-# any active nodes from the start.
+# any active nodes from the start. It's also how violations get restored after
+# losing the rqlite data.
 def populate_violations(bot_data):
+    """
+    Scan every farmerbot node we know of for violations and store them. Nodes are scanned in chunks, several at a time, and each chunk's violations are stored in one request. The last node stored is recorded in metadata after each chunk, so after a crash or a change of leader, the scan resumes from there
+    """
     db = bot_data["db"]
 
     # Check if violations have already been populated
     if db.get_metadata("violations_populated") == "true":
         return
 
-    logging.info("Populating violations")
+    progress = db.get_metadata("violations_populate_progress")
+    after = int(progress) if progress else -1
+    if progress:
+        logging.info(f"Resuming populating violations after node {after}")
+    else:
+        logging.info("Populating violations")
 
     con, periods = get_con_and_periods()
-
-    # Get all nodes that have ever been in standby (managed by farmerbot)
-    res = con.execute(
-        "SELECT DISTINCT node_id FROM PowerStateChanged WHERE state='Down'"
-    )
-    farmerbot_nodes = [row[0] for row in res.fetchall()]
+    try:
+        # Get all nodes that have ever been in standby (managed by farmerbot)
+        res = con.execute(
+            "SELECT DISTINCT node_id FROM PowerStateChanged WHERE state='Down' AND node_id > ? ORDER BY node_id",
+            (after,),
+        )
+        farmerbot_nodes = [row[0] for row in res.fetchall()]
+    finally:
+        tfchain_pool.put(con)
 
     # Only check nodes that are already in our database
-    existing_nodes = db.get_nodes("main")
+    existing_nodes = db.get_node_states("main")
     farmerbot_nodes = [n for n in farmerbot_nodes if n in existing_nodes]
+    chunks = [
+        farmerbot_nodes[i : i + POPULATE_CHUNK]
+        for i in range(0, len(farmerbot_nodes), POPULATE_CHUNK)
+    ]
 
-    # For each farmerbot-managed node, check for existing violations and store them
-    for node_id in farmerbot_nodes:
-        violations = get_violations(con, node_id, periods)
-        if violations:
-            db.add_violations(node_id, "main", violations)
+    # Chunks are scanned in parallel but stored in order, so the progress recorded always covers every node before it
+    with ThreadPoolExecutor(max_workers=POPULATE_WORKERS) as executor:
+        for chunk, violations in zip(
+            chunks, executor.map(lambda c: scan_chunk(c, periods), chunks)
+        ):
+            if violations:
+                db.add_network_violations_if_leader(
+                    "main", violations, args.node_id, bot_data["leader_term"]
+                )
+            if not db.set_metadata_if_leader(
+                "violations_populate_progress",
+                str(chunk[-1]),
+                args.node_id,
+                bot_data["leader_term"],
+            ):
+                # Another replica took over and is populating in our place
+                logging.info("Lost leadership while populating violations")
+                return
 
     # Mark violations as populated
     db.set_metadata("violations_populated", "true")
+    logging.info(f"Populated violations for {len(farmerbot_nodes)} nodes")
 
 
-def send_message(context, chat_id, text):
-    try:
-        if len(text) > MAX_TEXT_LENGTH:
-            for message in split_message(text):
-                context.bot.send_message(chat_id=chat_id, text=message)
-        else:
-            context.bot.send_message(chat_id=chat_id, text=text)
-    except telegram.error.Unauthorized:
-        # User blocked the bot or deleted their account
-        pass
-    except:
-        logging.exception("Error sending message")
+def scan_chunk(node_ids, periods):
+    """Scan some nodes for violations in all the periods given, returning {node_id: [Violation, ...]} for nodes with any violations"""
+    violations = collections.defaultdict(list)
+    with tfchain_pool.connection() as con:
+        for period in periods:
+            for node_id, node_violations in find_violations.check_nodes(
+                con, node_ids, period
+            ).items():
+                violations[node_id].extend(node_violations)
+    return {node_id: v for node_id, v in violations.items() if v}
 
 
-def split_message(text):
-    # The only messages that get over length at the time of writing this
-    # function are violations reports. Since each node's violations are
-    # separated by two blank lines, we can split on those and avoid a message
-    # break in the middle of one node's section
-    messages = []
-    message = ""
-    splitter = "\n\n\n"
-    for chunk in text.split(splitter):
-        if len(message) + len(chunk) > MAX_TEXT_LENGTH:
-            messages.append(message.rstrip(splitter))
-            message = chunk + splitter
+def send_message(context, chat_id, text, batch=False, source=None):
+    """Queue a message for sending, see outbox.py. Alerts should set batch, so alerts to the same chat that arrive together can be sent as one message, and give their source as (alert type, time of the event behind the alert) for the alert latency metrics"""
+    outbox.send(chat_id, text, batch, source)
+
+
+def send_violation_alerts(context, db, node_id, net, chat_ids, violations):
+    """Store any violations of the node that aren't stored yet, then alert the subscribed chats about them. The write is fenced by the leader term, so a replica that has lost the lease neither stores nor alerts"""
+    existing_violations = db.get_node_violations(node_id, net)
+    new_violations = [
+        v for v in violations if v.boot_requested not in existing_violations
+    ]
+    if not new_violations:
+        return
+    if not db.add_network_violations_if_leader(
+        net,
+        {node_id: new_violations},
+        args.node_id,
+        context.bot_data["leader_term"],
+    ):
+        logging.info("Lost leadership before alerting violations of node %s", node_id)
+        return
+    for violation in new_violations:
+        # The block time at which the boot request became a violation, the earliest it could be detected
+        deadline = violation.boot_requested + find_violations.MAX_BOOT_TIME
+        if violation.finalized:
+            for chat_id in chat_ids:
+                send_message(
+                    context,
+                    chat_id,
+                    text="🚨 Farmerbot violation detected for node {}. Node failed to boot within 30 minutes 🚨\n\n{}".format(
+                        node_id, format_violation(violation)
+                    ),
+                    batch=True,
+                    source=("violation", deadline),
+                )
+        # The idea here was to give a bit of wiggle room before alerting the user, since these are only possible violations at this point. However, if the condition wasn't met when the violation was first detected, then the user was never alerted. To reenable this, we'd need some additional logic here in the bot or in code that finds violations.
+        # elif (
+        #     violation.end_time - violation.boot_requested
+        #     > BOOT_TOLERANCE
+        # ):
         else:
-            message += chunk + splitter
-    messages.append(message.rstrip(splitter))
+            for chat_id in chat_ids:
+                send_message(
+                    context,
+                    chat_id,
+                    text="🚨 Possible farmerbot violation detected for node {}. Node appears to have not booted within 30 minutes of boot request. Check again with /violations after node boots 🚨\n\n{}".format(
+                        node_id, format_violation(violation)
+                    ),
+                    batch=True,
+                    source=("possible_violation", deadline),
+                )
+
 
-    return messages
+def send_report(context, chat_id, sections):
+    """Send a report that may be longer than one message, page by page as the sections are rendered (see pages.py). Returns the number of pages sent"""
+    pages = 0
+    for page in paginate(sections, MAX_TEXT_LENGTH):
+        send_message(context, chat_id, text=page)
+        pages += 1
+    return pages
+
+
+def split_message(text):
+    # Used by the outbox for messages that are too long, like alerts batched together. Batched alerts and each node's violations are separated by two blank lines, so we split there where possible, and otherwise between lines or words
+    sections = re.split("(?<=\n\n\n)", text)
+    return list(paginate(sections, MAX_TEXT_LENGTH))
 
 
 def start(update: Update, context: CallbackContext):
@@ -494,12 +895,17 @@ Here are all the commands I support:
 /status - check the current status of one node. This uses a similar method as the Dashboard for determining node status, and update may be delayed by an hour. With no input, a status report will be generated for all subscribed nodes, if any.
 Example: /status 1
 
-/violations - scan for farmerbot related violations during the current minting period. Like status, this works on all subscribed nodes when no input is given.
+To check every node in a farm, write "farm" before the farm id.
+Example: /status farm 1
 
-/subscribe - subscribe to updates about one or more nodes. If you don't provide an input, the nodes you are currently subscribed to will be shown.
+/violations - scan for farmerbot related violations during the current minting period. Like status, this works on all subscribed nodes when no input is given, and on a whole farm with "farm" before the farm id.
+Example: /violations farm 1
+
+/subscribe - subscribe to updates about one or more nodes. If you don't provide an input, the nodes you are currently subscribed to will be shown. To subscribe to every node in a farm, including nodes added to it later, write "farm" before the farm ids.
 Example: /sub 1 2 3
+Example: /sub farm 1
 
-/unsubscribe - unsubscribe from updates about one or more nodes. To unsubscribe from all node and thus stop all alerts, write "/unsubscribe all"
+/unsubscribe - unsubscribe from updates about one or more nodes, or farms with "farm" before the ids. To unsubscribe from all nodes and farms and thus stop all alerts, write "/unsubscribe all"
 
 /network - change the network to "dev", "test", or "main" (default is main). If you don't provide an input, the currently selected network is shown.
 Example: /network main
@@ -520,13 +926,16 @@ def status_gql(update: Update, context: CallbackContext):
     # Get current network for this chat
     net = db.get_chat_network(chat_id)
 
-    if context.args:
+    if context.args and context.args[0] == "farm":
+        farm_status(context, chat_id, net, context.args[1:])
+
+    elif context.args:
         try:
-            node = get_nodes(net, context.args)[0]
+            node = lookup_nodes(net, context.args[:1])[0]
             send_message(
                 context, chat_id, text="Node {} is {}".format(node.nodeId, node.status)
             )
-        except IndexError:
+        except (IndexError, ValueError):
             send_message(
                 context, chat_id, text="Node id not valid on {}net".format(net)
             )
@@ -542,22 +951,58 @@ def status_gql(update: Update, context: CallbackContext):
         subbed_nodes = db.get_subscribed_nodes(chat_id, net)
 
         if subbed_nodes:
-            up, down, standby = [], [], []
-            text = ""
-            nodes = get_nodes(net, subbed_nodes)
-            for node in nodes:
-                if node.status == "up":
-                    up.append(node.nodeId)
-                elif node.status == "down":
-                    down.append(node.nodeId)
-                elif node.status == "standby":
-                    standby.append(node.nodeId)
-            text = format_nodes(up, down, standby)
-            send_message(context, chat_id, text=text)
+            nodes = lookup_nodes(net, subbed_nodes)
+            send_report(context, chat_id, node_sections(*group_by_status(nodes)))
         else:
             send_message(context, chat_id, text="Please specify a node id")
 
 
+def farm_status(context, chat_id, net, args):
+    """The status command for every node in a farm. Large farms get their report over several messages"""
+    try:
+        farm_id = int(args[0])
+    except (IndexError, ValueError):
+        send_message(
+            context, chat_id, text="Please specify a farm id. Example: /status farm 1"
+        )
+        return
+
+    try:
+        node_ids = farm_index.get(net, [farm_id]).get(farm_id, ())
+        nodes = lookup_nodes(net, node_ids)
+    except:
+        logging.exception("Failed to fetch farm info")
+        send_message(
+            context,
+            chat_id,
+            text="Error fetching farm data. Please wait a moment and try again.",
+        )
+        return
+
+    if not nodes:
+        send_message(
+            context,
+            chat_id,
+            text="No nodes found in farm {} on {}net".format(farm_id, net),
+        )
+        return
+
+    send_report(context, chat_id, node_sections(*group_by_status(nodes)))
+
+
+def group_by_status(nodes):
+    """Split nodes into lists of up, down and standby node ids"""
+    up, down, standby = [], [], []
+    for node in nodes:
+        if node.status == "up":
+            up.append(node.nodeId)
+        elif node.status == "down":
+            down.append(node.nodeId)
+        elif node.status == "standby":
+            standby.append(node.nodeId)
+    return up, down, standby
+
+
 def status_ping(update: Update, context: CallbackContext):
     """
     Get the node status using a ping.
@@ -574,49 +1019,88 @@ def subscribe(update: Update, context: CallbackContext):
     # Get current network for this chat
     net = db.get_chat_network(chat_id)
 
-    # Get currently subscribed nodes
+    # Get currently subscribed nodes and farms
     current_subs = db.get_subscribed_nodes(chat_id, net)
+    current_farms = db.get_subscribed_farms(chat_id, net)
 
-    node_ids = []
-    if context.args:
+    farms = bool(context.args) and context.args[0] == "farm"
+    id_args = context.args[1:] if farms else context.args
+
+    ids = []
+    if id_args:
         try:
-            for arg in context.args:
-                node_ids.append(int(arg))
+            for arg in id_args:
+                ids.append(int(arg))
         except ValueError:
             send_message(
                 context,
                 chat_id,
-                text="There was a problem processing your input. This command accepts one or more node ids separated by a space.",
+                text="There was a problem processing your input. This command accepts one or more node ids separated by a space, or farm ids after the word farm.",
             )
             return
+    elif farms:
+        send_message(
+            context, chat_id, text="Please give one or more farm ids after farm."
+        )
+        return
     else:
-        if current_subs:
-            send_message(
-                context,
-                chat_id,
-                text="You are currently subscribed to node" + format_list(current_subs),
-            )
+        if current_subs or current_farms:
+            text = ""
+            if current_subs:
+                text = "You are currently subscribed to node" + format_list(
+                    current_subs
+                )
+            if current_farms:
+                if text:
+                    text += "\n\n"
+                text += "You are currently subscribed to farm" + format_list(
+                    current_farms
+                )
+            send_message(context, chat_id, text=text)
             return
         else:
             send_message(context, chat_id, text="You are not subscribed to any nodes")
             return
 
+    if farms:
+        run_scan(context, chat_id, add_farm_subscriptions, net, ids, current_farms)
+    else:
+        run_scan(context, chat_id, add_subscriptions, net, ids, current_subs)
+
+
+def store_new_nodes(context, net, nodes):
+    """Store the nodes of new subscriptions and any violations they already have, in one write each. Nodes owned by other replicas are written straight to rqlite, where their owner picks them up on its next poll"""
+    db = context.bot_data["db"]
+    ring = context.bot_data["ring"]
+    owned = {
+        node.nodeId for node in nodes if ring.owner(net, node.nodeId) == args.node_id
+    }
+    context.bot_data["node_cache"].create_nodes(
+        [node for node in nodes if node.nodeId in owned], net
+    )
+    db.create_nodes([node for node in nodes if node.nodeId not in owned], net)
+
+    with tfchain_pool.connection() as con:
+        periods = find_violations.get_periods(con)
+        # Only nodes that have been in standby can have violations
+        scan_ids = farmerbot_nodes(con, [node.nodeId for node in nodes])
+    if scan_ids:
+        violations = scan_chunk(sorted(scan_ids), periods)
+        if violations:
+            db.add_network_violations(net, violations)
+
+
+def add_subscriptions(context, chat_id, net, node_ids, current_subs):
+    """The second half of the subscribe command, which looks up the nodes and scans them for existing violations. It runs in the scan pool, so it doesn't hold up other commands"""
+    db = context.bot_data["db"]
     try:
         # Get node data for new subscriptions
         new_ids = [n for n in node_ids if n not in current_subs]
-        new_nodes = {node.nodeId: node for node in get_nodes(net, new_ids)}
+        new_nodes = {node.nodeId: node for node in lookup_nodes(net, new_ids)}
 
         if new_nodes:
             # Add nodes to database first
-            for node_id, node in new_nodes.items():
-                db.create_node(node, net)
-
-                # Fetch and store violations for the newly added node
-                con, periods = get_con_and_periods()
-                if node_used_farmerbot(con, node_id):
-                    violations = get_violations(con, node_id, periods)
-                    if violations:
-                        db.add_violations(node_id, net, violations)
+            store_new_nodes(context, net, list(new_nodes.values()))
 
             # Add all subscriptions in one go
             db.add_subscriptions(chat_id, net, list(new_nodes.keys()))
@@ -650,6 +1134,44 @@ def subscribe(update: Update, context: CallbackContext):
     send_message(context, chat_id, text=msg)
 
 
+def add_farm_subscriptions(context, chat_id, net, farm_ids, current_farms):
+    """Like add_subscriptions, for whole farms. The farm subscription itself is one row, and the farms' nodes are stored and scanned together"""
+    db = context.bot_data["db"]
+    try:
+        new_ids = [f for f in dict.fromkeys(farm_ids) if f not in current_farms]
+        farms = farm_index.get(net, new_ids)
+        new_farms = [f for f in new_ids if farms.get(f)]
+
+        if new_farms:
+            node_ids = [node_id for f in new_farms for node_id in farms[f]]
+            store_new_nodes(context, net, lookup_nodes(net, node_ids))
+            db.add_farm_subscriptions(chat_id, net, new_farms)
+        else:
+            text = "No valid farm ids found to add. Either the farms don't have any nodes or you were already subscribed to them."
+            if current_farms:
+                text += " You are currently subscribed to farm" + format_list(
+                    current_farms
+                )
+            send_message(context, chat_id, text=text)
+            return
+
+    except:
+        logging.exception("Failed to fetch farm info")
+        send_message(
+            context,
+            chat_id,
+            text="Error fetching farm data. Please wait a moment and try again.",
+        )
+        return
+
+    node_count = sum(len(farms[f]) for f in new_farms)
+    msg = "You have been successfully subscribed to farm" + format_list(new_farms)
+    msg += "\n\nThat's {} node{} in total.".format(
+        node_count, "" if node_count == 1 else "s"
+    )
+    send_message(context, chat_id, text=msg)
+
+
 def timeout(update: Update, context: CallbackContext):
     """
     Sets a custom ping timeout for the user.
@@ -691,47 +1213,54 @@ def unsubscribe(update: Update, context: CallbackContext):
     # Get current network for this chat
     net = db.get_chat_network(chat_id)
 
-    # Get currently subscribed nodes
+    # Get currently subscribed nodes and farms
     current_subs = db.get_subscribed_nodes(chat_id, net)
+    current_farms = db.get_subscribed_farms(chat_id, net)
 
-    if not current_subs:
+    if not current_subs and not current_farms:
         send_message(context, chat_id, text="You weren't subscribed to any updates.")
         return
 
     if context.args and context.args[0] == "all":
         # Remove all subscriptions for this chat
-        for node_id in current_subs:
-            db.remove_subscription(chat_id, net, node_id)
+        db.remove_all_subscriptions(chat_id, net)
         send_message(
             context,
             chat_id,
             text=f"You have been unsubscribed from all nodes on {net}net",
         )
     elif context.args:
-        removed_nodes = []
-        node_ids = []
-        for node in context.args:
+        farms = context.args[0] == "farm"
+        current = current_farms if farms else current_subs
+        removed = []
+        for arg in context.args[1:] if farms else context.args:
             try:
-                node_id = int(node)
-                if node_id in current_subs:
-                    node_ids.append(node_id)
-                    removed_nodes.append(node_id)
+                item_id = int(arg)
+                if item_id in current and item_id not in removed:
+                    removed.append(item_id)
             except ValueError:
                 pass
 
-        if node_ids:
-            db.remove_subscriptions(chat_id, net, node_ids)
-
-        if removed_nodes:
+        if removed:
+            if farms:
+                db.remove_farm_subscriptions(chat_id, net, removed)
+            else:
+                db.remove_subscriptions(chat_id, net, removed)
             send_message(
                 context,
                 chat_id,
-                text="You have been unsubscribed from node"
-                + format_list(removed_nodes),
+                text="You have been unsubscribed from {}".format(
+                    "farm" if farms else "node"
+                )
+                + format_list(removed),
             )
         else:
             send_message(
-                context, chat_id, text="No valid and subscribed node ids found."
+                context,
+                chat_id,
+                text="No valid and subscribed {} ids found.".format(
+                    "farm" if farms else "node"
+                ),
             )
     else:
         send_message(
@@ -744,6 +1273,19 @@ def unsubscribe(update: Update, context: CallbackContext):
 def violations(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
 
+    if context.args and context.args[0] == "farm":
+        try:
+            farm_id = int(context.args[1])
+        except (IndexError, ValueError):
+            send_message(
+                context,
+                chat_id,
+                text="Please specify a farm id. Example: /violations farm 1",
+            )
+            return
+        run_scan(context, chat_id, farm_violations_report, farm_id)
+        return
+
     # This is mostly copied from the subscribe command. TODO: refactor?
     node_ids = []
     if context.args:
@@ -773,76 +1315,297 @@ def violations(update: Update, context: CallbackContext):
             node_ids = subbed_nodes
             using_subs = True
 
-    farmerbot_node_ids = []
-    for node_id in node_ids:
-        con = sqlite3.connect(args.db_file)
-        exists = con.execute(
-            "SELECT 1 FROM PowerTargetChanged WHERE node_id=?", (node_id,)
-        ).fetchone()
-        if exists:
-            farmerbot_node_ids.append(node_id)
+    run_scan(context, chat_id, violations_report, node_ids, using_subs)
+
+
+def violations_report(context, chat_id, node_ids, using_subs):
+    """The scanning part of the violations command, run in the scan pool so that large requests don't hold up other commands"""
+    try:
+        with tfchain_pool.connection() as con:
+            farmerbot_node_ids = []
+            for node_id in node_ids:
+                exists = con.execute(
+                    "SELECT 1 FROM PowerTargetChanged WHERE node_id=?", (node_id,)
+                ).fetchone()
+                if exists:
+                    farmerbot_node_ids.append(node_id)
+
+            if not farmerbot_node_ids:
+                send_message(
+                    context,
+                    chat_id,
+                    text="None of the nodes to check appear to have used the farmerbot.",
+                )
+                return
+
+            if using_subs:
+                send_message(context, chat_id, text="Checking for violations...")
+            else:
+                send_message(
+                    context,
+                    chat_id,
+                    text="Checking node{} for violations...".format(
+                        format_list(farmerbot_node_ids)
+                    ),
+                )
+
+            current_period = find_violations.get_periods(con)[0]
+            checkpoint_time = get_checkpoint_time(con)
+            sections = violation_sections(
+                con, farmerbot_node_ids, current_period, checkpoint_time
+            )
+            pages = send_report(context, chat_id, sections)
+    except:
+        logging.exception("Failed to check violations")
+        send_message(
+            context,
+            chat_id,
+            text="Error checking for violations. Please wait a moment and try again.",
+        )
+        return
+
+    if not pages:
+        send_message(context, chat_id, text="No violations found")
+
 
-    if not farmerbot_node_ids:
+def violation_sections(con, node_ids, period, checkpoint_time):
+    """Scan the nodes one at a time, rendering a section for each one with violations. Pages of a large report can then be sent while the rest is still being scanned"""
+    for node_id in sorted(node_ids):
+        violations = scan_violations(con, node_id, period, checkpoint_time)
+        if violations:
+            yield format_violations(node_id, violations) + "\n"
+
+
+def farm_violations_report(context, chat_id, farm_id):
+    """Like violations_report, but for every node in a farm. The farm's nodes are found in tfchain.db by the farm id their power events are recorded with, and scanned together by the batch engine, so even a large farm takes a few queries"""
+    send_message(
+        context, chat_id, text="Checking farm {} for violations...".format(farm_id)
+    )
+    try:
+        with tfchain_pool.connection() as con:
+            current_period = find_violations.get_periods(con)[0]
+            violations = find_violations.check_farm(con, farm_id, current_period)
+    except:
+        logging.exception("Failed to check farm violations")
         send_message(
             context,
             chat_id,
-            text="None of the nodes to check appear to have used the farmerbot.",
+            text="Error checking for violations. Please wait a moment and try again.",
         )
         return
+
+    if violations:
+        send_report(
+            context,
+            chat_id,
+            (
+                format_violations(node_id, violations[node_id]) + "\n"
+                for node_id in sorted(violations)
+            ),
+        )
     else:
-        if using_subs:
-            send_message(context, chat_id, text="Checking for violations...")
-        else:
-            send_message(
-                context,
-                chat_id,
-                text="Checking node{} for violations...".format(
-                    format_list(farmerbot_node_ids)
-                ),
-            )
+        send_message(context, chat_id, text="No violations found")
 
-        current_period = Period()
-        text = ""
-        for node_id in sorted(farmerbot_node_ids):
-            violations = find_violations.check_node(con, node_id, current_period)
-            if violations:
-                text += format_violations(node_id, violations) + "\n"
-        if text:
-            send_message(context, chat_id, text=text)
+
+def violations_job(context: CallbackContext):
+    """
+    Check subscribed mainnet nodes for new violations. Only nodes with new events in the ingester's change log are scanned, plus nodes whose boot request deadline has just passed, since a node that never boots has no events.
+    """
+    bot_data = context.bot_data
+    db = bot_data["db"]
+    con, periods = get_con_and_periods()
+
+    try:
+        checkpoint_block, checkpoint_time = get_checkpoint(con)
+        checkpoint_lag.set(time.time() - checkpoint_time)
+        last_checkpoint = bot_data.get("violations_checkpoint")
+        if last_checkpoint and last_checkpoint[0] >= checkpoint_block:
+            return
+
+        subbed_nodes = expand_farms(
+            "main",
+            dict(db.get_all_subscribed_nodes("main")),
+            db.get_farm_subscriptions_by_network().get("main", {}),
+        )
+        deadlines = bot_data.setdefault("boot_deadlines", set())
+        known_nodes = bot_data.get("violations_nodes", set())
+        # Nodes whose scan failed, with the time their scan should start from
+        retries = bot_data.setdefault("violations_retries", {})
+
+        # If the change log no longer reaches back to our last run, every node is treated as new
+        if last_checkpoint:
+            log_start = change_log_start(con)
+            if log_start is None or last_checkpoint[1] < log_start:
+                logging.info(
+                    "Change log doesn't reach back to the last violations check, scanning all subscribed nodes"
+                )
+                known_nodes = set()
+                last_checkpoint = None
+
+        # New subscriptions, and every node on the first run, get a full scan. Their recent boot requests are tracked from here on
+        new_nodes = subbed_nodes.keys() - known_nodes
+        boot_requests = get_boot_requests(
+            con,
+            new_nodes,
+            checkpoint_time - find_violations.MAX_BOOT_TIME,
+            checkpoint_time,
+        )
+        if last_checkpoint:
+            changed_nodes = (
+                get_changed_nodes(con, last_checkpoint[0], checkpoint_block)
+                & subbed_nodes.keys()
+            )
+            boot_requests.extend(
+                get_boot_requests(
+                    con, changed_nodes, last_checkpoint[1], checkpoint_time
+                )
+            )
         else:
-            send_message(context, chat_id, text="No violations found")
+            changed_nodes = set()
+
+        for node_id, boot_requested in boot_requests:
+            deadlines.add((boot_requested + find_violations.MAX_BOOT_TIME, node_id))
+
+        due_nodes = set()
+        for deadline, node_id in list(deadlines):
+            if node_id not in subbed_nodes:
+                deadlines.discard((deadline, node_id))
+            elif checkpoint_time > deadline:
+                due_nodes.add(node_id)
+                deadlines.discard((deadline, node_id))
+
+        # Known nodes only need scanning from the last run, and the ingester's snapshots let the scan start there
+        new_nodes = farmerbot_nodes(con, new_nodes)
+        failed = {n: since for n, since in retries.items() if n in subbed_nodes}
+        retries.clear()
+        for node_id in sorted(new_nodes | changed_nodes | due_nodes | failed.keys()):
+            if node_id in new_nodes or not last_checkpoint:
+                since = None
+            elif node_id in failed:
+                since = failed[node_id]
+            else:
+                since = last_checkpoint[1]
+            try:
+                violations = get_violations(con, node_id, periods, since)
+                send_violation_alerts(
+                    context, db, node_id, "main", subbed_nodes[node_id], violations
+                )
+            except:
+                logging.exception("Error checking violations for node %s", node_id)
+                # The checkpoint moves on regardless, so the same window is scanned again on the next run
+                retries[node_id] = since
 
+        bot_data["violations_checkpoint"] = checkpoint_block, checkpoint_time
+        bot_data["violations_nodes"] = set(subbed_nodes)
+        save_violations_cursor(bot_data)
+    except:
+        logging.exception("Error in violations job")
+    finally:
+        tfchain_pool.put(con)
+
+
+def membership_job(context: CallbackContext):
+    """
+    Send this replica's heartbeat and update the hash ring from the replicas that are alive, see sharding.py. When the members change, the node states are reloaded, since nodes we just took over may have been written by their previous owner since we last loaded them. The leader also deletes replicas that have been gone for a while
+    """
+    db = context.bot_data["db"]
+    liveness = context.bot_data["liveness"]
+    try:
+        db.replica_heartbeat(args.node_id, time.time())
+        members = liveness.update(db.get_replicas())
+        if "leader_term" in context.bot_data:
+            stale = liveness.stale(REPLICA_PRUNE_AGE)
+            if stale:
+                db.delete_replicas(stale)
+    except:
+        logging.exception("Error updating replica membership")
+        return
+
+    # Always count ourselves, even if our own heartbeat didn't make it
+    members = set(members) | {args.node_id}
+    if members != context.bot_data["ring"].members:
+        logging.info("Replicas changed, now %s", ", ".join(sorted(members)))
+        context.bot_data["node_cache"].load()
+        context.bot_data["ring"] = HashRing(members)
+        outbox.set_replicas(len(members))
 
-def heartbeat_job(context: CallbackContext):
-    leader_info = get_leader(context.bot_data["db"])
 
-    if not leader_info or not is_leader_valid(leader_info):
-        # Leader is invalid, try to become leader
-        if not update_leader(context.bot_data["db"]):
-            logging.error("Failed to update leader, shutting down")
+def heartbeat_job(context: CallbackContext):
+    """Renew the leader lease. If another replica holds it now, we stop and restart as a follower"""
+    try:
+        term = acquire_lease(context.bot_data["db"])
+    except:
+        # rqlite may just be unavailable for a moment. That's fine for as long as the lease we have lasts
+        logging.exception("Failed to renew leader lease")
+        if time.time() > context.bot_data["lease_expiry"]:
+            logging.error("Leader lease expired, shutting down")
             os._exit(1)
         return
 
-    current_leader_id = leader_info.split(":")[0]
-    if current_leader_id != args.node_id:
-        logging.info(f"Another node ({current_leader_id}) is now leader, shutting down")
+    if term != context.bot_data["leader_term"]:
+        logging.info("Another node is now leader, shutting down")
         os._exit(0)
 
-    # Update our heartbeat
-    if not update_leader(context.bot_data["db"]):
-        logging.error("Failed to update heartbeat, shutting down")
 
-        os._exit(1)
+def save_violations_cursor(bot_data):
+    """Store violations_job's progress in rqlite, so whichever replica leads next can carry on from it rather than scanning every node again"""
+    checkpoint = bot_data.get("violations_checkpoint")
+    if not checkpoint or checkpoint == bot_data.get("saved_violations_checkpoint"):
+        return
+    cursor = {
+        "checkpoint": checkpoint,
+        "deadlines": sorted(bot_data.get("boot_deadlines", set())),
+        "nodes": sorted(bot_data.get("violations_nodes", set())),
+        "retries": sorted(bot_data.get("violations_retries", {}).items()),
+    }
+    try:
+        if bot_data["db"].set_metadata_if_leader(
+            "violations_cursor",
+            json.dumps(cursor),
+            args.node_id,
+            bot_data["leader_term"],
+        ):
+            bot_data["saved_violations_checkpoint"] = checkpoint
+    except:
+        logging.exception("Failed to save violations cursor")
+
+
+def load_violations_cursor(bot_data):
+    """Pick up violations_job's progress from the previous leader, see save_violations_cursor"""
+    try:
+        value = bot_data["db"].get_metadata("violations_cursor")
+    except:
+        logging.exception("Failed to load violations cursor")
+        return
+    if not value:
+        return
+    cursor = json.loads(value)
+    bot_data["violations_checkpoint"] = tuple(cursor["checkpoint"])
+    bot_data["boot_deadlines"] = {tuple(deadline) for deadline in cursor["deadlines"]}
+    bot_data["violations_nodes"] = set(cursor["nodes"])
+    bot_data["violations_retries"] = dict(cursor.get("retries", []))
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument("token", help="Specify a bot token")
 parser.add_argument("--rqlite-host", help="Rqlite host", default="localhost")
 parser.add_argument("--rqlite-port", help="Rqlite port", type=int, default=4001)
+parser.add_argument(
+    "--rqlite-client",
+    help="Client for rqlite: pyrqlite, or http for the pooled client that sends related statements in one request",
+    choices=["pyrqlite", "http"],
+    default="pyrqlite",
+)
 parser.add_argument("-v", "--verbose", help="Verbose output", action="store_true")
 parser.add_argument(
     "-p", "--poll", help="Set polling frequency in seconds", type=int, default=60
 )
+parser.add_argument(
+    "--violations-poll",
+    help="How often to check the ingester's change log for new violations, in seconds",
+    type=int,
+    default=10,
+)
 parser.add_argument("-t", "--test", help="Enable test feature", action="store_true")
 parser.add_argument(
     "-f", "--db_file", help="Specify file for sqlite db", type=str, default="tfchain.db"
@@ -852,33 +1615,125 @@ parser.add_argument(
 )
 parser.add_argument(
     "--heartbeat-interval",
-    help="Heartbeat interval in seconds",
-    type=int,
+    help="Leader heartbeat interval in seconds. The lease lasts three intervals, which is how long a crashed leader takes to replace",
+    type=float,
     default=DEFAULT_HEARTBEAT_INTERVAL,
 )
+parser.add_argument(
+    "--metrics-port",
+    help="Port to serve Prometheus metrics on",
+    type=int,
+    default=8001,
+)
+parser.add_argument(
+    "--webhook-url",
+    help="Receive updates from Telegram by webhook at this public URL, rather than by polling. The URL must lead to --webhook-port, for example through a reverse proxy that handles TLS",
+)
+parser.add_argument(
+    "--webhook-listen", help="Address to serve the webhook on", default="0.0.0.0"
+)
+parser.add_argument(
+    "--webhook-port", help="Port to serve the webhook on", type=int, default=8443
+)
+parser.add_argument(
+    "--workers",
+    help="Threads handling commands. Commands from the same chat are handled in order, one at a time",
+    type=int,
+    default=DEFAULT_WORKERS,
+)
+parser.add_argument(
+    "--max-queue",
+    help="Commands that can wait for a worker. Beyond this, the bot answers that it's busy",
+    type=int,
+    default=DEFAULT_MAX_QUEUE,
+)
+parser.add_argument(
+    "--telegram-api",
+    help="Base URL of the Telegram Bot API, for a local Bot API server or a fake one in testing",
+    default="https://api.telegram.org/bot",
+)
 args = parser.parse_args()
 
 # pickler = PicklePersistence(filename='bot_data')
 
 defaults = Defaults(parse_mode=ParseMode.HTML)
-updater = Updater(
-    token=args.token, persistence=None, use_context=True, defaults=defaults
+# Same connection pool sizing as the Updater uses by default, plus a connection for each update worker and one for the outbox
+bot = ExtBot(
+    args.token,
+    base_url=args.telegram_api,
+    defaults=defaults,
+    request=Request(con_pool_size=args.workers + 5),
+)
+# Jobs and commands each get their own lane of workers, see lanes.py. Commands are handled in the interactive lane, see chat_dispatcher.py
+heartbeat_lane = Lane("heartbeat", HEARTBEAT_WORKERS)
+interactive_lane = Lane("interactive", args.workers, args.max_queue)
+background_lane = Lane("background", BACKGROUND_WORKERS)
+job_queue = JobQueue()
+dispatcher = ChatDispatcher(
+    bot,
+    queue.Queue(),
+    job_queue=job_queue,
+    lane=interactive_lane,
+    on_busy=reply_busy,
+)
+job_queue.set_dispatcher(dispatcher)
+# After set_dispatcher, which reconfigures the scheduler and drops any executors added before
+job_queue.scheduler.add_executor(LaneExecutor(heartbeat_lane), "heartbeat")
+job_queue.scheduler.add_executor(LaneExecutor(background_lane), "background")
+updater = Updater(dispatcher=dispatcher, workers=None)
+
+# All messages go through the outbox, which sends them from its own thread within Telegram's rate limits
+outbox = Outbox(updater.bot, split_message, MAX_TEXT_LENGTH)
+prometheus_client.start_http_server(args.metrics_port)
+
+mainnet_gql = grid3.graphql.GraphQL(
+    "https://graphql.grid.tf/graphql", fetch_schema=False
+)
+testnet_gql = grid3.graphql.GraphQL(
+    "https://graphql.test.grid.tf/graphql", fetch_schema=False
+)
+devnet_gql = grid3.graphql.GraphQL(
+    "https://graphql.dev.grid.tf/graphql", fetch_schema=False
 )
-
-dispatcher = updater.dispatcher
-
-mainnet_gql = grid3.graphql.GraphQL("https://graphql.grid.tf/graphql")
-testnet_gql = grid3.graphql.GraphQL("https://graphql.test.grid.tf/graphql")
-devnet_gql = grid3.graphql.GraphQL("https://graphql.dev.grid.tf/graphql")
 
 graphqls = {"main": mainnet_gql, "test": testnet_gql, "dev": devnet_gql}
+schema_lock = threading.Lock()
+
+# One thread per network, so check_job can query all networks at once, plus a pool for the chunks of large queries. Every thread uses its own GraphQL clients, see get_graphql
+gql_executor = ThreadPoolExecutor(max_workers=len(NETWORKS))
+gql_chunk_executor = ThreadPoolExecutor(max_workers=GQL_CHUNK_WORKERS)
+gql_clients = threading.local()
+
+# The nodes last fetched by poll_nodes for each network, along with the newest updatedAt seen and the time of the last full poll
+poll_states = {}
+poll_lock = threading.Lock()
+# Read only connections to the ingester's database, shared by the jobs and commands
+tfchain_pool = ConnectionPool(args.db_file)
+# Violation scans requested by commands run here rather than in the dispatcher thread, a few at a time. Results are cached by (node, period, checkpoint time), see scan_violations
+scan_executor = Lane("scans", SCAN_WORKERS, MAX_SCAN_QUEUE)
+scan_cache = cachetools.LRUCache(SCAN_CACHE_SIZE)
+scan_cache_lock = threading.Lock()
+# Node data shared by all commands, fed by check_job's polls. The fetch looks up get_nodes when called, so test mode's replacement is used
+node_lookup = NodeLookupCache(lambda net, node_ids: get_nodes(net, node_ids))
+# Which nodes are in each farm, for expanding farm subscriptions
+farm_index = FarmIndex(lambda net, farm_ids: get_farm_nodes(net, farm_ids))
+
+# Deadlines of the next time based status change for each (net, node_id), see status_job
+status_scheduler = DeadlineScheduler()
+# check_updates is called by both check_job and status_job, which may run at the same time. Running one at a time avoids alerting twice for the same change
+alert_lock = threading.Lock()
+# How many runs of each job were skipped because they overran
+job_overruns = collections.Counter()
+
+# Fetch the schemas before logging is set up, so they don't dump on console when verbose. A network that's unavailable now gets its schema fetched by the first query instead, see get_schema
+for schema_net in graphqls:
+    try:
+        get_schema(schema_net)
+    except Exception:
+        pass
 
 if args.verbose:
     log_level = logging.INFO
-
-    # Force fetching the schemas when verbose so they don't dump on console
-    for gql in graphqls.values():
-        gql.fetch_schema()
 else:
     log_level = logging.WARNING
 
@@ -907,9 +1762,8 @@ dispatcher.add_handler(CommandHandler("unsub", unsubscribe))
 dispatcher.add_handler(CommandHandler("violations", violations))
 
 if args.test:
-    import json
-
     get_nodes = get_nodes_from_file
+    get_farm_nodes = get_farm_nodes_from_file
 
 initialize_dbs(dispatcher.bot_data)
 
@@ -920,6 +1774,25 @@ while True:
     except ConnectionRefusedError:
         time.sleep(DB_RETRY_WAIT)
 
+# Every replica checks the nodes in its shard, so the node states and the jobs that poll nodes start before leader election. Sending alerts doesn't need us to be polling Telegram
+dispatcher.bot_data["node_cache"] = NodeStateCache(db, NETWORKS)
+dispatcher.bot_data["node_cache"].load()
+dispatcher.bot_data["ring"] = HashRing([args.node_id])
+dispatcher.bot_data["liveness"] = Liveness(REPLICA_TIMEOUT)
+membership_job(CallbackContext(dispatcher))
+
+updater.job_queue.scheduler.add_listener(report_overrun, EVENT_JOB_MAX_INSTANCES)
+updater.job_queue.run_repeating(
+    membership_job, interval=MEMBERSHIP_INTERVAL, job_kwargs=HEARTBEAT_JOB
+)
+updater.job_queue.run_repeating(
+    check_job, interval=args.poll, first=1, job_kwargs=BACKGROUND_JOB
+)
+updater.job_queue.run_repeating(
+    status_job, interval=STATUS_TICK, first=1, job_kwargs=BACKGROUND_JOB
+)
+updater.job_queue.start()
+
 # Add random jitter before proceeding with leader logic. If all nodes start
 # simultaneously, they might all try setting themselves as the leader and
 # proceeding to connect to Telegram. While eventually one will prevail, that
@@ -927,23 +1800,50 @@ while True:
 initial_jitter = random.uniform(0, JITTER_TIME)
 time.sleep(initial_jitter)
 
+# Followers are already doing their share of alerts and keep their node states warm, so all that's left to do on taking over is load the violations cursor and start polling Telegram
 while True:
-    leader_info = get_leader(db)
-
-    if not leader_info or not is_leader_valid(leader_info):
-        # Try to become leader
-        if update_leader(db):
-            break
-
-    # Wait and check again
-    time.sleep(args.heartbeat_interval)
+    try:
+        term = acquire_lease(db)
+    except:
+        logging.exception("Failed to check leader lease")
+        term = None
+    if term is not None:
+        break
+    time.sleep(args.heartbeat_interval / LEASE_POLLS_PER_INTERVAL)
 
+dispatcher.bot_data["leader_term"] = term
+# Chat settings may have changed under another leader since we cached them
+db.clear_cache()
 # We're now the leader
-logging.info(f"Node {args.node_id} is now the leader")
+logging.info(f"Node {args.node_id} is now the leader (term {term})")
 # Flush the logs so we can always see leader changes immediately
 for handler in logging.getLogger().handlers:
     handler.flush()
 
+updater.job_queue.run_repeating(
+    heartbeat_job, interval=args.heartbeat_interval, job_kwargs=HEARTBEAT_JOB
+)
+load_violations_cursor(dispatcher.bot_data)
+populate_violations(dispatcher.bot_data)
+updater.job_queue.run_repeating(
+    violations_job,
+    interval=args.violations_poll,
+    first=1,
+    job_kwargs=BACKGROUND_JOB,
+)
+if args.webhook_url:
+    # Anyone who knows the path can send us updates, so use one that can't be guessed without the token
+    webhook_path = hashlib.sha256(args.token.encode()).hexdigest()
+    updater.start_webhook(
+        listen=args.webhook_listen,
+        port=args.webhook_port,
+        url_path=webhook_path,
+        webhook_url=args.webhook_url.rstrip("/") + "/" + webhook_path,
+    )
+else:
+    updater.start_polling()
+
+# Setting the commands takes a couple of requests to Telegram, which can wait until we're up and running
 updater.bot.delete_my_commands()
 updater.bot.set_my_commands(
     [
@@ -968,9 +1868,5 @@ updater.bot.set_my_commands(
     ]
 )
 
-populate_violations(dispatcher.bot_data)
-updater.job_queue.run_repeating(check_job, interval=args.poll, first=1)
-updater.job_queue.run_repeating(heartbeat_job, interval=args.heartbeat_interval)
-
-updater.start_polling()
 updater.idle()
+release_lease(db, term)
@@ -0,0 +1,149 @@
+"""
+Process wide cache of node data from GraphQL, keyed by (network, node id). Commands like /status and /subscribe look nodes up here instead of querying GraphQL every time, and check_job feeds the cache with the results of its own polls, so popular nodes are usually served from memory.
+
+When several threads miss on the same node at once, only one of them fetches it and the others wait for that result (single-flight), so a burst of requests for one node turns into a single query.
+
+The farm index does the same for farm membership, which is how farm subscriptions are expanded to nodes.
+"""
+
+import logging
+import threading
+
+import cachetools
+import prometheus_client
+
+# Entries older than this are fetched again. It should be longer than the check_job poll interval, so nodes that are polled anyway don't expire in between
+DEFAULT_TTL = 180
+MAX_ENTRIES = 100000
+# Farms gain and lose nodes rarely, so their membership is only fetched again after this long
+FARM_TTL = 60 * 10
+
+cache_hits = prometheus_client.Counter(
+    "node_lookup_hits", "Node lookups served from the cache"
+)
+cache_misses = prometheus_client.Counter(
+    "node_lookup_misses", "Node lookups that had to query GraphQL"
+)
+cache_coalesced = prometheus_client.Counter(
+    "node_lookup_coalesced",
+    "Node lookups that missed but waited for another thread's query of the same node",
+)
+
+
+class Flight:
+    """A query in progress that other threads can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class NodeLookupCache:
+    def __init__(self, fetch, ttl=DEFAULT_TTL):
+        """The fetch function takes a network and a list of node ids and returns a list of Node objects, leaving out any that don't exist"""
+        self.fetch = fetch
+        self.entries = cachetools.TTLCache(MAX_ENTRIES, ttl)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def put(self, net, nodes):
+        """Store fresh data for the nodes, restarting their TTL"""
+        with self.lock:
+            for node in nodes:
+                self.entries[(net, node.nodeId)] = node
+
+    def get(self, net, node_ids):
+        """Return the Node objects for the ids that exist, in the order given. The objects are shared, so callers shouldn't modify them"""
+        node_ids = [int(node_id) for node_id in node_ids]
+        found = {}
+        to_fetch = []
+        to_wait = []
+        with self.lock:
+            for node_id in dict.fromkeys(node_ids):
+                key = (net, node_id)
+                node = self.entries.get(key)
+                if node is not None:
+                    found[node_id] = node
+                    cache_hits.inc()
+                elif key in self.in_flight:
+                    to_wait.append((node_id, self.in_flight[key]))
+                    cache_coalesced.inc()
+                else:
+                    self.in_flight[key] = Flight()
+                    to_fetch.append(node_id)
+                    cache_misses.inc()
+
+        if to_fetch:
+            error = None
+            try:
+                nodes = self.fetch(net, to_fetch)
+                self.put(net, nodes)
+                for node in nodes:
+                    found[node.nodeId] = node
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                # Release the waiters even if the query failed, passing them the error
+                with self.lock:
+                    for node_id in to_fetch:
+                        flight = self.in_flight.pop((net, node_id))
+                        flight.error = error
+                        flight.done.set()
+
+        for node_id, flight in to_wait:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            with self.lock:
+                node = self.entries.get((net, node_id))
+            if node is not None:
+                found[node_id] = node
+
+        return [found[node_id] for node_id in node_ids if node_id in found]
+
+
+class FarmIndex:
+    def __init__(self, fetch, ttl=FARM_TTL):
+        """The fetch function takes a network and a list of farm ids and returns {farm_id: [node_id, ...]}, leaving out farms without nodes"""
+        self.fetch = fetch
+        self.entries = cachetools.TTLCache(MAX_ENTRIES, ttl)
+        # The last membership fetched for every farm, expired or not, for when GraphQL is unavailable
+        self.last_known = {}
+        self.lock = threading.Lock()
+
+    def get(self, net, farm_ids, stale_ok=False):
+        """Return the node ids of each farm as {farm_id: (node_id, ...)}. Farms that aren't cached or have expired are fetched together in one query. If that fails and stale_ok is set, the last membership we had is used instead, and farms we never had are left out"""
+        farm_ids = [int(farm_id) for farm_id in farm_ids]
+        found = {}
+        missing = []
+        with self.lock:
+            for farm_id in dict.fromkeys(farm_ids):
+                nodes = self.entries.get((net, farm_id))
+                if nodes is None:
+                    missing.append(farm_id)
+                else:
+                    found[farm_id] = nodes
+
+        if missing:
+            try:
+                fetched = self.fetch(net, missing)
+            except:
+                if not stale_ok:
+                    raise
+                logging.exception("Error fetching farm nodes, using last known")
+                with self.lock:
+                    for farm_id in missing:
+                        if (net, farm_id) in self.last_known:
+                            found[farm_id] = self.last_known[(net, farm_id)]
+                return found
+
+            with self.lock:
+                for farm_id in missing:
+                    # Farms without nodes are cached too, so they aren't fetched on every call
+                    nodes = tuple(sorted(fetched.get(farm_id, ())))
+                    self.entries[(net, farm_id)] = nodes
+                    self.last_known[(net, farm_id)] = nodes
+                    found[farm_id] = nodes
+
+        return found
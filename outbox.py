@@ -0,0 +1,281 @@
+"""
+Outbound message queue for the bot. Sending directly from the jobs means a mass event, like a whole farm going offline, blocks the job while it sends one message per node per chat, and quickly runs into Telegram's flood limits. Instead, messages are queued here and sent by a few background threads that:
+
+* Respect Telegram's rate limits with token buckets, one global and one per chat (group chats get a lower rate, as Telegram allows them fewer messages per minute)
+* Merge alerts for the same chat that arrive within a short window into one message, splitting it again only if it gets too long
+* Send replies to commands ahead of alerts, so a flood of alerts to other chats doesn't hold up someone waiting on a command
+* Wait and retry when Telegram answers with RetryAfter
+* Keep the messages of each chat in order, by only sending one message to a chat at a time
+
+Queue depth and the time from queueing to delivery are exported as Prometheus metrics. Alerts can also carry the time of the event that caused them, like the block time of a boot request or a node's last uptime report, in which case the time from that event until the alert was queued (detection) and until Telegram accepted it (delivery) are exported for each type of alert.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import prometheus_client
+import telegram
+
+# Telegram allows about 30 messages per second overall, one per second to the same chat (with short bursts), and 20 per minute to the same group
+GLOBAL_RATE = 25
+CHAT_RATE = 1
+CHAT_BURST = 3
+GROUP_RATE = 20 / 60
+# How long to hold an alert for more alerts to the same chat to arrive, which are then sent as one message
+BATCH_WINDOW = 2
+# Batched alerts are joined with two blank lines, which is also where split_message splits long messages
+SEPARATOR = "\n\n\n"
+# How many times to try sending a message that fails for reasons other than flood control
+MAX_ATTEMPTS = 3
+RETRY_WAIT = 5
+# Threads sending messages. Each send waits for Telegram to answer, so one thread alone can't keep up with the global rate
+SENDERS = 4
+# How often to drop the rate limits of chats we haven't sent to lately. Once a chat's bucket has refilled, it's no different from a new one
+PRUNE_INTERVAL = 60
+
+queue_depth = prometheus_client.Gauge(
+    "outbox_queue_depth", "Messages waiting in the outbound queue"
+)
+delivery_latency = prometheus_client.Histogram(
+    "outbox_delivery_seconds",
+    "Time from queueing a message to Telegram accepting it",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+messages_sent = prometheus_client.Counter(
+    "outbox_messages_sent", "Messages delivered to Telegram"
+)
+alerts_batched = prometheus_client.Counter(
+    "outbox_alerts_batched", "Alerts that were merged into another message"
+)
+messages_dropped = prometheus_client.Counter(
+    "outbox_messages_dropped", "Messages given up on after errors or blocked chats"
+)
+retry_afters = prometheus_client.Counter(
+    "outbox_retry_after", "Times Telegram asked us to slow down"
+)
+# Detecting some alerts takes up to a poll interval or more behind the ingester, so these go up to hours
+ALERT_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 21600)
+alert_detection = prometheus_client.Histogram(
+    "alert_detection_seconds",
+    "Time from the event behind an alert until the alert was queued",
+    ["type"],
+    buckets=ALERT_BUCKETS,
+)
+alert_delivery = prometheus_client.Histogram(
+    "alert_delivery_seconds",
+    "Time from the event behind an alert until Telegram accepted it",
+    ["type"],
+    buckets=ALERT_BUCKETS,
+)
+
+# Failed messages are retried no earlier than retry_at. Alert is set for messages queued with batch, and stays set once they are merged. Sources are the (alert type, event time) of the alerts in the message, for the alert latency metrics
+Message = collections.namedtuple(
+    "Message", "text, queued_at, batch, alert, attempts, retry_at, sources"
+)
+
+
+class TokenBucket:
+    """Allows rate actions per second on average, with bursts of up to capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now):
+        """When the next token will be available"""
+        self.refill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    def idle(self, now):
+        """Whether the bucket has refilled completely"""
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class Outbox:
+    def __init__(self, bot, split, max_length):
+        self.bot = bot
+        self.split = split
+        self.max_length = max_length
+
+        self.chats = collections.OrderedDict()
+        self.chat_buckets = {}
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.paused_until = 0
+        self.size = 0
+        # Chats with a message being sent right now
+        self.sending = set()
+        self.pruned_at = time.monotonic()
+        self.condition = threading.Condition()
+
+        self.threads = [
+            threading.Thread(target=self.run, daemon=True) for _ in range(SENDERS)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def send(self, chat_id, text, batch=False, source=None):
+        """Queue a message for the chat. Messages with batch set are alerts, which may be held for up to BATCH_WINDOW seconds and merged with other alerts to the same chat. The source of an alert is its type and the unix time of the event that caused it"""
+        sources = ()
+        if source is not None:
+            alert_type, event_time = source
+            alert_detection.labels(alert_type).observe(max(0, time.time() - event_time))
+            sources = (source,)
+        with self.condition:
+            self.chats.setdefault(chat_id, collections.deque()).append(
+                Message(text, time.monotonic(), batch, batch, 0, 0, sources)
+            )
+            self.size += 1
+            queue_depth.set(self.size)
+            self.condition.notify()
+
+    def set_replicas(self, count):
+        """Share the global rate limit with other bot replicas sending at the same time, since the limit applies to the bot token"""
+        with self.condition:
+            self.global_bucket.rate = GLOBAL_RATE / count
+            self.global_bucket.capacity = max(1, GLOBAL_RATE // count)
+
+    def chat_bucket(self, chat_id):
+        if chat_id not in self.chat_buckets:
+            if chat_id < 0:
+                self.chat_buckets[chat_id] = TokenBucket(GROUP_RATE, 1)
+            else:
+                self.chat_buckets[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+        return self.chat_buckets[chat_id]
+
+    def prune_buckets(self, now):
+        """Forget the rate limits of chats without queued messages whose buckets have refilled, so they don't pile up for every chat we ever sent to"""
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if chat_id not in self.chats and bucket.idle(now):
+                del self.chat_buckets[chat_id]
+        self.pruned_at = now
+
+    def next_ready(self, now):
+        """Find the chat that should be sent to next. Of the chats that are ready now, those waiting on a reply go first, otherwise it's the chat that will be ready first. Chats already being sent to are skipped. Returns (chat_id, time it's ready)"""
+        best = None, None
+        best_key = None
+        for chat_id, messages in self.chats.items():
+            if chat_id in self.sending:
+                continue
+            first = messages[0]
+            ready = first.queued_at + BATCH_WINDOW if first.batch else first.queued_at
+            ready = max(ready, first.retry_at, self.chat_bucket(chat_id).ready_at(now))
+            key = ready > now, first.alert, ready
+            if best_key is None or key < best_key:
+                best, best_key = (chat_id, ready), key
+        if best[0] is not None:
+            best = best[0], max(
+                best[1], self.global_bucket.ready_at(now), self.paused_until
+            )
+        return best
+
+    def take_message(self, chat_id):
+        """Remove the next message for the chat from the queue. Alerts are merged with any alerts queued right after them, and anything too long is split, with the remaining parts put back at the front of the queue"""
+        messages = self.chats[chat_id]
+        message = messages.popleft()
+        self.size -= 1
+        if message.batch:
+            parts = [message.text]
+            sources = list(message.sources)
+            while messages and messages[0].batch:
+                merged = messages.popleft()
+                parts.append(merged.text)
+                sources.extend(merged.sources)
+                self.size -= 1
+            alerts_batched.inc(len(parts) - 1)
+            message = message._replace(
+                text=SEPARATOR.join(parts), batch=False, sources=tuple(sources)
+            )
+
+        if len(message.text) > self.max_length:
+            texts = self.split(message.text)
+            # The alerts in the message count as delivered with its last part
+            parts = [message._replace(text=text, sources=()) for text in texts]
+            parts[-1] = parts[-1]._replace(sources=message.sources)
+            message = parts[0]
+            for part in reversed(parts[1:]):
+                messages.appendleft(part)
+                self.size += 1
+
+        if not messages:
+            del self.chats[chat_id]
+        queue_depth.set(self.size)
+        return message
+
+    def requeue(self, chat_id, message):
+        """Put a message that failed to send back at the front of its chat's queue"""
+        with self.condition:
+            self.chats.setdefault(chat_id, collections.deque()).appendleft(message)
+            self.chats.move_to_end(chat_id, last=False)
+            self.size += 1
+            queue_depth.set(self.size)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    if now - self.pruned_at > PRUNE_INTERVAL:
+                        self.prune_buckets(now)
+                    chat_id, ready = self.next_ready(now)
+                    if chat_id is not None and ready <= now:
+                        break
+                    self.condition.wait(None if chat_id is None else ready - now)
+
+                message = self.take_message(chat_id)
+                self.chat_bucket(chat_id).take(now)
+                self.global_bucket.take(now)
+                self.sending.add(chat_id)
+
+            try:
+                self.deliver(chat_id, message)
+            finally:
+                with self.condition:
+                    self.sending.discard(chat_id)
+                    self.condition.notify_all()
+
+    def deliver(self, chat_id, message):
+        try:
+            self.bot.send_message(chat_id=chat_id, text=message.text)
+            messages_sent.inc()
+            delivery_latency.observe(time.monotonic() - message.queued_at)
+            for alert_type, event_time in message.sources:
+                alert_delivery.labels(alert_type).observe(time.time() - event_time)
+        except telegram.error.RetryAfter as e:
+            # Flood control applies to the whole bot, so hold back every chat, not just this one
+            retry_afters.inc()
+            logging.warning("Telegram asked to retry after %s seconds", e.retry_after)
+            with self.condition:
+                self.paused_until = max(
+                    self.paused_until, time.monotonic() + e.retry_after
+                )
+            self.requeue(chat_id, message)
+        except telegram.error.Unauthorized:
+            # User blocked the bot or deleted their account
+            messages_dropped.inc()
+        except:
+            if message.attempts + 1 >= MAX_ATTEMPTS:
+                logging.exception("Error sending message")
+                messages_dropped.inc()
+            else:
+                self.requeue(
+                    chat_id,
+                    message._replace(
+                        attempts=message.attempts + 1,
+                        retry_at=time.monotonic() + RETRY_WAIT,
+                    ),
+                )
@@ -0,0 +1,101 @@
+"""
+Splitting long reports into pages that fit in a Telegram message. Reports like /status for thousands of nodes are rendered as a stream of sections (a node's violations, a list of nodes in one state, and so on), and paginate packs them into pages:
+
+* Sections are kept whole on one page where they fit, otherwise they are split between lines, and lines that are too long by themselves (like a list of node ids on one line) are split between words
+* Each page is yielded as soon as it's full, so it can be sent while the rest of the report is still being rendered
+* HTML tags that are open where a page ends are closed at the end of it and opened again at the start of the next one, so Telegram can parse every page
+
+Each section is only looked at a fixed number of times, so rendering takes time in proportion to the size of the report, however many pages it makes.
+"""
+
+import re
+
+# Room kept free on each page for closing the tags open at its end and opening them again on the next page. The bot's reports never nest more than a couple of tags, which takes far less than this
+TAG_RESERVE = 100
+
+TAG = re.compile(r"<(/?)([a-zA-Z-]+)[^>]*>")
+
+
+def update_tags(open_tags, text):
+    """Follow the tags opened and closed in the text, given the (name, opening tag) pairs open before it"""
+    for match in TAG.finditer(text):
+        closing, name = match.groups()
+        if not closing:
+            open_tags.append((name, match.group(0)))
+            continue
+        for i in range(len(open_tags) - 1, -1, -1):
+            if open_tags[i][0] == name:
+                del open_tags[i]
+                break
+
+
+def closing_tags(open_tags):
+    return "".join("</{}>".format(name) for name, _ in reversed(open_tags))
+
+
+def opening_tags(open_tags):
+    return "".join(tag for _, tag in open_tags)
+
+
+def split_line(line, size):
+    """Split a line into pieces of at most size characters, at the last space before the limit where there is one, and never inside a tag"""
+    start = 0
+    while len(line) - start > size:
+        end = start + size
+        space = line.rfind(" ", start + 1, end)
+        if space != -1:
+            end = space + 1
+        tag_start = line.rfind("<", start, end)
+        if tag_start != -1 and line.find(">", tag_start, end) == -1:
+            if tag_start > start:
+                end = tag_start
+            else:
+                # The tag is longer than size by itself, so it's kept whole on a piece of its own
+                end = line.find(">", tag_start) + 1 or len(line)
+        yield line[start:end]
+        start = end
+    yield line[start:]
+
+
+def pieces(section, size):
+    """The section itself if it fits in size, otherwise its lines, split further where needed"""
+    if len(section) <= size:
+        yield section
+        return
+    for line in section.splitlines(True):
+        if len(line) <= size:
+            yield line
+        else:
+            yield from split_line(line, size)
+
+
+def paginate(sections, limit):
+    """Pack sections of text into pages of at most limit characters, yielding each page when it's full. Trailing newlines are left off and empty pages are skipped. Tags are never split, so a limit far below Telegram's can be exceeded"""
+    page = []
+    length = 0
+    open_tags = []
+
+    def finish():
+        text = "".join(page).rstrip("\n")
+        if text and TAG.sub("", text).strip():
+            return text + closing_tags(open_tags)
+        return None
+
+    size = limit - min(TAG_RESERVE, limit // 2)
+    for section in sections:
+        for piece in pieces(section, size):
+            tags_after = list(open_tags)
+            update_tags(tags_after, piece)
+            if page and length + len(piece) + len(closing_tags(tags_after)) > limit:
+                text = finish()
+                if text:
+                    yield text
+                page = [opening_tags(open_tags)]
+                length = len(page[0])
+            page.append(piece)
+            length += len(piece)
+            open_tags = tags_after
+
+    text = finish()
+    if text:
+        yield text
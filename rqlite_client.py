@@ -0,0 +1,147 @@
+"""
+A small rqlite client built on the unified /db/request endpoint, as an alternative to pyrqlite for RqliteDB. Compared to pyrqlite it:
+
+* Sends any number of statements, reads and writes, in one HTTP request
+* Keeps a pool of HTTP connections alive and is safe to use from many threads at once, where pyrqlite shares one connection
+* Takes the read consistency level per request, so hot path reads can use "none" while the leader key uses "strong"
+* Passes parameters to rqlite as they are, rather than substituting them into the SQL
+"""
+
+import http.client
+import json
+import queue
+import select
+import threading
+import urllib.parse
+
+POOL_SIZE = 8
+TIMEOUT = 30
+MAX_REDIRECTS = 5
+
+
+class RqliteError(Exception):
+    pass
+
+
+class RqliteClient:
+    def __init__(self, host="localhost", port=4001, pool_size=POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def get_connection(self):
+        try:
+            return reopen_if_closed(self.idle.get_nowait())
+        except queue.Empty:
+            with self.lock:
+                room = self.opened < self.pool_size
+                if room:
+                    self.opened += 1
+            if room:
+                return http.client.HTTPConnection(self.host, self.port, timeout=TIMEOUT)
+            return reopen_if_closed(self.idle.get())
+
+    def post(self, path, body):
+        """POST to the node we're connected to, following redirects to the leader. Returns the decoded JSON response"""
+        con = self.get_connection()
+        try:
+            target = con
+            for _ in range(MAX_REDIRECTS):
+                send(target, path, body)
+                response = target.getresponse()
+                data = response.read()
+
+                if response.status in (301, 302, 307, 308):
+                    location = urllib.parse.urlparse(response.getheader("Location"))
+                    if target is not con:
+                        target.close()
+                    target = http.client.HTTPConnection(
+                        location.hostname, location.port, timeout=TIMEOUT
+                    )
+                    path = location.path + "?" + location.query
+                    continue
+                if response.status != 200:
+                    raise RqliteError(
+                        "Unexpected HTTP status {}: {}".format(response.status, data)
+                    )
+                return json.loads(data)
+            raise RqliteError("Too many redirects")
+        except:
+            # Don't put a connection back in the pool in the middle of a response
+            con.close()
+            raise
+        finally:
+            if target is not con:
+                target.close()
+            self.idle.put(con)
+
+    def request(self, statements, level=None, transaction=False):
+        """
+        Run a list of (sql, params) statements in one HTTP request, returning a list with the result of each. Queries give their rows as a list of lists, other statements give the number of rows affected. Raises RqliteError if any statement failed
+        """
+        if not statements:
+            return []
+        query = {}
+        if level:
+            query["level"] = level
+        path = "/db/request?" + urllib.parse.urlencode(query)
+        if transaction:
+            path += "&transaction"
+        body = json.dumps(
+            [[sql] + [adapt(p) for p in params] for sql, params in statements]
+        )
+
+        results = []
+        for result in self.post(path, body).get("results", []):
+            if "error" in result:
+                raise RqliteError(result["error"])
+            if "columns" in result:
+                results.append(result.get("values", []))
+            else:
+                results.append(result.get("rows_affected", 0))
+        return results
+
+    def query(self, sql, params=(), level=None):
+        """Run one query and return its rows"""
+        return self.request([(sql, params)], level)[0]
+
+    def execute(self, sql, params=()):
+        """Run one statement and return the number of rows affected"""
+        return self.request([(sql, params)])[0]
+
+    def executemany(self, sql, seq_of_params):
+        """Run a statement once for each set of parameters, all in one request and transaction"""
+        return self.request(
+            [(sql, params) for params in seq_of_params], transaction=True
+        )
+
+
+def reopen_if_closed(con):
+    """Close a pooled connection if the server has closed its end while it was idle, so the next request opens a new one. The server has nothing to send on an idle keep alive connection, so if it shows as readable, it's at end of file"""
+    if con.sock is not None and select.select([con.sock], [], [], 0)[0]:
+        con.close()
+    return con
+
+
+def send(con, path, body):
+    """
+    Send a POST request on the connection. If sending fails on a connection that was already open, the server can't have received the whole request, so it's sent once more on a fresh connection. This is the only time a request is retried: once it's sent, the server may have run it even if we never see the response, and running a write twice could apply it twice.
+    """
+    reused = con.sock is not None
+    try:
+        con.request("POST", path, body, {"Content-Type": "application/json"})
+    except (http.client.HTTPException, OSError):
+        if not reused:
+            raise
+        con.close()
+        con.request("POST", path, body, {"Content-Type": "application/json"})
+
+
+def adapt(value):
+    """SQLite stores booleans as integers, so send them that way"""
+    if isinstance(value, bool):
+        return int(value)
+    return value
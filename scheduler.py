@@ -0,0 +1,56 @@
+"""
+A min-heap of deadlines, used by the bot to evaluate each node's status at the exact moment it could change. Node status transitions that happen just because time passes (like an up node being considered down one hour after its last uptime report) are known in advance, so rather than checking every node on every poll, we schedule a deadline for each node and only look at the nodes whose deadline has arrived.
+"""
+
+import heapq
+import threading
+
+# The heap keeps old entries for rescheduled keys until they're popped. When it grows this many times larger than the number of live deadlines, it's rebuilt
+COMPACT_FACTOR = 4
+
+
+class DeadlineScheduler:
+    """Keeps at most one pending deadline per key. Scheduling a key again replaces its deadline. Old heap entries are left in place and skipped when they come up, which keeps rescheduling at O(log n)"""
+
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, deadline):
+        """Set the deadline for the key, or cancel it if deadline is None"""
+        with self.lock:
+            if deadline is None:
+                self.deadlines.pop(key, None)
+                return
+            if self.deadlines.get(key) == deadline:
+                return
+            self.deadlines[key] = deadline
+            heapq.heappush(self.heap, (deadline, key))
+            if len(self.heap) > COMPACT_FACTOR * max(len(self.deadlines), 64):
+                self.heap = [(d, k) for k, d in self.deadlines.items()]
+                heapq.heapify(self.heap)
+
+    def cancel(self, key):
+        self.schedule(key, None)
+
+    def pop_due(self, now):
+        """Remove and return all keys with a deadline at or before now, earliest first"""
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, key = heapq.heappop(self.heap)
+                if self.deadlines.get(key) == deadline:
+                    del self.deadlines[key]
+                    due.append(key)
+        return due
+
+    def next_deadline(self):
+        """The earliest pending deadline, or None if nothing is scheduled"""
+        with self.lock:
+            while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            return self.heap[0][0] if self.heap else None
@@ -0,0 +1,75 @@
+"""
+Consistent hashing of nodes over bot replicas. Every replica running check_job takes the nodes that hash to it, so the work of polling GraphQL and alerting is split between all live replicas rather than done by the leader alone.
+
+Each replica is placed on the ring at many points (virtual nodes) so the shares come out about even. When a replica joins or leaves, only the nodes next to its points change owner, and everyone else keeps theirs, along with the state they've built up for them.
+
+Replicas are members while their heartbeat keeps changing, see Liveness.
+"""
+
+import bisect
+import hashlib
+import time
+
+VIRTUAL_NODES = 100
+
+
+def ring_hash(key):
+    """A hash that's the same in every process, unlike Python's hash for strings"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, members, virtual_nodes=VIRTUAL_NODES):
+        self.members = frozenset(members)
+        points = sorted(
+            (ring_hash("{}#{}".format(member, i)), member)
+            for member in self.members
+            for i in range(virtual_nodes)
+        )
+        self.hashes = [point[0] for point in points]
+        self.owners = [point[1] for point in points]
+
+    def owner(self, network, node_id):
+        """The member that owns the node, or None if the ring is empty"""
+        if not self.hashes:
+            return None
+        i = bisect.bisect(self.hashes, ring_hash("{}:{}".format(network, node_id)))
+        return self.owners[i % len(self.owners)]
+
+
+class Liveness:
+    """
+    Tells which replicas are alive from their heartbeats, by when each one's heartbeat last changed as seen by this replica's own clock. So the replicas' clocks don't have to agree with each other. A replica seen for the first time counts as alive until it has had the timeout to send another heartbeat
+    """
+
+    def __init__(self, timeout, clock=time.monotonic):
+        self.timeout = timeout
+        self.clock = clock
+        # For each replica, its last heartbeat and when we first saw it
+        self.seen = {}
+
+    def update(self, heartbeats):
+        """Take the heartbeat of every replica, as {replica_id: heartbeat}, and return the set of those that are alive"""
+        now = self.clock()
+        seen = {}
+        for replica_id, heartbeat in heartbeats.items():
+            last = self.seen.get(replica_id)
+            if last is not None and last[0] == heartbeat:
+                seen[replica_id] = last
+            else:
+                seen[replica_id] = (heartbeat, now)
+        self.seen = seen
+        return {
+            replica_id
+            for replica_id, (_, changed) in seen.items()
+            if now - changed <= self.timeout
+        }
+
+    def stale(self, age):
+        """The replicas whose heartbeat hasn't changed for the given number of seconds, as (replica_id, heartbeat) pairs"""
+        now = self.clock()
+        return [
+            (replica_id, heartbeat)
+            for replica_id, (heartbeat, changed) in self.seen.items()
+            if now - changed > age
+        ]
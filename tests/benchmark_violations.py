@@ -0,0 +1,234 @@
+"""
+Benchmark harness for the violation scanning code. For each requested scale, a synthetic database is generated (see generate_tfchain_db.py) and every registered engine is timed scanning all nodes for all generated periods. The results of each engine are checked against the first engine (check_node, the reference implementation), so any engine that doesn't reach the same conclusions as minting would is caught here.
+
+An existing database, like a copy of the production one, can also be benchmarked with --db.
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from grid3.minting.period import Period
+
+import audit
+import find_violations
+from generate_tfchain_db import generate
+from tfchain_db import ConnectionPool
+
+
+def run_check_node(db_file, nodes, periods):
+    con = sqlite3.connect(db_file)
+    results = {}
+    for period in periods:
+        for node in nodes:
+            results[(node, period.offset)] = find_violations.check_node(
+                con, node, period
+            )
+    con.close()
+    return results
+
+
+# The bot scans a few nodes at a time, for each command or changed node. These engines split the work into requests of this many nodes, to compare a new connection per request with the bot's connection pool
+REQUEST_SIZE = 5
+# Pools are kept between runs, as the bot keeps them
+pools = {}
+
+
+def run_requests(get_connection, done, nodes, periods):
+    results = {}
+    for i in range(0, len(nodes), REQUEST_SIZE):
+        con = get_connection()
+        for period in periods:
+            for node in nodes[i : i + REQUEST_SIZE]:
+                results[(node, period.offset)] = find_violations.check_node(
+                    con, node, period
+                )
+        done(con)
+    return results
+
+
+def run_check_node_connect(db_file, nodes, periods):
+    return run_requests(
+        lambda: sqlite3.connect(db_file), lambda con: con.close(), nodes, periods
+    )
+
+
+def run_check_node_pooled(db_file, nodes, periods):
+    pool = pools.setdefault(db_file, ConnectionPool(db_file, size=1))
+    return run_requests(pool.get, pool.put, nodes, periods)
+
+
+def run_batch(engine, db_file, nodes, periods):
+    con = sqlite3.connect(db_file)
+    results = {}
+    for period in periods:
+        for node, violations in engine(con, nodes, period).items():
+            results[(node, period.offset)] = violations
+    con.close()
+    return results
+
+
+def run_check_nodes(db_file, nodes, periods):
+    return run_batch(find_violations.check_nodes, db_file, nodes, periods)
+
+
+def run_scan_nodes(db_file, nodes, periods):
+    def violations(con, nodes, period):
+        results = find_violations.scan_nodes(con, nodes, period)
+        return {node: result.violations for node, result in results.items()}
+
+    return run_batch(violations, db_file, nodes, periods)
+
+
+def run_audit(db_file, nodes, periods, uptime=True):
+    results = audit.audit(
+        db_file, nodes, [p.offset for p in periods], os.cpu_count(), uptime=uptime
+    )
+    return {
+        (node, offset): result.violations
+        for offset, node_results in results.items()
+        for node, result in node_results.items()
+    }
+
+
+def run_audit_no_uptime(db_file, nodes, periods):
+    return run_audit(db_file, nodes, periods, uptime=False)
+
+
+# Engines take a database file, a list of node ids, and a list of periods and
+# return a dict of {(node_id, period_offset): [Violation, ...]}
+ENGINES = {
+    "check_node": run_check_node,
+    "check_node_connect": run_check_node_connect,
+    "check_node_pooled": run_check_node_pooled,
+    "check_nodes": run_check_nodes,
+    "scan_nodes": run_scan_nodes,
+    "audit": run_audit,
+    "audit_no_uptime": run_audit_no_uptime,
+}
+
+
+def all_nodes(db_file):
+    con = sqlite3.connect(db_file)
+    nodes = con.execute("""
+        SELECT node_id FROM PowerState
+        UNION SELECT node_id FROM NodeUptimeReported
+        UNION SELECT node_id FROM PowerTargetChanged
+        UNION SELECT node_id FROM PowerStateChanged
+        """).fetchall()
+    con.close()
+    return sorted(n[0] for n in nodes)
+
+
+def normalize(results):
+    return {
+        key: sorted(
+            (v.boot_requested, v.booted_at, v.finalized, v.end_time) for v in violations
+        )
+        for key, violations in results.items()
+        if violations
+    }
+
+
+def compare(reference, results):
+    reference, results = normalize(reference), normalize(results)
+    return [
+        (key, reference.get(key), results.get(key))
+        for key in sorted(reference.keys() | results.keys())
+        if reference.get(key) != results.get(key)
+    ]
+
+
+def benchmark(db_file, periods, engines, repeat):
+    nodes = all_nodes(db_file)
+    reference = None
+    failed = False
+    for name in engines:
+        timings = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            results = ENGINES[name](db_file, nodes, periods)
+            timings.append(time.perf_counter() - start)
+
+        best = min(timings)
+        violation_count = sum(len(v) for v in results.values())
+        print(
+            f"  {name:<20} {best:>8.3f}s  {len(nodes) * len(periods) / best:>10.0f} scans/s  {violation_count} violations"
+        )
+
+        if reference is None:
+            reference = results
+        else:
+            mismatches = compare(reference, results)
+            if mismatches:
+                failed = True
+                print(
+                    f"    {len(mismatches)} mismatches against {engines[0]}, first few:"
+                )
+                for key, expected, got in mismatches[:5]:
+                    print("     ", key, "expected:", expected, "got:", got)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-s",
+        "--scales",
+        help="Comma separated node counts to generate databases for",
+        default="100,1000,5000",
+    )
+    parser.add_argument(
+        "-p", "--periods", help="Number of periods to generate", type=int, default=2
+    )
+    parser.add_argument(
+        "--db",
+        help="Benchmark an existing database instead of generating ones. Scans the current and previous period",
+    )
+    parser.add_argument(
+        "--engines",
+        help="Comma separated engines to run, the first is used as reference. Available: "
+        + ", ".join(ENGINES),
+        default=",".join(ENGINES),
+    )
+    parser.add_argument(
+        "-r", "--repeat", help="Runs per engine, best is reported", type=int, default=1
+    )
+    parser.add_argument(
+        "--seed", help="Random seed for generation", type=int, default=0
+    )
+    parser.add_argument(
+        "--keep",
+        help="Directory to keep generated databases in, rather than a temporary one",
+    )
+    args = parser.parse_args()
+
+    engines = args.engines.split(",")
+    failed = False
+
+    if args.db:
+        current_period = Period()
+        periods = [Period(offset=current_period.offset - 1), current_period]
+        print(args.db)
+        failed = benchmark(args.db, periods, engines, args.repeat)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = args.keep or tmp
+            os.makedirs(directory, exist_ok=True)
+            for scale in [int(s) for s in args.scales.split(",")]:
+                db_file = os.path.join(directory, f"tfchain-{scale}-{args.seed}.db")
+                if os.path.exists(db_file):
+                    os.remove(db_file)
+                start = time.perf_counter()
+                summary = generate(db_file, scale, args.periods, seed=args.seed)
+                print(
+                    f"{scale} nodes, {summary.uptimes + summary.targets + summary.states} events, {summary.late_boots} late boots, {summary.no_boots} never booted (generated in {time.perf_counter() - start:.1f}s)"
+                )
+                failed |= benchmark(db_file, summary.periods, engines, args.repeat)
+
+    sys.exit(1 if failed else 0)
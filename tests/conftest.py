@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules under test live in the repository root, next to this directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
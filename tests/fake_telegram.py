@@ -0,0 +1,230 @@
+"""
+A fake Telegram Bot API for load testing the bot's command handling, without a real bot token or any traffic to Telegram. It serves the handful of Bot API methods the bot uses, then plays a number of chats each sending a sequence of /network commands, and waits for the replies. Updates are delivered by long polling (getUpdates) or, once the bot has set a webhook, by posting to it, so both modes can be tested.
+
+Start the fake API first, then point the bot at it with --telegram-api:
+
+    python fake_telegram.py --port 8081 --chats 100 --commands 3
+    python node-status-bot.py 123:fake --telegram-api http://localhost:8081/bot ...
+
+For the webhook mode, also give the bot --webhook-url http://localhost:8443. When all replies have arrived, the time from each command to its reply is summarized, and the replies of each chat are checked to have come back in the order the commands were sent. Replies go through the bot's outbox, which holds to Telegram's rate limits here too, so more than a few commands per chat or a few hundred in total measures the rate limits rather than the bot.
+"""
+
+import argparse
+import itertools
+import json
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NETWORKS = ["main", "test", "dev"]
+# Chat ids start here, so they don't collide with chats a test deployment already has
+FIRST_CHAT = 900000
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.updates = []
+        self.next_update_id = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.webhook_url = ""
+        self.condition = threading.Condition()
+        # For each chat, the time each command was sent and the replies received
+        self.sent = {}
+        self.replies = {}
+
+    def call(self, method, params):
+        """Handle a Bot API method call, returning its result"""
+        if method == "getMe":
+            return {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "Fake",
+                "username": "fake_bot",
+            }
+        if method == "getUpdates":
+            # The bot sends every parameter as a string
+            return self.get_updates(
+                int(params.get("offset", 0)), float(params.get("timeout", 0))
+            )
+        if method == "setWebhook":
+            with self.condition:
+                self.webhook_url = params.get("url", "")
+            print("Webhook set to", self.webhook_url or "nothing")
+            return True
+        if method == "deleteWebhook":
+            with self.condition:
+                self.webhook_url = ""
+            return True
+        if method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            with self.condition:
+                self.replies.setdefault(chat_id, []).append(
+                    (time.monotonic(), params["text"])
+                )
+                self.condition.notify_all()
+            return {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params["text"],
+            }
+        # setMyCommands, deleteMyCommands and anything else the bot doesn't need an answer from
+        return True
+
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            return list(self.updates)
+
+    def send_command(self, chat_id, text):
+        """Send a command from a chat to the bot, by webhook if one is set"""
+        command = text.split()[0]
+        update = {
+            "update_id": next(self.next_update_id),
+            "message": {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+                "text": text,
+                "entities": [
+                    {"type": "bot_command", "offset": 0, "length": len(command)}
+                ],
+            },
+        }
+        with self.condition:
+            self.sent.setdefault(chat_id, []).append(time.monotonic())
+            webhook_url = self.webhook_url
+            if not webhook_url:
+                self.updates.append(update)
+                self.condition.notify_all()
+        if webhook_url:
+            request = urllib.request.Request(
+                webhook_url,
+                json.dumps(update).encode(),
+                {"Content-Type": "application/json"},
+            )
+            urllib.request.urlopen(request).read()
+
+    def wait_for_replies(self, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while sum(len(r) for r in self.replies.values()) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+
+def make_handler(telegram):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            # Paths look like /bot<token>/<method>
+            method = self.path.rstrip("/").split("/")[-1]
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length) if length else b""
+            params = json.loads(body) if body else {}
+            result = telegram.call(method, params)
+            data = json.dumps({"ok": True, "result": result}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def run_chat(telegram, chat_id, commands, interval):
+    for i in range(commands):
+        telegram.send_command(chat_id, "/network " + NETWORKS[i % len(NETWORKS)])
+        time.sleep(interval)
+
+
+def report(telegram, commands):
+    latencies = []
+    out_of_order = 0
+    for chat_id, sent in telegram.sent.items():
+        replies = telegram.replies.get(chat_id, [])
+        expected = [
+            "Set network to {}net".format(NETWORKS[i % len(NETWORKS)])
+            for i in range(commands)
+        ]
+        if [text for _, text in replies] != expected:
+            out_of_order += 1
+        latencies.extend(reply[0] - t for t, reply in zip(sent, replies))
+
+    latencies.sort()
+    print(
+        "Reply latency over {} commands: median {:.3f}s, p95 {:.3f}s, max {:.3f}s".format(
+            len(latencies),
+            statistics.median(latencies),
+            latencies[int(len(latencies) * 0.95)],
+            latencies[-1],
+        )
+    )
+    if out_of_order:
+        print(f"{out_of_order} chats got their replies out of order or missing")
+    else:
+        print("Every chat got its replies in order")
+    return out_of_order
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--port", help="Port to serve the fake API on", type=int, default=8081
+    )
+    parser.add_argument(
+        "--chats", help="Number of chats sending commands", type=int, default=20
+    )
+    parser.add_argument(
+        "--commands", help="Commands sent by each chat", type=int, default=3
+    )
+    parser.add_argument(
+        "--interval", help="Seconds between a chat's commands", type=float, default=0.01
+    )
+    parser.add_argument(
+        "--startup",
+        help="Seconds to wait for the bot to start before sending commands",
+        type=float,
+        default=10,
+    )
+    parser.add_argument(
+        "--timeout", help="Seconds to wait for all replies", type=float, default=120
+    )
+    args = parser.parse_args()
+
+    telegram = FakeTelegram()
+    server = ThreadingHTTPServer(("", args.port), make_handler(telegram))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Fake Telegram API on http://localhost:{args.port}/bot")
+
+    time.sleep(args.startup)
+    threads = [
+        threading.Thread(
+            target=run_chat,
+            args=(telegram, FIRST_CHAT + i, args.commands, args.interval),
+        )
+        for i in range(args.chats)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if not telegram.wait_for_replies(args.chats * args.commands, args.timeout):
+        print("Timed out waiting for replies")
+    sys.exit(1 if report(telegram, args.commands) else 0)
@@ -0,0 +1,370 @@
+"""
+Generate a synthetic tfchain.db with the same schema the ingester produces, so that the violation scanning code can be tested and benchmarked at a realistic scale without a copy of the production database.
+
+Nodes are grouped into farms, and a share of the farms are managed by the farmerbot. Regular nodes just submit uptime reports every 40 minutes and reboot now and then. Farmerbot nodes cycle between being awake and in standby, and when asked to wake up most of them boot within a few minutes, some boot late (resulting in a violation), and a few never boot at all. Some nodes are also created partway through the scanned range, so they have no PowerState entry for the earlier periods, just like real new nodes.
+
+The processed_blocks table is not filled, since it's only needed by the ingester itself. Instead the checkpoint in kv is set to the end of the generated range.
+"""
+
+import argparse
+import collections
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from grid3.minting.period import Period
+
+from find_violations import MAX_BOOT_TIME
+from ingester import prep_db
+
+BLOCK_TIME = 6
+UPTIME_INTERVAL = 60 * 40
+HOUR = 60 * 60
+DAY = HOUR * 24
+
+# How far before the first period we start simulating, so that nodes are in a
+# realistic state by the time the first period starts
+WARMUP = DAY * 2
+
+Summary = collections.namedtuple(
+    "Summary",
+    "nodes, farms, periods, start, end, uptimes, targets, states, late_boots, no_boots",
+)
+
+
+class Chain:
+    """Maps timestamps onto block numbers and hands out unique event indexes"""
+
+    def __init__(self, genesis):
+        self.genesis = genesis
+        self.event_counts = collections.Counter()
+
+    def block(self, timestamp):
+        return int(timestamp - self.genesis) // BLOCK_TIME + 1
+
+    def block_time(self, block):
+        return self.genesis + (block - 1) * BLOCK_TIME
+
+    def first_block_after(self, timestamp):
+        block = self.block(timestamp)
+        if self.block_time(block) < timestamp:
+            block += 1
+        return block
+
+    def place(self, timestamp):
+        """Return the block, event index and block timestamp for an event happening around the given time"""
+        block = self.block(timestamp)
+        index = self.event_counts[block]
+        self.event_counts[block] += 1
+        return block, index, self.block_time(block)
+
+
+class NodeSim:
+    """Simulates the chain events of a single node and collects the rows to insert"""
+
+    def __init__(self, node_id, farm_id, chain, start, end, boundaries, out):
+        self.node_id = node_id
+        self.farm_id = farm_id
+        self.chain = chain
+        self.start = start
+        self.end = end
+        self.boundaries = collections.deque(boundaries)
+        self.out = out
+
+        self.state = "Up"
+        self.target = "Up"
+        self.down_block = None
+        self.down_time = None
+
+    def advance(self, timestamp):
+        # Snapshot the node's power state at any period boundaries we passed
+        while self.boundaries and self.boundaries[0][1] <= timestamp:
+            block, block_time = self.boundaries.popleft()
+            self.out["PowerState"].append(
+                (
+                    self.node_id,
+                    self.state,
+                    self.down_block,
+                    self.down_time,
+                    self.target,
+                    block,
+                    block_time,
+                )
+            )
+
+    def uptime(self, timestamp, boot_time):
+        self.advance(timestamp)
+        block, index, timestamp = self.chain.place(timestamp)
+        if self.start <= timestamp <= self.end:
+            self.out["NodeUptimeReported"].append(
+                (
+                    self.node_id,
+                    timestamp - boot_time,
+                    timestamp,
+                    block,
+                    index,
+                    timestamp,
+                )
+            )
+        return timestamp
+
+    def power_target(self, timestamp, target):
+        self.advance(timestamp)
+        block, index, timestamp = self.chain.place(timestamp)
+        self.target = target
+        if self.start <= timestamp <= self.end:
+            self.out["PowerTargetChanged"].append(
+                (self.farm_id, self.node_id, target, block, index, timestamp)
+            )
+        return timestamp
+
+    def power_state(self, timestamp, state):
+        self.advance(timestamp)
+        block, index, timestamp = self.chain.place(timestamp)
+        self.state = state
+        if state == "Down":
+            self.down_block, self.down_time = block, timestamp
+        else:
+            self.down_block, self.down_time = None, None
+        if self.start <= timestamp <= self.end:
+            self.out["PowerStateChanged"].append(
+                (
+                    self.farm_id,
+                    self.node_id,
+                    state,
+                    self.down_block,
+                    block,
+                    index,
+                    timestamp,
+                )
+            )
+        return timestamp
+
+
+def simulate_node(sim, rng, created, farmerbot, opts, stats):
+    t = created
+    boot_time = t - rng.uniform(0, DAY * 10)
+    next_report = t + rng.uniform(0, UPTIME_INTERVAL)
+
+    while t < sim.end:
+        if farmerbot:
+            awake_until = t + rng.uniform(HOUR * 2, HOUR * 16)
+        else:
+            awake_until = sim.end
+
+        while next_report < min(awake_until, sim.end):
+            if rng.random() < opts.reboot_rate * UPTIME_INTERVAL / DAY:
+                boot_time = next_report - rng.uniform(60, 600)
+            sim.uptime(next_report, boot_time)
+            next_report += UPTIME_INTERVAL + rng.uniform(-120, 120)
+
+        if not farmerbot or awake_until >= sim.end:
+            break
+
+        # Farmerbot puts the node to sleep, and the node shuts down shortly after
+        sim.power_target(awake_until, "Down")
+        down_time = sim.power_state(awake_until + rng.uniform(30, 180), "Down")
+
+        boot_requested = down_time + rng.uniform(HOUR, HOUR * 20)
+        if boot_requested >= sim.end:
+            break
+        boot_requested = sim.power_target(boot_requested, "Up")
+
+        roll = rng.random()
+        if roll < opts.no_boot_rate:
+            stats["no_boots"] += 1
+            break
+        elif roll < opts.no_boot_rate + opts.late_boot_rate:
+            stats["late_boots"] += 1
+            delay = rng.uniform(MAX_BOOT_TIME + 60, HOUR * 3)
+        else:
+            delay = rng.uniform(60, 60 * 15)
+
+        boot_time = boot_requested + delay
+        report = sim.uptime(boot_time + rng.uniform(30, 300), boot_time)
+        sim.power_state(report, "Up")
+        next_report = report + UPTIME_INTERVAL
+        t = report
+
+    sim.advance(sim.end)
+
+
+def generate(db_file, nodes=1000, periods=2, farm_size=20, end=None, seed=0, opts=None):
+    """Write a synthetic database to db_file, which must not exist yet. Returns a Summary of what was generated"""
+    if opts is None:
+        opts = parser.parse_args([db_file])
+    if end is None:
+        end = int(time.time())
+    rng = random.Random(seed)
+
+    last_period = Period(end)
+    first_period = Period(offset=last_period.offset - periods + 1)
+    start = first_period.start
+    chain = Chain(start - WARMUP - DAY)
+
+    # Blocks at which the ingester would fetch the PowerState for each period
+    boundaries = []
+    for offset in range(first_period.offset, last_period.offset + 1):
+        block = chain.first_block_after(Period(offset=offset).start)
+        boundaries.append((block, chain.block_time(block)))
+
+    out = collections.defaultdict(list)
+    stats = collections.Counter()
+    farms = (nodes + farm_size - 1) // farm_size
+    farmerbot_farms = set(
+        rng.sample(range(1, farms + 1), round(farms * opts.farmerbot_rate))
+    )
+
+    for node_id in range(1, nodes + 1):
+        farm_id = (node_id - 1) // farm_size + 1
+        if rng.random() < opts.new_node_rate:
+            created = rng.uniform(start, end)
+        else:
+            created = start - WARMUP
+        sim = NodeSim(node_id, farm_id, chain, start, end, boundaries, out)
+        # New nodes don't have a power state until after they are created
+        while sim.boundaries and sim.boundaries[0][1] < created:
+            sim.boundaries.popleft()
+        simulate_node(sim, rng, created, farm_id in farmerbot_farms, opts, stats)
+
+    con = sqlite3.connect(db_file)
+    prep_db(con)
+    con.executemany(
+        "INSERT INTO NodeUptimeReported VALUES(?, ?, ?, ?, ?, ?)",
+        out["NodeUptimeReported"],
+    )
+    con.executemany(
+        "INSERT INTO PowerTargetChanged VALUES(?, ?, ?, ?, ?, ?)",
+        out["PowerTargetChanged"],
+    )
+    con.executemany(
+        "INSERT INTO PowerStateChanged VALUES(?, ?, ?, ?, ?, ?, ?)",
+        out["PowerStateChanged"],
+    )
+    con.executemany(
+        "INSERT INTO PowerState VALUES(?, ?, ?, ?, ?, ?, ?)", out["PowerState"]
+    )
+    changes = collections.defaultdict(set)
+    for rows, node_column in (
+        (out["NodeUptimeReported"], 0),
+        (out["PowerTargetChanged"], 1),
+        (out["PowerStateChanged"], 1),
+    ):
+        for row in rows:
+            changes[(row[-3], row[-1])].add(row[node_column])
+    con.executemany(
+        "INSERT INTO ChangeLog VALUES(?, ?, ?)",
+        [
+            (block, timestamp, ",".join(str(n) for n in sorted(node_ids)))
+            for (block, timestamp), node_ids in changes.items()
+        ],
+    )
+    for i, offset in enumerate(range(first_period.offset, last_period.offset + 1)):
+        period = Period(offset=offset)
+        block, block_time = boundaries[i]
+        end_block = boundaries[i + 1][0] - 1 if i + 1 < len(boundaries) else None
+        con.execute(
+            "INSERT OR REPLACE INTO Periods VALUES(?, ?, ?, ?, ?, ?, 'complete')",
+            (offset, period.start, period.end, block, block_time, end_block),
+        )
+
+    checkpoint_block = chain.block(end)
+    con.execute(
+        "UPDATE kv SET value=? WHERE key='checkpoint_block'", (checkpoint_block,)
+    )
+    con.execute(
+        "UPDATE kv SET value=? WHERE key='checkpoint_time'",
+        (chain.block_time(checkpoint_block),),
+    )
+    con.commit()
+    con.close()
+
+    return Summary(
+        nodes,
+        farms,
+        [Period(offset=o) for o in range(first_period.offset, last_period.offset + 1)],
+        start,
+        end,
+        len(out["NodeUptimeReported"]),
+        len(out["PowerTargetChanged"]),
+        len(out["PowerStateChanged"]),
+        stats["late_boots"],
+        stats["no_boots"],
+    )
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("db_file", help="Path of the SQLite database file to create")
+parser.add_argument("-n", "--nodes", help="Number of nodes", type=int, default=1000)
+parser.add_argument(
+    "-p",
+    "--periods",
+    help="Number of minting periods to generate, ending with the period containing the end time",
+    type=int,
+    default=2,
+)
+parser.add_argument("--farm-size", help="Nodes per farm", type=int, default=20)
+parser.add_argument(
+    "-e",
+    "--end",
+    help="Timestamp of the last generated block. Defaults to now",
+    type=int,
+)
+parser.add_argument("--seed", help="Random seed", type=int, default=0)
+parser.add_argument(
+    "--farmerbot-rate",
+    help="Share of farms managed by the farmerbot",
+    type=float,
+    default=0.3,
+)
+parser.add_argument(
+    "--late-boot-rate",
+    help="Share of wake ups where the node boots too late",
+    type=float,
+    default=0.02,
+)
+parser.add_argument(
+    "--no-boot-rate",
+    help="Share of wake ups where the node never boots",
+    type=float,
+    default=0.002,
+)
+parser.add_argument(
+    "--reboot-rate", help="Average reboots per node per day", type=float, default=0.05
+)
+parser.add_argument(
+    "--new-node-rate",
+    help="Share of nodes created partway through the generated range",
+    type=float,
+    default=0.02,
+)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if os.path.exists(args.db_file):
+        print("Database file already exists:", args.db_file)
+        sys.exit(1)
+
+    start_time = time.time()
+    summary = generate(
+        args.db_file,
+        nodes=args.nodes,
+        periods=args.periods,
+        farm_size=args.farm_size,
+        end=args.end,
+        seed=args.seed,
+        opts=args,
+    )
+    print(
+        f"Generated {summary.nodes} nodes in {summary.farms} farms over {len(summary.periods)} periods in {time.time() - start_time:.1f} seconds"
+    )
+    print(
+        f"{summary.uptimes} uptime reports, {summary.targets} power target changes, {summary.states} power state changes"
+    )
+    print(
+        f"{summary.late_boots} late boots, {summary.no_boots} wake ups that never booted"
+    )
@@ -0,0 +1,93 @@
+"""
+Measure how long it takes a standby bot to take over when the leader goes away, using the Docker Compose setup in this folder. The leader's service is stopped (or killed with --kill, which leaves its lease to expire rather than releasing it), and the leader key in rqlite is watched until another replica holds it. The stopped service is started again afterwards, so the measurement can be repeated with --rounds.
+
+Service names are expected to match the bots' node ids, as they do in docker-compose.yaml.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import time
+import urllib.parse
+import urllib.request
+
+POLL_INTERVAL = 0.05
+
+
+def get_leader(rqlite_url):
+    """Read the leader key, returning the node id holding it and its expiry, or None if there isn't one"""
+    query = urllib.parse.urlencode(
+        {"level": "strong", "q": "SELECT value FROM metadata WHERE key='leader'"}
+    )
+    with urllib.request.urlopen(rqlite_url + "/db/query?" + query) as response:
+        result = json.load(response)["results"][0]
+    if not result.get("values"):
+        return None
+    parts = result["values"][0][0].split(":")
+    return parts[0], float(parts[1])
+
+
+def wait_for_leader(rqlite_url, not_id=None, timeout=120):
+    """Wait for a replica other than not_id to hold an unexpired lease, returning its id"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            leader = get_leader(rqlite_url)
+        except OSError:
+            leader = None
+        if leader and leader[0] != not_id and leader[1] > time.time():
+            return leader[0]
+        time.sleep(POLL_INTERVAL)
+    raise TimeoutError("No new leader after {} seconds".format(timeout))
+
+
+def compose(*command):
+    subprocess.run(["docker", "compose", *command], check=True)
+
+
+def measure(rqlite_url, kill):
+    leader = wait_for_leader(rqlite_url)
+    print(f"Current leader is {leader}, {'killing' if kill else 'stopping'} it")
+    start = time.time()
+    if kill:
+        compose("kill", leader)
+    else:
+        # Stopping sends SIGTERM, so the bot releases its lease on the way out. Measure from the signal, not from when the container is gone
+        subprocess.Popen(["docker", "compose", "stop", leader])
+    new_leader = wait_for_leader(rqlite_url, not_id=leader)
+    elapsed = time.time() - start
+    print(f"{new_leader} took over after {elapsed:.3f} seconds")
+    compose("start", leader)
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--rqlite-url", help="Rqlite HTTP API", default="http://localhost:4001"
+    )
+    parser.add_argument(
+        "--kill",
+        help="Kill the leader instead of stopping it gracefully",
+        action="store_true",
+    )
+    parser.add_argument("--rounds", help="Times to fail over", type=int, default=5)
+    parser.add_argument(
+        "--settle",
+        help="Seconds to wait between rounds, for the restarted bot to come up as a standby",
+        type=float,
+        default=20,
+    )
+    args = parser.parse_args()
+
+    times = []
+    for i in range(args.rounds):
+        if i:
+            time.sleep(args.settle)
+        times.append(measure(args.rqlite_url, args.kill))
+
+    print(
+        f"Failover over {len(times)} rounds: min {min(times):.3f}s, "
+        f"median {statistics.median(times):.3f}s, max {max(times):.3f}s"
+    )
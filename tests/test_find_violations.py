@@ -0,0 +1,148 @@
+"""
+Compare the violation engines, and scans resuming from snapshots, with check_node on a small synthetic database. benchmark_violations.py does the same at scale.
+"""
+
+import shutil
+import sqlite3
+
+import pytest
+
+import find_violations
+import ingester
+from generate_tfchain_db import generate, parser
+
+# A fixed end time keeps the generated data the same on every run
+END = 1_750_000_000
+NODES = 120
+
+
+def key(violation):
+    return (
+        violation.boot_requested,
+        violation.booted_at,
+        violation.finalized,
+        violation.end_time,
+    )
+
+
+def normalize(violations):
+    return sorted(key(v) for v in violations)
+
+
+@pytest.fixture(scope="module")
+def db_file(tmp_path_factory):
+    """A database with enough late and missing boots for violations in every period, and snapshots written like the ingester does"""
+    db_file = str(tmp_path_factory.mktemp("tfchain") / "tfchain.db")
+    opts = parser.parse_args(
+        [db_file, "--late-boot-rate", "0.2", "--no-boot-rate", "0.05"]
+    )
+    generate(db_file, nodes=NODES, periods=2, farm_size=10, end=END, opts=opts)
+    con = sqlite3.connect(db_file)
+    ingester.write_snapshots(con, END)
+    con.close()
+    return db_file
+
+
+@pytest.fixture
+def con(db_file):
+    con = sqlite3.connect(db_file)
+    yield con
+    con.close()
+
+
+def periods(con):
+    return find_violations.get_periods(con, END)
+
+
+def nodes(con):
+    rows = con.execute(
+        "SELECT node_id FROM PowerState UNION SELECT node_id FROM PowerTargetChanged"
+    )
+    return sorted(row[0] for row in rows)
+
+
+def check_each(con, period, since=None):
+    return {
+        node: normalize(find_violations.check_node(con, node, period, since=since))
+        for node in nodes(con)
+    }
+
+
+def test_batch_engines_match_check_node(con):
+    total = 0
+    for period in periods(con):
+        expected = check_each(con, period)
+        checked = find_violations.check_nodes(con, nodes(con), period)
+        scanned = find_violations.scan_nodes(con, nodes(con), period)
+        assert {n: normalize(v) for n, v in checked.items()} == expected
+        assert {n: normalize(r.violations) for n, r in scanned.items()} == expected
+        total += sum(map(len, expected.values()))
+    assert total > 0
+
+
+def test_batch_engines_split_into_chunks(con, monkeypatch):
+    period = periods(con)[1]
+    expected = find_violations.check_nodes(con, nodes(con), period)
+    monkeypatch.setattr(find_violations, "NODE_CHUNK", 7)
+    # Duplicates are only scanned once
+    assert find_violations.check_nodes(con, nodes(con) * 2, period) == expected
+
+
+def test_scans_since_snapshot(con):
+    for period in periods(con):
+        full = check_each(con, period)
+        times = [
+            row[0]
+            for row in con.execute(
+                "SELECT timestamp FROM SnapshotTimes WHERE period_offset=? ORDER BY timestamp",
+                (period.offset,),
+            )
+        ]
+        assert times
+        since = times[len(times) // 2] + 100
+        snapshot = find_violations.snapshot_time(con, period, since)
+        assert snapshot == times[len(times) // 2]
+
+        expected = check_each(con, period, since)
+        checked = find_violations.check_nodes(con, nodes(con), period, since)
+        scanned = find_violations.scan_nodes(con, nodes(con), period, since)
+        assert {n: normalize(v) for n, v in checked.items()} == expected
+        assert {n: normalize(r.violations) for n, r in scanned.items()} == expected
+
+        # Only violations settled before the snapshot are left out
+        for node, violations in full.items():
+            assert set(expected[node]) <= set(violations)
+            for _, booted_at, _, _ in set(violations) - set(expected[node]):
+                assert booted_at is not None and booted_at < snapshot
+
+
+def test_since_before_first_snapshot_scans_whole_period(con):
+    period = periods(con)[1]
+    assert find_violations.snapshot_time(con, period, period.start - 1) is None
+    assert find_violations.check_nodes(
+        con, nodes(con), period, period.start - 1
+    ) == find_violations.check_nodes(con, nodes(con), period)
+
+
+def test_periods_come_from_catalog(con):
+    for period in periods(con):
+        assert isinstance(period, find_violations.CatalogPeriod)
+        assert period.snapshot_status == "complete"
+
+
+def test_database_from_older_ingester(db_file, con, tmp_path):
+    """Without the period catalog and snapshots, scans start from the beginning of each period"""
+    old_file = str(tmp_path / "old.db")
+    shutil.copy(db_file, old_file)
+    old_con = sqlite3.connect(old_file)
+    old_con.execute("DROP TABLE Periods")
+    old_con.execute("DROP TABLE SnapshotTimes")
+
+    for old_period, period in zip(periods(old_con), periods(con)):
+        assert find_violations.get_period(old_con, period.offset) is None
+        assert old_period.offset == period.offset
+        assert find_violations.snapshot_time(old_con, old_period, END) is None
+        assert find_violations.check_nodes(
+            old_con, nodes(old_con), old_period, since=END
+        ) == find_violations.check_nodes(con, nodes(con), period)
+    old_con.close()
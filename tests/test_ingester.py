@@ -0,0 +1,25 @@
+import sqlite3
+
+from grid3.minting.period import Period
+
+import ingester
+
+
+def test_backfill_periods_runs_once():
+    con = sqlite3.connect(":memory:")
+    ingester.prep_db(con)
+    period = Period(offset=100)
+    con.execute(
+        "INSERT INTO PowerState VALUES(1, 'Up', NULL, NULL, 'Up', 10, ?)",
+        (period.start + 6,),
+    )
+    con.execute("DELETE FROM kv WHERE key='periods_backfilled'")
+
+    ingester.prep_db(con)
+    assert con.execute(
+        "SELECT period_offset, snapshot_status FROM Periods"
+    ).fetchall() == [(100, "pending")]
+
+    con.execute("DELETE FROM Periods")
+    ingester.prep_db(con)
+    assert con.execute("SELECT * FROM Periods").fetchall() == []
@@ -0,0 +1,132 @@
+"""
+The leader lease, taken from an in-memory metadata table, and the pattern fenced writes check the lease with, run against sqlite.
+"""
+
+import sqlite3
+
+import pytest
+
+import lease
+from db import lease_pattern
+
+INTERVAL = 10
+LEASE_TIME = lease.LEASE_FACTOR * INTERVAL
+
+
+class Metadata:
+    """The metadata methods of RqliteDB the lease uses, kept in a dict"""
+
+    def __init__(self, leader=None):
+        self.values = {}
+        if leader is not None:
+            self.values["leader"] = leader
+        # Report the next successful swap as failed, like a lost response
+        self.lose_response = False
+
+    def get_metadata(self, key):
+        return self.values.get(key)
+
+    def compare_and_set_metadata(self, key, old_value, new_value):
+        if self.values.get(key) != old_value:
+            return False
+        self.values[key] = new_value
+        if self.lose_response:
+            self.lose_response = False
+            return False
+        return True
+
+
+def test_parse():
+    assert lease.parse("a:100.5:3") == ("a", 100.5, 3)
+    # Keys from older versions only hold the last heartbeat
+    assert lease.parse("a:100") == ("a", 100 + lease.LEGACY_LEASE_TIME, 0)
+    assert lease.parse("garbage") is None
+    assert lease.parse("a:soon:1") is None
+
+
+def test_first_leader_gets_term_one():
+    db = Metadata()
+    assert lease.acquire(db, "a", INTERVAL, now=100) == (1, 100 + LEASE_TIME)
+    assert db.get_metadata("leader") == f"a:{100 + LEASE_TIME}:1"
+
+
+def test_renewal_keeps_term():
+    db = Metadata()
+    lease.acquire(db, "a", INTERVAL, now=100)
+    # Even after the lease ran out, nobody else took it, so it's still ours
+    assert lease.acquire(db, "a", INTERVAL, now=200) == (1, 200 + LEASE_TIME)
+
+
+def test_lease_is_held_until_it_expires():
+    db = Metadata()
+    lease.acquire(db, "a", INTERVAL, now=100)
+    assert lease.acquire(db, "b", INTERVAL, now=100 + LEASE_TIME - 1) is None
+    assert lease.acquire(db, "b", INTERVAL, now=100 + LEASE_TIME + 1) == (
+        2,
+        101 + 2 * LEASE_TIME,
+    )
+    # The old leader has lost it, and a stale renewal can't take it back
+    assert lease.acquire(db, "a", INTERVAL, now=102 + LEASE_TIME) is None
+
+
+def test_only_one_replica_wins_a_race():
+    db = Metadata("a:100:4")
+    current = db.get_metadata("leader")
+    assert lease.acquire(db, "b", INTERVAL, now=200) == (5, 200 + LEASE_TIME)
+    # c read the same expired lease as b, but its swap no longer matches
+    assert not db.compare_and_set_metadata("leader", current, "c:230:5")
+    assert lease.acquire(db, "c", INTERVAL, now=201) is None
+
+
+def test_lost_response_still_holds_lease():
+    db = Metadata()
+    db.lose_response = True
+    assert lease.acquire(db, "a", INTERVAL, now=100) == (1, 100 + LEASE_TIME)
+
+
+def test_takeover_from_older_version():
+    db = Metadata("a:100")
+    assert lease.acquire(db, "b", INTERVAL, now=100) is None
+    assert lease.acquire(db, "b", INTERVAL, now=101 + lease.LEGACY_LEASE_TIME) == (
+        1,
+        101 + lease.LEGACY_LEASE_TIME + LEASE_TIME,
+    )
+
+
+def test_release():
+    db = Metadata()
+    lease.acquire(db, "a", INTERVAL, now=100)
+    # Only the holder of the current term can release it
+    lease.release(db, "b", 1)
+    lease.release(db, "a", 2)
+    assert db.get_metadata("leader") == f"a:{100 + LEASE_TIME}:1"
+    lease.release(db, "a", 1)
+    assert db.get_metadata("leader") == "a:0:1"
+    assert lease.acquire(db, "b", INTERVAL, now=101) == (2, 101 + LEASE_TIME)
+
+
+@pytest.mark.parametrize(
+    "leader, leader_id, term, held",
+    [
+        ("a:130.5:2", "a", 2, True),
+        ("a:0:2", "a", 2, True),
+        ("a:130.5:3", "a", 2, False),
+        ("a:130.5:12", "a", 2, False),
+        ("b:130.5:2", "a", 2, False),
+        ("ab:130.5:2", "a", 2, False),
+        # Wildcards in node ids are matched literally
+        ("aXb:130.5:2", "a_b", 2, False),
+        ("a_b:130.5:2", "a_b", 2, True),
+        ("a%:130.5:2", "a%", 2, True),
+        ("abc:130.5:2", "a%", 2, False),
+    ],
+)
+def test_lease_pattern(leader, leader_id, term, held):
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)")
+    con.execute("INSERT INTO metadata VALUES ('leader', ?)", (leader,))
+    rows = con.execute(
+        "SELECT 1 FROM metadata WHERE key = 'leader' AND value LIKE ? ESCAPE '\\'",
+        (lease_pattern(leader_id, term),),
+    ).fetchall()
+    assert bool(rows) == held
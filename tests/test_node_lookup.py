@@ -0,0 +1,149 @@
+import threading
+import time
+
+import prometheus_client
+import pytest
+from grid3.types import Node
+
+from node_lookup import FarmIndex, NodeLookupCache
+
+THREADS = 8
+
+
+def make_node(node_id):
+    return Node({"nodeID": node_id, "twinID": node_id, "updatedAt": 0})
+
+
+class SlowFetch:
+    """Fetches nodes once released, recording the ids asked for in each call"""
+
+    def __init__(self, missing=(), error=None):
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.missing = set(missing)
+        self.error = error
+
+    def __call__(self, net, node_ids):
+        self.calls.append((net, list(node_ids)))
+        self.started.set()
+        assert self.release.wait(10)
+        if self.error is not None:
+            raise self.error
+        return [make_node(n) for n in node_ids if n not in self.missing]
+
+
+def lookup_in_threads(cache, net, node_ids, count=THREADS):
+    """Look the nodes up from several threads at once, collecting each result or error"""
+    results = [None] * count
+
+    def lookup(i):
+        try:
+            results[i] = cache.get(net, node_ids)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=lookup, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def coalesced():
+    return prometheus_client.REGISTRY.get_sample_value("node_lookup_coalesced_total")
+
+
+def finish(fetch, threads, waiting=0, coalesced_before=0):
+    """Release the fetch once the given number of threads wait on it"""
+    assert fetch.started.wait(10)
+    deadline = time.monotonic() + 10
+    while coalesced() - coalesced_before < waiting:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    fetch.release.set()
+    for thread in threads:
+        thread.join(10)
+        assert not thread.is_alive()
+
+
+def test_hits_are_served_from_cache():
+    fetch = SlowFetch()
+    fetch.release.set()
+    cache = NodeLookupCache(fetch)
+    first = cache.get("main", [1, "2", 1])
+    assert [node.nodeId for node in first] == [1, 2, 1]
+    assert cache.get("main", [2, 1]) == [first[1], first[0]]
+    assert fetch.calls == [("main", [1, 2])]
+    # Networks are cached apart
+    cache.get("test", [1])
+    assert fetch.calls[-1] == ("test", [1])
+
+
+def test_concurrent_misses_share_one_fetch():
+    fetch = SlowFetch()
+    cache = NodeLookupCache(fetch)
+    before = coalesced()
+    threads, results = lookup_in_threads(cache, "main", [7])
+    finish(fetch, threads, THREADS - 1, before)
+    assert fetch.calls == [("main", [7])]
+    assert all(result == results[0] for result in results)
+    assert [node.nodeId for node in results[0]] == [7]
+
+
+def test_only_missing_nodes_are_fetched():
+    fetch = SlowFetch()
+    fetch.release.set()
+    cache = NodeLookupCache(fetch)
+    cache.get("main", [1])
+    cache.get("main", [1, 2, 3])
+    assert fetch.calls == [("main", [1]), ("main", [2, 3])]
+
+
+def test_nodes_that_dont_exist_are_left_out():
+    fetch = SlowFetch(missing={5})
+    cache = NodeLookupCache(fetch)
+    threads, results = lookup_in_threads(cache, "main", [4, 5])
+    finish(fetch, threads)
+    assert len(fetch.calls) == 1
+    assert all([node.nodeId for node in result] == [4] for result in results)
+
+
+def test_errors_reach_waiting_threads():
+    fetch = SlowFetch(error=RuntimeError("GraphQL is down"))
+    cache = NodeLookupCache(fetch)
+    before = coalesced()
+    threads, results = lookup_in_threads(cache, "main", [9])
+    finish(fetch, threads, THREADS - 1, before)
+    assert len(fetch.calls) == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+    # Nothing was cached, so the next lookup tries again
+    fetch.error = None
+    assert [node.nodeId for node in cache.get("main", [9])] == [9]
+    assert len(fetch.calls) == 2
+
+
+def test_put_refreshes_entries():
+    fetch = SlowFetch()
+    fetch.release.set()
+    cache = NodeLookupCache(fetch)
+    node = make_node(3)
+    cache.put("main", [node])
+    assert cache.get("main", [3]) == [node]
+    assert fetch.calls == []
+
+
+def test_farm_index_falls_back_to_last_known():
+    calls = []
+
+    def fetch(net, farm_ids):
+        calls.append(list(farm_ids))
+        if len(calls) > 1:
+            raise RuntimeError("GraphQL is down")
+        return {1: [3, 2], 2: [4]}
+
+    index = FarmIndex(fetch, ttl=0)
+    assert index.get("main", [1, 2, 3]) == {1: (2, 3), 2: (4,), 3: ()}
+    with pytest.raises(RuntimeError):
+        index.get("main", [1])
+    assert index.get("main", [1, 4], stale_ok=True) == {1: (2, 3)}
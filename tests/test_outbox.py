@@ -0,0 +1,118 @@
+import collections
+import threading
+import time
+
+import pytest
+
+import outbox
+from outbox import Outbox, TokenBucket
+
+
+class RecordingBot:
+    """Records the messages sent, as (chat_id, text)"""
+
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text):
+        with self.lock:
+            self.sent.append((chat_id, text))
+
+    def wait_for(self, count, timeout=10):
+        deadline = time.monotonic() + timeout
+        while len(self.sent) < count:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        return list(self.sent)
+
+
+def no_split(text):
+    return [text]
+
+
+def test_bucket_allows_bursts():
+    bucket = TokenBucket(rate=1, capacity=3)
+    now = bucket.updated
+    for _ in range(3):
+        assert bucket.ready_at(now) == now
+        bucket.take(now)
+    assert bucket.ready_at(now) == pytest.approx(now + 1)
+
+
+def test_bucket_refills_at_rate():
+    bucket = TokenBucket(rate=0.5, capacity=2)
+    now = bucket.updated
+    bucket.take(now)
+    bucket.take(now)
+    assert bucket.ready_at(now + 1) == pytest.approx(now + 2)
+    assert bucket.ready_at(now + 2) == now + 2
+    # Tokens never pile up beyond capacity
+    bucket.refill(now + 100)
+    assert bucket.tokens == 2
+
+
+def test_bucket_idle():
+    bucket = TokenBucket(rate=1, capacity=3)
+    now = bucket.updated
+    assert bucket.idle(now)
+    bucket.take(now)
+    assert not bucket.idle(now + 0.5)
+    assert bucket.idle(now + 1)
+
+
+def test_replies_go_before_alerts():
+    bot = RecordingBot()
+    box = Outbox(bot, no_split, 4096)
+    # Hold the senders off while the queue is set up
+    with box.condition:
+        for chat_id in range(1, 6):
+            box.send(chat_id, "alert", batch=True)
+        box.send(99, "reply")
+        now = time.monotonic()
+        assert box.next_ready(now)[0] == 99
+        # Even once the alerts are ready, the reply is still first
+        assert box.next_ready(now + outbox.BATCH_WINDOW + 1)[0] == 99
+    assert bot.wait_for(1)[0] == (99, "reply")
+
+
+def test_alerts_to_a_chat_are_merged(monkeypatch):
+    monkeypatch.setattr(outbox, "BATCH_WINDOW", 0.2)
+    bot = RecordingBot()
+    box = Outbox(bot, no_split, 4096)
+    with box.condition:
+        for i in range(3):
+            box.send(1, "alert {}".format(i), batch=True)
+        box.send(2, "alert for another chat", batch=True)
+    sent = bot.wait_for(2)
+    assert sorted(sent) == [
+        (1, outbox.SEPARATOR.join("alert {}".format(i) for i in range(3))),
+        (2, "alert for another chat"),
+    ]
+
+
+def test_messages_to_a_chat_stay_in_order():
+    bot = RecordingBot()
+    box = Outbox(bot, no_split, 4096)
+    with box.condition:
+        for i in range(4):
+            box.send(1, "reply {}".format(i))
+    # The chat's burst lets the first three go at once, and the fourth after a second
+    sent = bot.wait_for(4)
+    assert sent == [(1, "reply {}".format(i)) for i in range(4)]
+
+
+def test_idle_buckets_are_pruned():
+    box = Outbox(RecordingBot(), no_split, 4096)
+    with box.condition:
+        box.chat_bucket(2)
+        now = time.monotonic()
+        box.chat_bucket(1).take(now)
+        box.chat_bucket(3).take(now)
+        box.chats[3] = collections.deque()
+        box.prune_buckets(now)
+        # Chat 1 hasn't refilled and chat 3 has messages queued
+        assert set(box.chat_buckets) == {1, 3}
+        del box.chats[3]
+        box.prune_buckets(now + outbox.CHAT_BURST / outbox.CHAT_RATE)
+        assert box.chat_buckets == {}
@@ -0,0 +1,91 @@
+import re
+
+import pytest
+
+from pages import TAG, paginate, split_line
+
+
+def balanced(page):
+    """Whether every tag opened on the page is closed on it, in order"""
+    open_tags = []
+    for match in TAG.finditer(page):
+        closing, name = match.groups()
+        if not closing:
+            open_tags.append(name)
+        elif not open_tags or open_tags.pop() != name:
+            return False
+    return not open_tags
+
+
+def words(text):
+    return TAG.sub("", text).split()
+
+
+def test_short_report_is_one_page():
+    sections = ["<b>Node 1</b>\nUp\n\n", "<b>Node 2</b>\nDown\n\n"]
+    assert list(paginate(sections, 100)) == ["<b>Node 1</b>\nUp\n\n<b>Node 2</b>\nDown"]
+
+
+def test_sections_are_kept_whole():
+    sections = ["Node {}: up for a while\n\n".format(i) for i in range(50)]
+    pages = list(paginate(sections, 200))
+    assert len(pages) > 1
+    for page in pages:
+        assert len(page) <= 200
+        for section in page.split("\n\n"):
+            assert re.fullmatch(r"Node \d+: up for a while", section)
+    assert words("\n".join(pages)) == words("".join(sections))
+
+
+def test_long_line_is_split_between_words():
+    line = " ".join(str(node_id) for node_id in range(1000, 3000))
+    pages = list(paginate(["Nodes: " + line], 300))
+    assert all(len(page) <= 300 for page in pages)
+    assert words(" ".join(pages)) == words("Nodes: " + line)
+
+
+@pytest.mark.parametrize("limit", [250, 400, 3800])
+def test_tags_are_closed_and_reopened(limit):
+    sections = [
+        "<b>Farm {}</b>\n<i>{}</i>\n\n".format(
+            i, "\n".join("node {} is down".format(n) for n in range(30))
+        )
+        for i in range(20)
+    ]
+    pages = list(paginate(sections, limit))
+    assert len(pages) > 1
+    for page in pages:
+        assert len(page) <= limit
+        assert balanced(page)
+    assert words("\n".join(pages)) == words("".join(sections))
+
+
+def test_pages_without_text_are_skipped():
+    assert list(paginate([], 100)) == []
+    assert list(paginate(["\n\n", "<b></b>\n"], 100)) == []
+
+
+@pytest.mark.parametrize("limit", [1, 2, 5, 10])
+def test_small_limits(limit):
+    """Words get cut and tags may not fit, but the HTML stays valid and no text is lost"""
+    sections = ["<b>Node 12345</b> is up\n", "and node 678 too"]
+    pages = list(paginate(sections, limit))
+    assert all(balanced(page) for page in pages)
+    assert re.sub(r"\s", "", "".join(TAG.sub("", page) for page in pages)) == (
+        "Node12345isupandnode678too"
+    )
+
+
+def test_small_limit_with_room_for_tags():
+    sections = ["<b>Node 12345</b> is up\n", "and node 678 too"]
+    pages = list(paginate(sections, 20))
+    assert pages == ["<b>Node 12345</b> ", "is up\nand node ", "678 too"]
+
+
+@pytest.mark.parametrize("size", [1, 4, 10])
+def test_split_line_never_cuts_a_tag(size):
+    line = "x" * 8 + '<a href="https://t.me/x">1 2 3</a>'
+    pieces = list(split_line(line, size))
+    for piece in pieces:
+        assert piece.count("<") == piece.count(">")
+    assert "".join(pieces) == line
@@ -0,0 +1,51 @@
+"""
+Replica liveness from heartbeats, timed by a fake clock.
+"""
+
+from sharding import Liveness
+
+TIMEOUT = 15
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_replicas_are_alive_while_their_heartbeat_changes():
+    clock = Clock()
+    liveness = Liveness(TIMEOUT, clock)
+    assert liveness.update({"a": 5.0, "b": 7.0}) == {"a", "b"}
+    clock.now += 10
+    assert liveness.update({"a": 10.0, "b": 7.0}) == {"a", "b"}
+    clock.now += 10
+    # b's heartbeat hasn't changed for 20 seconds, whatever its value says
+    assert liveness.update({"a": 15.0, "b": 7.0}) == {"a"}
+    assert liveness.stale(TIMEOUT) == [("b", 7.0)]
+
+
+def test_heartbeats_from_skewed_clocks():
+    clock = Clock()
+    liveness = Liveness(TIMEOUT, clock)
+    # c's clock is an hour behind, and d's an hour ahead
+    liveness.update({"c": clock.now - 3600, "d": clock.now + 3600})
+    clock.now += 20
+    assert liveness.update({"c": clock.now - 3600, "d": clock.now + 3600}) == {
+        "c",
+        "d",
+    }
+    assert liveness.stale(TIMEOUT) == []
+
+
+def test_deleted_replicas_are_forgotten():
+    clock = Clock()
+    liveness = Liveness(TIMEOUT, clock)
+    liveness.update({"a": 1.0})
+    clock.now += 20
+    assert liveness.update({}) == set()
+    assert liveness.stale(0) == []
+    # A replica that comes back is alive again right away
+    assert liveness.update({"a": 2.0}) == {"a"}
@@ -0,0 +1,106 @@
+"""
+Pool of read only connections to the ingester's database, for the bot. Opening a new connection for every poll and command throws away SQLite's page cache and prepared statements each time, so instead a few connections are kept open and handed out as needed. They're tuned for the bot's access pattern, which is many small indexed reads spread over the event tables:
+
+* Opened with mode=ro and query_only, since the bot never writes to this database
+* Memory mapped, so pages are read straight from the OS page cache without copying
+* A larger page cache than the default 2MB, which survives between scans as long as the connection does
+* A larger statement cache, so the queries made by check_node are only prepared once per connection
+
+When the database file is replaced (like a replica syncing a fresh copy), connections to the old file are closed and reopened on the new one the next time they're handed out.
+"""
+
+import contextlib
+import os
+import queue
+import sqlite3
+import threading
+
+POOL_SIZE = 4
+MMAP_SIZE = 256 * 1024 * 1024
+# In KiB, as a negative number per SQLite's convention
+CACHE_SIZE = -64 * 1024
+CACHED_STATEMENTS = 256
+
+
+def file_id(path):
+    """Identifies the file at the path, so we can tell when it has been replaced"""
+    stat = os.stat(path)
+    return stat.st_dev, stat.st_ino
+
+
+class PooledConnection(sqlite3.Connection):
+    """A connection that remembers which file it was opened on"""
+
+    file_id = None
+
+
+class ConnectionPool:
+    def __init__(self, db_file, size=POOL_SIZE):
+        self.db_file = db_file
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def open(self):
+        file = file_id(self.db_file)
+        con = sqlite3.connect(
+            "file:{}?mode=ro".format(self.db_file),
+            uri=True,
+            check_same_thread=False,
+            cached_statements=CACHED_STATEMENTS,
+            factory=PooledConnection,
+        )
+        con.execute("PRAGMA query_only=ON")
+        con.execute("PRAGMA mmap_size={}".format(MMAP_SIZE))
+        con.execute("PRAGMA cache_size={}".format(CACHE_SIZE))
+        con.file_id = file
+        return con
+
+    def reopen(self):
+        """Open a connection in place of one that was closed or failed to open"""
+        try:
+            return self.open()
+        except:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    def get(self):
+        """Take a connection from the pool, opening one if there's room, otherwise waiting for one to be returned"""
+        try:
+            con = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                room = self.opened < self.size
+                if room:
+                    self.opened += 1
+            if room:
+                return self.reopen()
+            con = self.idle.get()
+
+        try:
+            current = file_id(self.db_file)
+        except FileNotFoundError:
+            # Mid replacement. The old file is still readable through the open connection
+            current = con.file_id
+        if current != con.file_id:
+            con.close()
+            return self.reopen()
+        return con
+
+    def put(self, con):
+        """Return a connection to the pool"""
+        # Don't keep a read transaction open, which would keep seeing old data
+        if con.in_transaction:
+            con.rollback()
+        self.idle.put(con)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Use a pooled connection for the duration of a with block"""
+        con = self.get()
+        try:
+            yield con
+        finally:
+            self.put(con)